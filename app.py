@@ -5,11 +5,12 @@ import hashlib
 import hmac
 import json
 from urllib.parse import parse_qsl
-from database import EmailDatabase, ADMIN_ID
+from database import EmailDatabase, ADMIN_ID, is_reserved_address
 
 app = Flask(__name__)
 BOT_TOKEN = os.environ.get('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
 DB_PATH = 'emails.db'
+email_db = EmailDatabase(DB_PATH)
 
 def get_db():
     db = getattr(g, '_database', None)
@@ -48,8 +49,7 @@ def verify_telegram_data(init_data):
             user_data = json.loads(parsed_data.get('user', '{}'))
             
             # Check if user is blocked
-            db_helper = EmailDatabase(DB_PATH)
-            if db_helper.is_user_blocked(user_data['id']):
+            if email_db.is_user_blocked(user_data['id']):
                 # Special handling for Admin? No, Admin shouldn't block himself.
                 if user_data['id'] != ADMIN_ID:
                     return False, None # Treat blocked as invalid/unauthorized
@@ -62,6 +62,15 @@ def verify_telegram_data(init_data):
         print(f"Auth Error: {e}")
         return False, None
 
+def parse_cursor(value):
+    """A page cursor (the last uid of the previous page) as an int, None for the first page."""
+    if value is None:
+        return None
+    # bool is an int, a float would be truncated: neither is a uid
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"invalid cursor: {value!r}")
+    return int(value)
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -77,12 +86,11 @@ def auth():
     valid, user = verify_telegram_data(init_data)
     if valid:
         # Upsert user to ensure they exist in DB (especially for Admin)
-        db_helper = EmailDatabase(DB_PATH)
         # Ensure admin alias exists (recovery)
         if user['id'] == ADMIN_ID:
-            db_helper.ensure_admin_alias(ADMIN_ID)
+            email_db.ensure_admin_alias(ADMIN_ID)
             
-        db_helper.upsert_user(
+        email_db.upsert_user(
             user['id'], 
             user.get('username'), 
             user.get('first_name'), 
@@ -115,10 +123,11 @@ def create_alias():
         return jsonify({"error": "Unauthorized"}), 401
         
     user_id = user['id']
+    if is_reserved_address(alias) and not is_admin(user_id):
+        return jsonify({"error": "Alias is reserved"}), 403
     
     # Use EmailDatabase for safe writing
-    db_helper = EmailDatabase(DB_PATH)
-    if db_helper.add_alias(user_id, alias):
+    if email_db.add_alias(user_id, alias):
         return jsonify({"status": "ok"})
     else:
         return jsonify({"error": "Failed to create alias"}), 500
@@ -134,7 +143,7 @@ def dashboard():
     db = get_db()
     
     # Aliases
-    cursor = db.execute('SELECT * FROM aliases WHERE user_id = ?', (user_id,))
+    cursor = db.execute('SELECT address, active, created_at FROM aliases WHERE user_id = ?', (user_id,))
     aliases = []
     alias_addresses = []
     for row in cursor.fetchall():
@@ -155,10 +164,16 @@ def dashboard():
 def get_emails():
     init_data = request.json.get('initData')
     alias_filter = request.json.get('alias')
-    search_query = request.json.get('query')
+    # The web app sends 'search'; 'query' is kept for older clients
+    search_query = request.json.get('query') or request.json.get('search')
+    # Keyset pagination: 'cursor' is the last uid of the previous page
+    try:
+        before_uid = parse_cursor(request.json.get('cursor'))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    with_total = bool(request.json.get('with_total'))
     page = request.json.get('page', 0)
     limit = 20
-    offset = page * limit
     
     valid, user = verify_telegram_data(init_data)
     if not valid:
@@ -172,7 +187,7 @@ def get_emails():
     user_aliases = [row['address'] for row in cursor.fetchall()]
     
     if not user_aliases:
-        return jsonify({"status": "ok", "emails": []})
+        return jsonify({"status": "ok", "emails": [], "has_more": False, "next_cursor": None})
         
     # Determine which aliases to query
     target_aliases = []
@@ -184,57 +199,27 @@ def get_emails():
     else:
         target_aliases = user_aliases
         
-    placeholders = ','.join('?' for _ in target_aliases)
-    params = list(target_aliases)
-    
-    query_sql = f'''
-        SELECT uid, to_addr, from_addr, subject, received_at, 
-               CASE WHEN html_body IS NOT NULL THEN 1 ELSE 0 END as has_html
-        FROM emails 
-        WHERE to_addr IN ({placeholders})
-    '''
-    
     if search_query:
-        query_sql += ''' AND (
-            subject LIKE ? OR 
-            from_addr LIKE ? OR 
-            text_body LIKE ?
-        )'''
-        search_term = f"%{search_query}%"
-        params.extend([search_term, search_term, search_term])
-        
-    # Get total count first
-    count_sql = f'SELECT COUNT(*) as count FROM emails WHERE to_addr IN ({placeholders})'
-    count_params = list(target_aliases)
-    
-    if search_query:
-        count_sql += ''' AND (
-            subject LIKE ? OR 
-            from_addr LIKE ? OR 
-            text_body LIKE ?
-        )'''
-        count_params.extend([search_term, search_term, search_term])
-        
-    count_cursor = db.execute(count_sql, count_params)
-    total_count = count_cursor.fetchone()['count']
-        
-    query_sql += f' ORDER BY uid DESC LIMIT ? OFFSET ?'
-    params.extend([limit, offset])
-    
-    cursor = db.execute(query_sql, params)
-    
-    emails = []
-    for row in cursor.fetchall():
-        emails.append({
-            "uid": row['uid'],
-            "to": row['to_addr'],
-            "from": row['from_addr'],
-            "subject": row['subject'],
-            "date": row['received_at'],
-            "has_html": bool(row['has_html'])
-        })
-        
-    return jsonify({"status": "ok", "emails": emails, "total": total_count})
+        # Search results are ranked, so they page by offset and always carry a total.
+        # Archived months are searched too.
+        emails, total_count = email_db.search_emails(target_aliases, search_query, limit, page * limit,
+                                                     include_archive=True)
+        has_more = (page + 1) * limit < total_count
+        return jsonify({"status": "ok", "emails": emails, "total": total_count,
+                        "has_more": has_more, "next_cursor": None})
+
+    emails, has_more, total_count = email_db.get_emails_page(
+        target_aliases, limit, before_uid=before_uid, with_total=with_total, include_archive=True
+    )
+    result = {
+        "status": "ok",
+        "emails": emails,
+        "has_more": has_more,
+        "next_cursor": emails[-1]['uid'] if has_more else None
+    }
+    if with_total:
+        result["total"] = total_count
+    return jsonify(result)
 
 @app.route('/api/email_body', methods=['POST'])
 def email_body():
@@ -245,31 +230,35 @@ def email_body():
     if not valid:
         return jsonify({"error": "Unauthorized"}), 401
         
-    db = get_db()
     # Check ownership
-    # 1. Get email to_addr
-    cursor = db.execute('SELECT * FROM emails WHERE uid = ?', (uid,))
-    row = cursor.fetchone()
-    if not row:
+    # 1. Get headers only; bodies are read after the access check
+    meta = email_db.get_email_meta(uid)
+    if not meta:
         return jsonify({"error": "Not found"}), 404
         
     # 2. Check if user owns this alias
-    owner_cursor = db.execute('SELECT user_id FROM aliases WHERE address = ?', (row['to_addr'],))
-    owner_row = owner_cursor.fetchone()
+    owner_id = email_db.get_owner(meta['to_email'])
     
     # Allow if owner matches OR if user is admin
-    if (not owner_row or owner_row['user_id'] != user['id']) and not is_admin(user['id']):
+    if owner_id != user['id'] and not is_admin(user['id']):
         return jsonify({"error": "Access denied"}), 403
 
+    email = email_db.get_email_by_uid(uid)
+    if not email:
+        return jsonify({"error": "Not found"}), 404
+
     return jsonify({
         "status": "ok",
-        "uid": row['uid'],
-        "subject": row['subject'],
-        "from": row['from_addr'],
-        "to": row['to_addr'],
-        "text_body": row['text_body'],
-        "html_body": row['html_body'].decode('utf-8', errors='ignore') if row['html_body'] else None,
-        "date": row['received_at']
+        "uid": email['uid'],
+        "subject": email['subject'],
+        "from": email['from'],
+        "to": email['to_email'],
+        "text_body": email['text'],
+        "body_dropped": email['body_dropped'],
+        "truncated": email['truncated'],
+        "raw_size": email['raw_size'],
+        "html_body": email['html'].decode('utf-8', errors='ignore') if email['html'] else None,
+        "date": email['date']
     })
 
 @app.route('/api/toggle_alias', methods=['POST'])
@@ -282,10 +271,9 @@ def toggle_alias():
         return jsonify({"error": "Unauthorized"}), 401
         
     user_id = user['id']
-    db_helper = EmailDatabase(DB_PATH)
     
     # Verify ownership happens inside toggle_alias_active via user_id check
-    new_state = db_helper.toggle_alias_active(user_id, alias)
+    new_state = email_db.toggle_alias_active(user_id, alias)
     
     if new_state is not None:
         return jsonify({"status": "ok", "active": new_state})
@@ -302,10 +290,9 @@ def delete_alias():
         return jsonify({"error": "Unauthorized"}), 401
         
     user_id = user['id']
-    db_helper = EmailDatabase(DB_PATH)
     
     # Use delete_alias from DB which checks user_id
-    success = db_helper.delete_alias(user_id, alias)
+    success = email_db.delete_alias(user_id, alias)
     
     if success:
         return jsonify({"status": "ok"})
@@ -323,13 +310,11 @@ def admin_users():
     valid, user = verify_telegram_data(init_data)
     if not valid or not is_admin(user['id']):
         return jsonify({"error": "Unauthorized"}), 403
-        
-    db_helper = EmailDatabase(DB_PATH)
     
     # Ensure admin alias exists (recovery)
-    db_helper.ensure_admin_alias(ADMIN_ID)
+    email_db.ensure_admin_alias(ADMIN_ID)
     
-    stats = db_helper.get_all_users_stats()
+    stats = email_db.get_all_users_stats()
     return jsonify({"status": "ok", "users": stats})
 
 @app.route('/api/admin/user_details', methods=['POST'])
@@ -341,8 +326,7 @@ def admin_user_details():
     if not valid or not is_admin(user['id']):
         return jsonify({"error": "Unauthorized"}), 403
         
-    db_helper = EmailDatabase(DB_PATH)
-    details = db_helper.get_user_details_admin(target_user_id)
+    details = email_db.get_user_details_admin(target_user_id)
     return jsonify({"status": "ok", "details": details})
 
 @app.route('/api/admin/block_user', methods=['POST'])
@@ -355,11 +339,10 @@ def admin_block_user():
     if not valid or not is_admin(user['id']):
         return jsonify({"error": "Unauthorized"}), 403
         
-    db_helper = EmailDatabase(DB_PATH)
     if block:
-        db_helper.block_user(target_user_id, "Admin blocked")
+        email_db.block_user(target_user_id, "Admin blocked")
     else:
-        db_helper.unblock_user(target_user_id)
+        email_db.unblock_user(target_user_id)
         
     return jsonify({"status": "ok"})
 
@@ -372,8 +355,7 @@ def admin_delete_user():
     if not valid or not is_admin(user['id']):
         return jsonify({"error": "Unauthorized"}), 403
         
-    db_helper = EmailDatabase(DB_PATH)
-    if db_helper.delete_user_data(target_user_id):
+    if email_db.delete_user_data(target_user_id):
         return jsonify({"status": "ok"})
     return jsonify({"error": "Failed"}), 500
 
@@ -381,15 +363,26 @@ def admin_delete_user():
 def admin_user_emails():
     init_data = request.json.get('initData')
     target_user_id = request.json.get('user_id')
-    page = request.json.get('page', 0)
+    try:
+        before_uid = parse_cursor(request.json.get('cursor'))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    with_total = bool(request.json.get('with_total'))
     
     valid, user = verify_telegram_data(init_data)
     if not valid or not is_admin(user['id']):
         return jsonify({"error": "Unauthorized"}), 403
         
-    db_helper = EmailDatabase(DB_PATH)
-    emails, total = db_helper.get_user_emails_admin(target_user_id, offset=page*50)
-    return jsonify({"status": "ok", "emails": emails, "total": total})
+    emails, has_more, total = email_db.get_user_emails_admin(target_user_id, before_uid=before_uid, with_total=with_total)
+    result = {
+        "status": "ok",
+        "emails": emails,
+        "has_more": has_more,
+        "next_cursor": emails[-1]['uid'] if has_more else None
+    }
+    if with_total:
+        result["total"] = total
+    return jsonify(result)
 
 @app.route('/api/admin/delete_email', methods=['POST'])
 def admin_delete_email():
@@ -400,8 +393,7 @@ def admin_delete_email():
     if not valid or not is_admin(user['id']):
         return jsonify({"error": "Unauthorized"}), 403
         
-    db_helper = EmailDatabase(DB_PATH)
-    db_helper.delete_email(uid)
+    email_db.delete_email(uid)
     return jsonify({"status": "ok"})
 
 @app.route('/api/admin/add_alias', methods=['POST'])
@@ -414,8 +406,7 @@ def admin_add_alias():
     if not valid or not is_admin(user['id']):
         return jsonify({"error": "Unauthorized"}), 403
         
-    db_helper = EmailDatabase(DB_PATH)
-    if db_helper.add_alias(target_user_id, alias):
+    if email_db.add_alias(target_user_id, alias):
         return jsonify({"status": "ok"})
     return jsonify({"error": "Failed"}), 500
 
@@ -428,18 +419,17 @@ def delete_email():
     if not valid:
         return jsonify({"error": "Unauthorized"}), 403
         
-    db_helper = EmailDatabase(DB_PATH)
     # Verify ownership before deleting
-    email = db_helper.get_email_by_uid(uid)
+    email = email_db.get_email_meta(uid)
     if not email:
         return jsonify({"error": "Not found"}), 404
         
     # Check if the email's 'to_addr' belongs to one of the user's aliases
-    owner_id = db_helper.get_owner(email['to_email'])
+    owner_id = email_db.get_owner(email['to_email'])
     if owner_id != user['id']:
         return jsonify({"error": "Forbidden"}), 403
         
-    if db_helper.delete_email(uid):
+    if email_db.delete_email(uid):
         return jsonify({"status": "ok"})
     return jsonify({"error": "Failed"}), 500
 
@@ -453,8 +443,7 @@ def admin_toggle_alias():
     if not valid or not is_admin(user['id']):
         return jsonify({"error": "Unauthorized"}), 403
         
-    db_helper = EmailDatabase(DB_PATH)
-    new_state = db_helper.toggle_alias_active(target_user_id, alias)
+    new_state = email_db.toggle_alias_active(target_user_id, alias)
     if new_state is not None:
         return jsonify({"status": "ok", "active": new_state})
     return jsonify({"error": "Failed"}), 400
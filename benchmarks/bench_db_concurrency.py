@@ -0,0 +1,126 @@
+"""
+Mixed read/write throughput of EmailDatabase from several threads.
+
+Compares the old access pattern (new sqlite3 connection per call, one global
+lock for reads and writes, rollback journal) with the pooled WAL layer.
+
+    python benchmarks/bench_db_concurrency.py --threads 8 --seconds 5
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import EmailDatabase
+
+
+class LegacyEmailDatabase:
+    """The pre-pool access pattern: connect, query, close under one lock."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        conn = sqlite3.connect(db_path)
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.close()
+
+    def add_email(self, uid, owner_id, to_addr, from_addr, subject, text_body, html_body):
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            conn.execute('''
+                INSERT OR IGNORE INTO emails (uid, owner_id, to_addr, from_addr, subject, text_body, html_body)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (uid, owner_id, to_addr, from_addr, subject, text_body, html_body))
+            conn.commit()
+            conn.close()
+
+    def get_owner(self, email):
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            row = conn.execute('SELECT user_id FROM aliases WHERE address = ?', (email,)).fetchone()
+            conn.close()
+            return row[0] if row else None
+
+    def get_email_by_uid(self, uid):
+        with self.lock:
+            conn = sqlite3.connect(self.db_path)
+            row = conn.execute('SELECT * FROM emails WHERE uid = ?', (uid,)).fetchone()
+            conn.close()
+            return row
+
+
+def seed(db_path, aliases, emails):
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = EmailDatabase(db_path)
+    for i in range(aliases):
+        db.add_alias(1000 + i, f"user{i}@dreampartners.online")
+    for uid in range(1, emails + 1):
+        db.add_email(uid, 1000 + uid % aliases, f"user{uid % aliases}@dreampartners.online",
+                     "sender@example.com", f"Subject {uid}", "body " * 200, None)
+    db.close()
+
+
+def run(db, threads, seconds, write_ratio, aliases, start_uid):
+    stop = time.monotonic() + seconds
+    counts = [0] * threads
+    next_uid = [start_uid]
+    uid_lock = threading.Lock()
+
+    def worker(n):
+        rnd = random.Random(n)
+        done = 0
+        while time.monotonic() < stop:
+            if rnd.random() < write_ratio:
+                with uid_lock:
+                    next_uid[0] += 1
+                    uid = next_uid[0]
+                db.add_email(uid, 0, "user0@dreampartners.online", "bench@example.com",
+                             "bench", "text " * 200, None)
+            elif rnd.random() < 0.5:
+                db.get_owner(f"user{rnd.randrange(aliases)}@dreampartners.online")
+            else:
+                db.get_email_by_uid(rnd.randrange(1, start_uid))
+            done += 1
+        counts[n] = done
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool: t.start()
+    for t in pool: t.join()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    parser.add_argument('--aliases', type=int, default=200)
+    parser.add_argument('--emails', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for name in ('legacy', 'pooled'):
+            db_path = os.path.join(tmp, f"{name}.db")
+            seed(db_path, args.aliases, args.emails)
+            db = LegacyEmailDatabase(db_path) if name == 'legacy' else EmailDatabase(db_path)
+            results[name] = run(db, args.threads, args.seconds, args.write_ratio,
+                                args.aliases, args.emails + 1)
+            if name == 'pooled':
+                db.close()
+            print(f"{name:>7}: {results[name]:10.0f} ops/s "
+                  f"({args.threads} threads, {args.write_ratio:.0%} writes)")
+
+        print(f"speedup: {results['pooled'] / results['legacy']:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+HTML extraction: mail_parser.extract_html (one pass, no tree) against the
+old path, which built one BeautifulSoup tree for get_text() and a second
+one for extract_links().
+
+First checks extract_html against the golden corpus in html_golden/
+(expected.json holds what BeautifulSoup produced), then times both paths.
+
+    python benchmarks/bench_html_extract.py
+    python benchmarks/bench_html_extract.py --corpus ~/Maildir/cur   # HTML parts of real mail
+    python benchmarks/bench_html_extract.py --update   # regenerate expected.json (needs bs4)
+    python benchmarks/bench_html_extract.py --golden-only   # just the golden check, no bs4 needed
+
+Without bs4 it fails unless --golden-only is given.
+"""
+import argparse
+import email
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GOLDEN = os.path.join(HERE, 'html_golden')
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from mail_parser import LINK_KEYWORDS, extract_html
+from bench_parse import load_corpus, synthetic_corpus
+
+
+# --- The two-tree path, as mail_parser had it ---
+
+def legacy_extract(html_bytes):
+    from bs4 import BeautifulSoup
+    text = BeautifulSoup(html_bytes, "html.parser").get_text(separator="\n").strip()
+    links, seen = [], set()
+    for a in BeautifulSoup(html_bytes, "html.parser").find_all('a', href=True):
+        href = a['href']
+        label_text = a.get_text().strip().lower()
+        score = 0
+        if any(k in label_text for k in LINK_KEYWORDS):
+            score = 2
+        elif any(k in href.lower() for k in LINK_KEYWORDS):
+            score = 1
+        if score > 0 and href not in seen and "http" in href:
+            label = label_text if len(label_text) < 30 and label_text else "🔗 action"
+            links.append({"url": href, "label": label, "score": score})
+            seen.add(href)
+    links.sort(key=lambda x: x['score'], reverse=True)
+    return text, links[:3]
+
+
+# --- Corpus ---
+
+def golden_cases():
+    return {name[:-len('.html')]: open(os.path.join(GOLDEN, name), 'rb').read()
+            for name in sorted(os.listdir(GOLDEN)) if name.endswith('.html')}
+
+
+def html_parts(messages):
+    parts = []
+    for raw in messages:
+        for part in email.message_from_bytes(raw).walk():
+            if part.get_content_type() == 'text/html':
+                payload = part.get_payload(decode=True)
+                if payload:
+                    parts.append(payload)
+    return parts
+
+
+def check_golden():
+    expected_path = os.path.join(GOLDEN, 'expected.json')
+    with open(expected_path, encoding='utf-8') as f:
+        expected = json.load(f)
+    failed = 0
+    for name, data in golden_cases().items():
+        text, links = extract_html(data)
+        want = expected.get(name)
+        if want is None or want != {'text': text, 'links': links}:
+            failed += 1
+            print(f"golden mismatch: {name}")
+            if want is not None:
+                print(f"  expected {want!r:.300}\n  got      {({'text': text, 'links': links})!r:.300}")
+    print(f"golden corpus: {len(expected) - failed}/{len(expected)} match")
+    return failed == 0
+
+
+def update_golden():
+    expected = {}
+    for name, data in golden_cases().items():
+        text, links = legacy_extract(data)
+        expected[name] = {'text': text, 'links': links}
+    with open(os.path.join(GOLDEN, 'expected.json'), 'w', encoding='utf-8') as f:
+        json.dump(expected, f, ensure_ascii=False, indent=1, sort_keys=True)
+        f.write('\n')
+    print(f"wrote {len(expected)} cases")
+
+
+# --- Runs ---
+
+def run(name, parts, extract):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for data in parts:
+        extract(data)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:<24} {len(parts) / elapsed:>8.0f} docs/s  ({elapsed:.2f}s)  peak {peak / 1e3:.0f} KB")
+    return elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--corpus', help='directory of .eml files or an mbox file')
+    ap.add_argument('--generate', type=int, default=600, help='synthetic messages when no corpus is given')
+    ap.add_argument('--update', action='store_true', help='regenerate html_golden/expected.json with bs4')
+    ap.add_argument('--golden-only', action='store_true', help='only check the golden corpus')
+    args = ap.parse_args()
+
+    if args.update:
+        update_golden()
+        return
+    ok = check_golden()
+    if args.golden_only:
+        sys.exit(0 if ok else 1)
+
+    messages = load_corpus(os.path.expanduser(args.corpus)) if args.corpus else synthetic_corpus(args.generate)
+    parts = html_parts(messages) + list(golden_cases().values())
+    print(f"{len(parts)} HTML documents, {sum(len(p) for p in parts) / 1e6:.1f} MB")
+
+    try:
+        import bs4  # noqa: F401
+    except ImportError:
+        sys.exit("bs4 is not installed: the two-tree comparison needs it (or pass --golden-only)")
+
+    mismatched = sum(1 for data in parts if extract_html(data) != legacy_extract(data))
+    if mismatched:
+        print(f"warning: {mismatched} of {len(parts)} documents extract differently")
+    base = run('two BeautifulSoup trees', parts, legacy_extract)
+    elapsed = run('extract_html', parts, extract_html)
+    print(f"{'':<24} {base / elapsed:.1f}x faster")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
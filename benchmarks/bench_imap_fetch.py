@@ -0,0 +1,102 @@
+"""
+Catch-up download throughput: one `UID FETCH` per message (the old loop)
+against pipelined multi-message batches from imap_sync.fetch_messages.
+
+Runs against the local IMAP stand-in in fake_imap.py; --latency adds a
+simulated round trip to every command, which is what the batching saves.
+With --attachment-every, header-first ingestion (imap_sync.fetch_structured)
+is compared with whole-message batches on a mailbox where every Nth message
+carries an attachment.
+
+    python benchmarks/bench_imap_fetch.py --messages 2000 --latency 0.02
+    python benchmarks/bench_imap_fetch.py --attachment-every 3 --attachment-size 2000000 --skip-single
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import imap_idle
+from fake_imap import FakeIMAPServer, FakeMailbox, generate_message, generate_with_attachment
+from imap_sync import fetch_messages, fetch_structured
+
+
+def per_message(conn, uids):
+    total = 0
+    for uid in uids:
+        typ, data = conn.uid('fetch', str(uid), '(RFC822)')
+        total += len(data[0][1])
+    return total
+
+
+def pipelined(conn, uids, batch, batch_bytes, window):
+    return sum(len(raw) for _, raw in fetch_messages(conn, uids, batch, batch_bytes, window))
+
+
+def header_first(conn, uids, batch, batch_bytes, window):
+    return sum(len(raw) for _, raw, _ in fetch_structured(conn, uids, None, batch, batch_bytes, window))
+
+
+def run(name, server, fn):
+    conn = imap_idle.connect('127.0.0.1', 'bench', 'bench', port=server.port, use_ssl=False)
+    conn.select('INBOX')
+    typ, data = conn.uid('search', None, 'ALL')
+    uids = [int(x) for x in data[0].split()]
+    start = time.perf_counter()
+    total = fn(conn, uids)
+    elapsed = time.perf_counter() - start
+    conn.logout()
+    print(f"{name:<28} {len(uids) / elapsed:>9.0f} msg/s {total / 1e6:>9.1f} MB downloaded  ({elapsed:.2f}s)")
+    return elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--messages', type=int, default=2000)
+    ap.add_argument('--size', type=int, default=4000, help='approximate message size in bytes')
+    ap.add_argument('--latency', type=float, default=0.02, help='simulated round trip per command, seconds')
+    ap.add_argument('--batch', type=int, default=100, help='messages per FETCH')
+    ap.add_argument('--batch-bytes', type=int, default=8 << 20, help='bytes per FETCH')
+    ap.add_argument('--window', type=int, default=2, help='FETCH commands in flight')
+    ap.add_argument('--skip-single', action='store_true', help='skip the per-message baseline')
+    ap.add_argument('--attachment-every', type=int, default=0, help='every Nth message has an attachment')
+    ap.add_argument('--attachment-size', type=int, default=2 << 20)
+    ap.add_argument('--bandwidth', type=float, default=0, help='server send rate, MB/s (0: unlimited)')
+    args = ap.parse_args()
+
+    mailbox = FakeMailbox()
+    for i in range(args.messages):
+        if args.attachment_every and i % args.attachment_every == 0:
+            mailbox.append(generate_with_attachment(i, body_size=args.size, attachment_size=args.attachment_size))
+        else:
+            mailbox.append(generate_message(i, body_size=args.size))
+    if args.attachment_every:
+        # A real server has the MIME structure indexed; keep the fake's own parsing out of the timings
+        for uid in mailbox.uids():
+            mailbox.parsed(uid)
+    server = FakeIMAPServer(mailbox, latency=args.latency, bandwidth=args.bandwidth * 1e6).start()
+    print(f"{args.messages} messages of ~{args.size} bytes, {args.latency * 1000:.0f} ms per round trip"
+          + (f", {args.bandwidth:g} MB/s" if args.bandwidth else ''))
+
+    try:
+        if not args.skip_single:
+            base = run('per-message UID FETCH', server, per_message)
+        best = run(f'batched {args.batch}/cmd, window 1', server,
+                   lambda c, u: pipelined(c, u, args.batch, args.batch_bytes, 1))
+        piped = run(f'batched {args.batch}/cmd, window {args.window}', server,
+                    lambda c, u: pipelined(c, u, args.batch, args.batch_bytes, args.window))
+        if not args.skip_single:
+            print(f"speedup over per-message: {base / min(best, piped):.1f}x")
+        if args.attachment_every:
+            partial = run('header-first, text sections', server,
+                          lambda c, u: header_first(c, u, args.batch, args.batch_bytes, args.window))
+            print(f"header-first vs whole messages: {piped / partial:.1f}x")
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+End-to-end ingestion: the bot's intake loop (ingest.MailIngest, what
+bot1.mail_check_loop runs) against generated mailboxes served by the
+in-process IMAP stand-in (fake_imap.py), into a throwaway database. Parsing
+runs in a ParserPool as in the bot; notifications go through the outbox to
+a counting stand-in for Telegram.
+
+Two phases:
+  history  the mailboxes already hold --messages emails when the loop
+           starts; the first catch-up pass takes the newest of each folder
+           and the backfill the rest. Timed until all are stored.
+  live     --live more emails arrive at --rate per second (0: all at once)
+           while the loop idles. Each is timed from its APPEND to the commit
+           of the transaction that stored it.
+
+A live email must not wait out a partial store batch: the run fails when
+the live p50 is not well under INGEST_FLUSH_INTERVAL (--max-live-p50).
+
+Peak RSS is the high-water mark of this process, which also holds the
+fake mailboxes (reported separately), and of the largest parser process.
+
+--json writes the results with the current commit, so runs on two commits
+can be compared; --baseline compares with such a file and exits 1 when a
+metric got worse by more than --tolerance.
+
+    python benchmarks/bench_ingest.py --messages 5000 --live 500 --json before.json
+    python benchmarks/bench_ingest.py --messages 5000 --live 500 --baseline before.json
+    python benchmarks/bench_ingest.py --accounts 2 --folders INBOX,Spam,Promo --max-connections 3
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from database import ALLOWED_DOMAINS, EmailDatabase
+from fake_imap import FakeIMAPServer, FakeMailbox, MailboxGenerator
+from imap_scheduler import Account, source_name
+from ingest import INGEST_FLUSH_INTERVAL, MailIngest
+from mail_parser import ParserPool
+
+# (metric, higher is better) compared against --baseline
+METRICS = [
+    ('history.msg_per_s', True),
+    ('live.msg_per_s', True),
+    ('live.latency_ms.p50', False),
+    ('live.latency_ms.p95', False),
+    ('peak_rss_mb.main', False),
+    ('peak_rss_mb.parser', False),
+]
+
+
+class TimedDatabase(EmailDatabase):
+    """Notes when the transaction storing each (source, server uid) committed."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.committed = {}
+        self.cond = threading.Condition()
+
+    def add_emails(self, messages, raise_errors=False):
+        stored = super().add_emails(messages, raise_errors)
+        now = time.perf_counter()
+        with self.cond:
+            for m in messages:
+                self.committed.setdefault((m.get('source'), m.get('server_uid')), now)
+            self.cond.notify_all()
+        return stored
+
+    def wait_for(self, count, timeout):
+        """True once `count` messages are stored."""
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.committed) >= count, timeout)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def git_commit():
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return head + ('-dirty' if dirty else '')
+
+
+def metric(result, path):
+    for key in path.split('.'):
+        result = result[key]
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """Prints each metric against the baseline; returns the regressed ones."""
+    if baseline.get('params') != result['params']:
+        print("note: the baseline ran with different parameters")
+    print(f"vs baseline {baseline.get('commit')}:")
+    regressed = []
+    for path, higher_better in METRICS:
+        old, new = metric(baseline, path), metric(result, path)
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_better else change
+        flag = 'REGRESSION' if worse > tolerance else ''
+        if flag:
+            regressed.append(path)
+        print(f"  {path:<22} {old:>10.1f} -> {new:>10.1f}  {change:+6.1%} {flag}")
+    return regressed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--messages', type=int, default=2000, help='emails in the mailboxes before the start')
+    ap.add_argument('--live', type=int, default=300, help='emails arriving after the catch-up')
+    ap.add_argument('--rate', type=float, default=50, help='live arrivals per second, 0: all at once')
+    ap.add_argument('--accounts', type=int, default=1, help='upstream accounts, one fake server each')
+    ap.add_argument('--folders', default='INBOX', help='folders of every account')
+    ap.add_argument('--max-connections', type=int, default=5, help='IMAP_MAX_CONNECTIONS per account')
+    ap.add_argument('--aliases', type=int, default=50, help='aliases the mail is addressed to')
+    ap.add_argument('--median-size', type=int, default=4000, help='median message size, bytes')
+    ap.add_argument('--size-sigma', type=float, default=1.0, help='spread of the log-normal sizes')
+    ap.add_argument('--max-size', type=int, default=4 << 20, help='largest message, bytes')
+    ap.add_argument('--cyrillic', type=float, default=0.3, help='share of Russian mail')
+    ap.add_argument('--latency', type=float, default=0.01, help='simulated round trip per IMAP command, seconds')
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--timeout', type=float, default=600, help='give up on a phase after this many seconds')
+    ap.add_argument('--json', help='write the results here')
+    ap.add_argument('--baseline', help='results of an earlier run to compare with')
+    ap.add_argument('--tolerance', type=float, default=0.15, help='allowed relative regression')
+    ap.add_argument('--max-live-p50', type=float, default=INGEST_FLUSH_INTERVAL * 1000 / 4,
+                    help='fail above this live arrival->commit p50, ms (default: a quarter of INGEST_FLUSH_INTERVAL)')
+    args = ap.parse_args()
+    params = {k: v for k, v in vars(args).items()
+              if k not in ('json', 'baseline', 'tolerance', 'timeout', 'max_live_p50')}
+    folders = [f.strip() for f in args.folders.split(',') if f.strip()]
+
+    aliases = [f'user{i}@{ALLOWED_DOMAINS[0]}' for i in range(args.aliases)]
+    generator = MailboxGenerator(aliases, seed=args.seed, median_size=args.median_size,
+                                 size_sigma=args.size_sigma, max_size=args.max_size, cyrillic=args.cyrillic)
+    servers, accounts, boxes = [], [], {}
+    for a in range(args.accounts):
+        mailboxes = {folder: FakeMailbox(uidvalidity=a + 1) for folder in folders}
+        server = FakeIMAPServer(mailboxes['INBOX'] if 'INBOX' in mailboxes else None, latency=args.latency,
+                                folders=mailboxes).start()
+        account = Account(f'bench{a}@example.com', 'x', '127.0.0.1', folders, port=server.port,
+                          use_ssl=False, max_connections=args.max_connections)
+        servers.append(server)
+        accounts.append(account)
+        for folder in folders:
+            boxes[source_name(account.user, folder)] = mailboxes[folder]
+    sources = list(boxes)
+    for i in range(args.messages):
+        boxes[sources[i % len(sources)]].append(generator.message())
+    # A real server has the MIME structure indexed; keep the fake's own parsing out of the timings
+    for box in boxes.values():
+        for uid in box.uids():
+            box.parsed(uid)
+    live = [generator.message() for _ in range(args.live)]
+    mailbox_mb = sum(len(raw) for box in boxes.values() for raw, _ in box.messages.values()) / (1 << 20)
+    print(f"{args.messages} emails in {len(sources)} folders ({mailbox_mb:.1f} MB), then {args.live} live "
+          f"at {args.rate or 'unlimited'}/s; {args.aliases} aliases, {args.latency * 1000:.0f} ms per round trip")
+
+    parser_pool = ParserPool()
+    parser_pool.start()
+    notified = []
+
+    def send(chat_id, email):
+        notified.append(email['uid'])
+        return len(notified)
+
+    result = {'benchmark': 'ingest', 'commit': git_commit(),
+              'time': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'params': params}
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        db = TimedDatabase(os.path.join(tmp, 'emails.db'))
+        for i, alias in enumerate(aliases):
+            db.add_alias(1000 + i, alias)
+        ingest = MailIngest(db, accounts, parser_pool.parse, send, smtp_port=0)
+        thread = threading.Thread(target=ingest.run, daemon=True)
+
+        start = time.perf_counter()
+        thread.start()
+        ok = db.wait_for(args.messages, args.timeout)
+        elapsed = time.perf_counter() - start
+        stored = len(db.committed)
+        result['history'] = {'messages': stored, 'seconds': round(elapsed, 3),
+                             'msg_per_s': round(stored / elapsed, 1)}
+        print(f"history  {stored:>6} stored in {elapsed:6.2f}s  {stored / elapsed:8.0f} msg/s")
+
+        arrived = {}
+        if ok and live:
+            # Give the catch-up a moment to settle into IDLE
+            time.sleep(1)
+            start = time.perf_counter()
+            for i, raw in enumerate(live):
+                if args.rate:
+                    delay = start + i / args.rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                source = sources[i % len(sources)]
+                now = time.perf_counter()
+                arrived[(source, boxes[source].append(raw))] = now
+            ok = db.wait_for(args.messages + args.live, args.timeout)
+            done = max((db.committed.get(key, 0) for key in arrived), default=start)
+            latencies = [(db.committed[key] - t) * 1000 for key, t in arrived.items() if key in db.committed]
+            elapsed = done - start
+            result['live'] = {
+                'messages': len(latencies), 'seconds': round(elapsed, 3),
+                'msg_per_s': round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+                'latency_ms': {name: round(percentile(latencies, p), 1)
+                               for name, p in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))},
+            }
+            lat = result['live']['latency_ms']
+            print(f"live     {len(latencies):>6} stored in {elapsed:6.2f}s  {result['live']['msg_per_s']:8.0f} msg/s"
+                  f"  arrival->commit p50 {lat['p50']:.0f} ms, p95 {lat['p95']:.0f} ms, max {lat['max']:.0f} ms")
+
+        ingest.stop(thread, timeout=30)
+        db.close()
+    if 'live' in result:
+        # Counted once the notify stage is drained
+        result['live']['notified'] = len(notified)
+    parser_pool.close()
+    for server in servers:
+        server.stop()
+
+    # ru_maxrss is in KB on Linux; for children it is the largest one that has exited
+    result['peak_rss_mb'] = {
+        'main': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'parser': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'mailbox': round(mailbox_mb, 1),
+    }
+    rss = result['peak_rss_mb']
+    print(f"peak RSS {rss['main']:.0f} MB (mailboxes {rss['mailbox']:.0f} MB of it), parser process {rss['parser']:.0f} MB")
+    if not ok:
+        print("timed out before every email was stored")
+        return 1
+    if 'live' in result and result['live']['latency_ms']['p50'] > args.max_live_p50:
+        print(f"live p50 {result['live']['latency_ms']['p50']:.0f} ms is over {args.max_live_p50:.0f} ms: "
+              f"live mail waits for the store batch (INGEST_FLUSH_INTERVAL {INGEST_FLUSH_INTERVAL}s)")
+        return 1
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Peak memory of parsing one very large message (mail_parser.parse_message).
+
+Each case message is received in 64 KB chunks into a MessageSpool, as the
+LMTP/SMTP server does, and parsed from the spool file; for comparison the
+same message is parsed from bytes in memory, as every message was before.
+Peaks are measured with tracemalloc and do not count the raw message the
+in-memory path is handed. The spooled results must match the in-memory ones
+up to the caps, and the spooled peak must stay under --max-peak (by default
+a few MB over ten times the caps) whatever the message size.
+
+    python benchmarks/bench_large_message.py --size 50
+    python benchmarks/bench_large_message.py --text-max 262144 --html-max 262144
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mail_parser
+from mail_parser import MessageSpool, parse_message
+
+CHUNK = 64 << 10
+
+
+def with_attachment(size):
+    """Short text and HTML, plus a base64 attachment of `size` bytes."""
+    blob = base64.encodebytes(os.urandom(size))
+    return (
+        b"From: Sender <sender@example.org>\r\n"
+        b"To: user@example.com\r\n"
+        b"Subject: Scan of the contract\r\n"
+        b"MIME-Version: 1.0\r\n"
+        b"Content-Type: multipart/mixed; boundary=\"m1\"\r\n\r\n"
+        b"--m1\r\nContent-Type: multipart/alternative; boundary=\"b1\"\r\n\r\n"
+        b"--b1\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n"
+        b"Please sign and confirm: https://example.com/confirm?id=1\r\n"
+        b"--b1\r\nContent-Type: text/html; charset=utf-8\r\n\r\n"
+        b"<p>Please sign and <a href='https://example.com/confirm?id=1'>confirm</a></p>\r\n"
+        b"--b1--\r\n"
+        b"--m1\r\nContent-Type: application/pdf; name=\"scan.pdf\"\r\n"
+        b"Content-Disposition: attachment; filename=\"scan.pdf\"\r\n"
+        b"Content-Transfer-Encoding: base64\r\n\r\n"
+        + blob +
+        b"--m1--\r\n"
+    )
+
+
+def huge_text(size):
+    """A text/plain log dump of about `size` bytes, quoted-printable."""
+    line = b"2026-01-01 12:00:00 worker=7 status=ok latency=12ms path=/api/v1/items=3D42\r\n"
+    return (
+        b"From: cron@example.org\r\n"
+        b"To: user@example.com\r\n"
+        b"Subject: Nightly log\r\n"
+        b"MIME-Version: 1.0\r\n"
+        b"Content-Type: text/plain; charset=utf-8\r\n"
+        b"Content-Transfer-Encoding: quoted-printable\r\n\r\n"
+        + line * (size // len(line))
+    )
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak, elapsed
+
+
+def spooled(raw):
+    with MessageSpool() as spool:
+        for i in range(0, len(raw), CHUNK):
+            spool.write(raw[i:i + CHUNK])
+        return parse_message(spool.message())
+
+
+def same(full, cut):
+    """The spooled result is the in-memory one, cut at the caps."""
+    for key in ('subject', 'from', 'to_email', 'links', 'raw_size'):
+        if full[key] != cut[key]:
+            return False
+    if not full['text'].startswith(cut['text']):
+        return False
+    return (full['html'] or b'').startswith(cut['html'] or b'')
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--size', type=int, default=30, help='message size in MB')
+    ap.add_argument('--text-max', type=int, default=mail_parser.MAIL_TEXT_MAX, help='MAIL_TEXT_MAX')
+    ap.add_argument('--html-max', type=int, default=mail_parser.MAIL_HTML_MAX, help='MAIL_HTML_MAX')
+    ap.add_argument('--max-peak', type=float, help='fail above this spooled peak, MB')
+    args = ap.parse_args()
+    max_peak = args.max_peak * (1 << 20) if args.max_peak else 10 * max(args.text_max, args.html_max) + (4 << 20)
+    mail_parser.MAIL_TEXT_MAX = args.text_max
+    mail_parser.MAIL_HTML_MAX = args.html_max
+
+    size = args.size << 20
+    ok = True
+    for name, make in (('attachment', with_attachment), ('text body', huge_text)):
+        raw = make(size)
+        full, mem_peak, mem_time = measure(lambda: parse_message(raw))
+        cut, spool_peak, spool_time = measure(lambda: spooled(raw))
+        del raw
+        matches = same(full, cut)
+        print(f"{name:<11} {full['raw_size'] / (1 << 20):6.1f} MB  "
+              f"in memory: peak {mem_peak / (1 << 20):7.1f} MB {mem_time:5.2f}s   "
+              f"spooled: peak {spool_peak / (1 << 20):5.1f} MB {spool_time:5.2f}s   "
+              f"text {len(cut['text'])} chars, truncated {cut['truncated']}, "
+              f"{'same' if matches else 'DIFFERENT'}")
+        ok = ok and matches and spool_peak <= max_peak
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
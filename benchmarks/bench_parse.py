@@ -0,0 +1,203 @@
+"""
+Parsing throughput: the old in-thread path (parse_email, then extract_links
+building a second BeautifulSoup tree) against mail_parser.parse_message
+in-process and in a ParserPool.
+
+Also measures how late a 5 ms ticker thread runs while parsing is going on,
+which is what the bot's polling thread feels.
+
+    python benchmarks/bench_parse.py --corpus ~/mail/cur --processes 2 4
+    python benchmarks/bench_parse.py --corpus archive.mbox
+    python benchmarks/bench_parse.py --generate 2000   # synthetic corpus
+"""
+import argparse
+import base64
+import email
+import mailbox
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.header import decode_header
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mail_parser import ParserPool, parse_message
+
+
+# --- The pre-pool path, as bot1.py had it ---
+
+def legacy_decode_str(s):
+    if s is None: return ""
+    value = ""
+    for decoded, charset in decode_header(s):
+        if isinstance(decoded, bytes):
+            try:
+                value += decoded.decode(charset or 'utf-8')
+            except Exception:
+                value += decoded.decode('utf-8', errors='ignore')
+        else:
+            value += str(decoded)
+    return value
+
+
+def legacy_parse(raw):
+    from bs4 import BeautifulSoup
+    msg = email.message_from_bytes(raw)
+    subject, from_ = legacy_decode_str(msg["Subject"]), legacy_decode_str(msg["From"])
+    body_text, body_html = "", None
+    for part in msg.walk():
+        if part.is_multipart():
+            continue
+        payload = part.get_payload(decode=True)
+        disposition = str(part.get("Content-Disposition"))
+        if payload and "attachment" not in disposition:
+            if part.get_content_type() == "text/plain":
+                body_text += payload.decode('utf-8', errors='ignore')
+            elif part.get_content_type() == "text/html":
+                body_html = payload
+    if not body_text and body_html:
+        body_text = BeautifulSoup(body_html, "html.parser").get_text(separator="\n").strip()
+    keywords = ['confirm', 'verify', 'activate', 'login', 'sign in', 'подтвердить', 'активировать', 'войти']
+    links = []
+    if body_html:
+        # The second tree extract_links() used to build
+        for a in BeautifulSoup(body_html, "html.parser").find_all('a', href=True):
+            text = a.get_text().strip().lower()
+            if any(k in text or k in a['href'].lower() for k in keywords):
+                links.append(a['href'])
+    return subject, from_, body_text, links
+
+
+# --- Corpus ---
+
+def load_corpus(path):
+    if os.path.isdir(path):
+        messages = []
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as f:
+                    messages.append(f.read())
+        return messages
+    return [bytes(m) for m in mailbox.mbox(path)]
+
+
+def synthetic_corpus(n):
+    """Shapes seen in a temp-mail inbox: HTML-only newsletters, multipart codes, Cyrillic QP/base64."""
+    rows = ''.join(
+        f"<tr><td style='padding:8px'><img src='https://cdn.example.com/{i}.png'></td>"
+        f"<td><h3>Offer {i}</h3><p>{'Lorem ipsum dolor sit amet. ' * 8}</p>"
+        f"<a href='https://shop.example.com/item/{i}?utm_source=mail'>Buy now</a></td></tr>"
+        for i in range(25)
+    )
+    newsletter = (f"<html><head><style>td {{ font-family: Arial }}</style></head><body><table>{rows}</table>"
+                  "<a href='https://shop.example.com/unsubscribe'>Unsubscribe</a></body></html>")
+    corpus = []
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            msg = MIMEText(newsletter, 'html', 'utf-8')
+            msg['Subject'] = f'Weekly deals #{i}'
+        elif kind == 1:
+            msg = MIMEMultipart('alternative')
+            code = 100000 + i
+            msg.attach(MIMEText(f"Your code is {code}\nConfirm: https://auth.example.com/verify?c={code}", 'plain'))
+            msg.attach(MIMEText(
+                f"<html><body><p>Your code is <b>{code}</b></p>"
+                f"<a href='https://auth.example.com/verify?c={code}'>Confirm email</a></body></html>", 'html'))
+            msg['Subject'] = 'Confirm your email'
+        else:
+            body = "<html><body>" + "<p>Здравствуйте! Подтвердите адрес почты.</p>" * 30 + \
+                   f"<a href='https://example.ru/activate/{i}'>Подтвердить</a></body></html>"
+            msg = MIMEText(body, 'html', 'utf-8')
+            msg.replace_header('Content-Transfer-Encoding', 'base64')
+            msg.set_payload(base64.encodebytes(body.encode()).decode())
+            msg['Subject'] = '=?utf-8?b?' + base64.b64encode('Подтверждение регистрации'.encode()).decode() + '?='
+        msg['From'] = f'Sender {i % 7} <noreply{i % 7}@example.com>'
+        msg['To'] = f'user{i % 50}@dreampartners.online'
+        corpus.append(msg.as_bytes())
+    return corpus
+
+
+# --- Runs ---
+
+class Ticker:
+    """A 5 ms timer thread; records how late it wakes up."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lateness = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            time.sleep(self.interval)
+            self.lateness.append(time.perf_counter() - start - self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def report(self):
+        late = sorted(self.lateness) or [0.0]
+        return f"ticker late p99 {late[int(len(late) * 0.99)] * 1000:.1f} ms, max {late[-1] * 1000:.1f} ms"
+
+
+def run(name, corpus, parse, threads=1):
+    with Ticker() as ticker:
+        start = time.perf_counter()
+        if threads > 1:
+            with ThreadPoolExecutor(threads) as ex:
+                list(ex.map(parse, corpus))
+        else:
+            for raw in corpus:
+                parse(raw)
+        elapsed = time.perf_counter() - start
+    print(f"{name:<28} {len(corpus) / elapsed:>8.0f} msg/s  ({elapsed:.2f}s)  {ticker.report()}")
+    return elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--corpus', help='directory of .eml files or an mbox file')
+    ap.add_argument('--generate', type=int, default=1500, help='synthetic messages when no corpus is given')
+    ap.add_argument('--processes', type=int, nargs='+', default=[2, 4])
+    args = ap.parse_args()
+
+    corpus = load_corpus(os.path.expanduser(args.corpus)) if args.corpus else synthetic_corpus(args.generate)
+    size = sum(len(m) for m in corpus)
+    print(f"{len(corpus)} messages, {size / 1e6:.1f} MB, {os.cpu_count()} CPUs")
+
+    # Same text and links from both paths
+    mismatched = 0
+    for raw in corpus[:200]:
+        _, _, text, links = legacy_parse(raw)
+        parsed = parse_message(raw)
+        if parsed['text'] != text.strip() or not {l['url'] for l in parsed['links']} <= set(links):
+            mismatched += 1
+    if mismatched:
+        print(f"warning: {mismatched} of the first 200 messages parse differently")
+
+    base = run('legacy (two trees)', corpus, legacy_parse)
+    run('parse_message in-process', corpus, parse_message)
+    for n in args.processes:
+        pool = ParserPool(n).start()
+        try:
+            elapsed = run(f'ParserPool({n}), {2 * n} threads', corpus, pool.parse, threads=2 * n)
+        finally:
+            pool.close()
+        print(f"{'':<28} {base / elapsed:.1f}x legacy")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+Push ingestion over LMTP/SMTP (smtp_ingest.IngestServer) on localhost.
+
+A scripted smtplib client first checks what the server refuses (unknown,
+inactive and foreign recipients before DATA, oversized messages), then
+several clients deliver mail to known aliases in parallel. Messages go
+through the bot's parse and store stages into a throwaway database; each
+delivery is timed from MAIL FROM to the reply after DATA, which the server
+sends only once the message is stored.
+
+    python benchmarks/bench_smtp_ingest.py --messages 2000 --clients 8
+    python benchmarks/bench_smtp_ingest.py --smtp --recipients 3
+"""
+import argparse
+import os
+import smtplib
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from database import ALLOWED_DOMAINS, EmailDatabase
+from fake_imap import generate_message
+from mail_parser import parse_message
+from pipeline import Pipeline, Stage
+from smtp_ingest import IngestServer
+
+DOMAIN = ALLOWED_DOMAINS[0]
+
+
+def build_pipeline(db, server, batch_size):
+    """parse -> store as in bot1.build_ingest_pipeline, settling the deliveries."""
+    def parse(record):
+        try:
+            return {**server.prepare(record), 'delivered': record['delivered']}
+        except Exception as e:
+            record['delivered'].set_exception(e)
+            raise
+
+    def store(batch):
+        try:
+            stored = db.add_emails(batch, raise_errors=True)
+        except Exception as e:
+            for m in batch:
+                m['delivered'].set_exception(e)
+            raise
+        for m in stored:
+            m['delivered'].set_result(m['uid'])
+        return None
+
+    return Pipeline([
+        Stage('parse', parse, workers=4, queue_size=200),
+        # The client is waiting: write what is queued instead of waiting for a full batch
+        Stage('store', store, queue_size=200, batch_size=batch_size, batch_timeout=2.0,
+              urgent=lambda m: True),
+    ])
+
+
+def send(client, lmtp, sender, recipients, raw):
+    """MAIL, RCPT, DATA -> {recipient: (code, reply)}; LMTP answers DATA once per accepted recipient."""
+    client.mail(sender)
+    replies, accepted = {}, []
+    for rcpt in recipients:
+        code, msg = client.rcpt(rcpt)
+        replies[rcpt] = (code, msg)
+        if code == 250:
+            accepted.append(rcpt)
+    if not accepted:
+        client.rset()
+        return replies
+    code, msg = client.data(raw)
+    replies[accepted[0]] = (code, msg)
+    for rcpt in accepted[1:]:
+        replies[rcpt] = client.getreply() if lmtp else (code, msg)
+    return replies
+
+
+def check_refusals(server, lmtp):
+    cls = smtplib.LMTP if lmtp else smtplib.SMTP
+    raw = generate_message(0, body_size=200)
+    cases = [
+        ('unknown alias', f'nobody@{DOMAIN}', 550),
+        ('inactive alias', f'off@{DOMAIN}', 550),
+        ('foreign domain', 'someone@example.com', 550),
+        ('known alias', f'user0@{DOMAIN}', 250),
+    ]
+    with cls('127.0.0.1', server.port) as client:
+        client.ehlo_or_helo_if_needed()
+        for name, rcpt, expected in cases:
+            code, msg = send(client, lmtp, 'sender@example.com', [rcpt], raw)[rcpt]
+            print(f"  {name:<16} RCPT/DATA {code} {msg.decode()}")
+            assert code == expected, (name, code)
+        code = client.mail('sender@example.com', [f'SIZE={server.max_size + 1}'])[0]
+        print(f"  {'oversized':<16} MAIL {code}")
+        assert code == 552, code
+        client.rset()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--messages', type=int, default=1000)
+    ap.add_argument('--clients', type=int, default=8, help='parallel client connections')
+    ap.add_argument('--recipients', type=int, default=1, help='aliases per message')
+    ap.add_argument('--size', type=int, default=4000, help='approximate message size in bytes')
+    ap.add_argument('--batch', type=int, default=200, help='messages per store transaction')
+    ap.add_argument('--smtp', action='store_true', help='SMTP instead of LMTP')
+    args = ap.parse_args()
+    lmtp = not args.smtp
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = EmailDatabase(os.path.join(tmp, 'emails.db'))
+        for i in range(args.recipients):
+            db.add_alias(1000 + i, f'user{i}@{DOMAIN}')
+        db.add_alias(999, f'off@{DOMAIN}')
+        db.toggle_alias_active(999, f'off@{DOMAIN}')
+
+        pipeline = None
+
+        def deliver(record):
+            delivered = Future()
+            pipeline.put({**record, 'delivered': delivered})
+            return delivered.result(60)
+
+        server = IngestServer(db, parse_message, deliver, host='127.0.0.1', port=0, lmtp=lmtp,
+                              hostname='bench.local', max_size=10 << 20)
+        pipeline = build_pipeline(db, server, args.batch)
+        server.start()
+
+        print(f"{'LMTP' if lmtp else 'SMTP'} refusals:")
+        check_refusals(server, lmtp)
+
+        raws = [generate_message(i, body_size=args.size) for i in range(args.messages)]
+        recipients = [f'user{i}@{DOMAIN}' for i in range(args.recipients)]
+        latencies, failures = [], []
+        lock = threading.Lock()
+
+        def client(part):
+            cls = smtplib.LMTP if lmtp else smtplib.SMTP
+            with cls('127.0.0.1', server.port) as c:
+                c.ehlo_or_helo_if_needed()
+                for raw in part:
+                    start = time.perf_counter()
+                    replies = send(c, lmtp, 'sender@example.com', recipients, raw)
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed)
+                        failures.extend(r for r, (code, _) in replies.items() if code != 250)
+
+        threads = [threading.Thread(target=client, args=(raws[i::args.clients],)) for i in range(args.clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        server.stop()
+        pipeline.close()
+        with db._reader() as conn:
+            stored = conn.execute('SELECT COUNT(*) FROM emails').fetchone()[0] - 1   # minus the refusal check's
+        db.close()
+
+    lat = sorted(latencies)
+    print(f"{args.messages} messages x {args.recipients} recipients over {args.clients} clients: "
+          f"{args.messages / elapsed:.0f} msg/s ({elapsed:.2f}s)")
+    print(f"  delivery latency avg {sum(lat) / len(lat) * 1000:.1f} ms, "
+          f"p95 {lat[int(len(lat) * 0.95)] * 1000:.1f} ms")
+    print(f"  stored {stored} of {args.messages * args.recipients}, refused {len(failures)}")
+    return 0 if stored == args.messages * args.recipients and not failures else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,575 @@
+"""
+In-process IMAP4rev1 stand-in for benchmarks and local runs of the ingestion
+code. Plain TCP on localhost, any login accepted, one shared mailbox as
+INBOX plus any further `folders` ({name: FakeMailbox}).
+
+Implements what the bot uses: CAPABILITY, LOGIN, SELECT/EXAMINE, NOOP, IDLE,
+LOGOUT, FETCH <seq> (UID), UID SEARCH (ALL, UID <set>, SINCE; with
+`esearch`, RETURN (ALL) answered by ESEARCH as in RFC 4731) and UID FETCH of
+UID, FLAGS, RFC822, RFC822.SIZE, BODYSTRUCTURE, BODY[] / BODY.PEEK[] with a
+section (numbers, HEADER, HEADER.FIELDS, TEXT) and <offset.count>. `latency` delays every
+command by that many seconds after it arrives, like a network round trip;
+pipelined commands overlap their delays the way they would on a real link.
+`bandwidth` (bytes/s per connection) paces what the server sends.
+`sessions` and `peak_sessions` count open connections.
+
+    server = FakeIMAPServer(mailbox, latency=0.02)
+    server.start()
+    conn = imap_idle.connect('127.0.0.1', 'u', 'p', port=server.port, use_ssl=False)
+"""
+import base64
+import email
+import math
+import queue
+import quopri
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+from email.charset import BASE64, QP, Charset
+from email.header import Header
+from email.utils import format_datetime
+
+BODY_ITEM_RE = re.compile(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?')
+
+
+class FakeMailbox:
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = {}      # uid -> (raw bytes, internal date)
+        self.next_uid = 1
+        self.changed = threading.Condition()
+        self._parsed = {}      # uid -> (email.message.Message, BODYSTRUCTURE), like a server's MIME index
+
+    def append(self, raw, date=None):
+        with self.changed:
+            uid = self.next_uid
+            self.messages[uid] = (raw, date or time.time())
+            self.next_uid += 1
+            self.changed.notify_all()
+        return uid
+
+    def uids(self):
+        with self.changed:
+            return sorted(self.messages)
+
+    def parsed(self, uid):
+        entry = self._parsed.get(uid)
+        if entry is None:
+            msg = email.message_from_bytes(self.messages[uid][0])
+            entry = self._parsed[uid] = (msg, bodystructure(msg).encode())
+        return entry
+
+
+def generate_message(i, to_addr='user@example.com', body_size=2000):
+    """A plain-text + HTML message of roughly body_size bytes."""
+    line = f"Message {i} line of text with a link https://example.com/confirm?id={i}\r\n"
+    text = line * max(1, body_size // 2 // len(line))
+    html = f"<html><body><p>{text}</p><a href='https://example.com/confirm?id={i}'>Confirm</a></body></html>"
+    return (
+        f"From: Sender {i % 17} <sender{i % 17}@example.org>\r\n"
+        f"To: {to_addr}\r\n"
+        f"Subject: Test message {i}\r\n"
+        f"Date: {format_datetime_now()}\r\n"
+        f"Message-ID: <{i}@fake.example>\r\n"
+        "MIME-Version: 1.0\r\n"
+        "Content-Type: multipart/alternative; boundary=\"b1\"\r\n"
+        "\r\n"
+        "--b1\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n\r\n"
+        f"{text}\r\n"
+        "--b1\r\n"
+        "Content-Type: text/html; charset=utf-8\r\n\r\n"
+        f"{html}\r\n"
+        "--b1--\r\n"
+    ).encode()
+
+
+def generate_with_attachment(i, to_addr='user@example.com', body_size=2000, attachment_size=1 << 20):
+    """generate_message() plus a base64 PDF of attachment_size bytes."""
+    import base64
+    inner = generate_message(i, to_addr, body_size)
+    head, _, body = inner.partition(b'\r\n\r\n')
+    blob = base64.encodebytes((bytes(range(256)) * (attachment_size // 256 + 1))[:attachment_size])
+    head = head.replace(b'multipart/alternative; boundary="b1"', b'multipart/mixed; boundary="m1"')
+    return head + (
+        b'\r\n\r\n--m1\r\nContent-Type: multipart/alternative; boundary="b1"\r\n\r\n' + body +
+        b'--m1\r\nContent-Type: application/pdf; name="report-%d.pdf"\r\n'
+        b'Content-Disposition: attachment; filename="report-%d.pdf"\r\n'
+        b'Content-Transfer-Encoding: base64\r\n\r\n' % (i, i) + blob.replace(b'\n', b'\r\n') + b'\r\n--m1--\r\n'
+    )
+
+
+
+# Share of each MIME shape in a generated mailbox
+SHAPES = {'plain': 0.25, 'alternative': 0.4, 'html': 0.15, 'attachment': 0.15, 'forward': 0.05}
+_WORDS = {
+    False: ('your order invoice delivery account payment receipt update team please review '
+            'the attached report meeting schedule password reset security notice subscription').split(),
+    True: ('ваш заказ счёт доставка аккаунт оплата чек обновление команда пожалуйста проверьте '
+           'отчёт встреча расписание пароль сброс уведомление безопасности подписка письмо').split(),
+}
+_NAMES = {False: ('Billing', 'Support Team', 'Alice Smith', 'Notifications', 'HR'),
+          True: ('Служба поддержки', 'Бухгалтерия', 'Иван Петров', 'Уведомления', 'Отдел кадров')}
+
+
+class MailboxGenerator:
+    """
+    Reproducible mail for a FakeMailbox. Sizes are log-normal around
+    `median_size` (capped at max_size), MIME shapes follow the `shapes`
+    weights (see SHAPES), `cyrillic` of the messages have Russian headers
+    (RFC 2047, B and Q) and bodies (base64, quoted-printable or 8bit), and
+    recipients spread over `aliases` with Zipf weights: a few busy addresses
+    and a long tail. `unknown` of the messages go to addresses with no alias.
+
+        gen = MailboxGenerator(['a@dreampartners.online', 'b@dreampartners.online'], seed=1)
+        gen.fill(mailbox, 5000)
+    """
+
+    def __init__(self, aliases, seed=0, median_size=4000, size_sigma=1.0, max_size=10 << 20,
+                 shapes=None, cyrillic=0.3, unknown=0.05):
+        self.aliases = list(aliases)
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.median_size = median_size
+        self.size_sigma = size_sigma
+        self.max_size = max_size
+        self.shapes = shapes or SHAPES
+        self.cyrillic = cyrillic
+        self.unknown = unknown
+        self.domain = self.aliases[0].split('@')[1] if self.aliases else 'example.com'
+        self._weights = [1 / (rank + 1) for rank in range(len(self.aliases))]
+        self.count = 0
+
+    def fill(self, mailbox, count):
+        """Appends `count` messages; returns their uids."""
+        return [mailbox.append(self.message()) for _ in range(count)]
+
+    def message(self):
+        rng = self.rng
+        i = self.count
+        self.count += 1
+        if not self.aliases or rng.random() < self.unknown:
+            to_addr = f'nobody{rng.randrange(100)}@{self.domain}'
+        else:
+            to_addr = rng.choices(self.aliases, self._weights)[0]
+        size = min(self.max_size, max(300, int(rng.lognormvariate(math.log(self.median_size), self.size_sigma))))
+        shape = rng.choices(list(self.shapes), list(self.shapes.values()))[0]
+        cyr = rng.random() < self.cyrillic
+
+        sender = rng.randrange(50)
+        head = (
+            f"From: {self._header(rng.choice(_NAMES[cyr]), cyr)} <sender{sender}@example.org>\r\n"
+            f"To: {to_addr}\r\n"
+            f"Subject: {self._header(self._words(cyr, rng.randint(3, 8)).capitalize() + f' #{i}', cyr)}\r\n"
+            f"Date: {format_datetime_now()}\r\n"
+            f"Message-ID: <gen-{self.seed}-{i}@fake.example>\r\n"
+            "MIME-Version: 1.0\r\n"
+        ).encode()
+        return head + self._shape(shape, i, size, cyr)
+
+    def _shape(self, shape, i, size, cyr):
+        if shape == 'plain':
+            return self._leaf('text/plain', self._text(i, size, cyr), cyr)
+        if shape == 'html':
+            return self._leaf('text/html', self._html(i, size, cyr), cyr)
+        if shape == 'alternative':
+            return self._multipart('alternative', [
+                self._leaf('text/plain', self._text(i, size // 3, cyr), cyr),
+                self._leaf('text/html', self._html(i, size * 2 // 3, cyr), cyr),
+            ])
+        if shape == 'attachment':
+            body = self._multipart('alternative', [
+                self._leaf('text/plain', self._text(i, 600, cyr), cyr),
+                self._leaf('text/html', self._html(i, 1200, cyr), cyr),
+            ])
+            name = f'{"отчёт" if cyr else "report"}-{i}.pdf'
+            blob = (bytes(range(256)) * (size // 256 + 1))[:max(size - 2000, 256)]
+            disposition = (f"attachment; filename*=utf-8''{urllib.parse.quote(name)}" if cyr
+                           else f'attachment; filename="{name}"')
+            attachment = (f'Content-Type: application/pdf\r\nContent-Disposition: {disposition}\r\n'
+                          'Content-Transfer-Encoding: base64\r\n\r\n').encode() + _base64(blob)
+            return self._multipart('mixed', [body, attachment])
+        # forward: a short note with the original message attached
+        inner_cyr = not cyr if self.rng.random() < 0.3 else cyr
+        inner = (
+            f"From: {self._header(self.rng.choice(_NAMES[inner_cyr]), inner_cyr)} <orig@example.net>\r\n"
+            f"Subject: {self._header(self._words(inner_cyr, 4).capitalize(), inner_cyr)}\r\n"
+            "MIME-Version: 1.0\r\n"
+        ).encode() + self._shape('alternative', i, max(size - 500, 300), inner_cyr)
+        return self._multipart('mixed', [
+            self._leaf('text/plain', self._text(i, 300, cyr), cyr),
+            b'Content-Type: message/rfc822\r\n\r\n' + inner,
+        ])
+
+    def _multipart(self, subtype, parts):
+        boundary = f'=_{subtype}_{self.rng.getrandbits(48):012x}'.encode()
+        out = b'Content-Type: multipart/%s; boundary="%s"\r\n\r\n' % (subtype.encode(), boundary)
+        for part in parts:
+            out += b'--' + boundary + b'\r\n' + part + b'\r\n'
+        return out + b'--' + boundary + b'--\r\n'
+
+    def _leaf(self, content_type, text, cyr):
+        data = text.encode()
+        encoding = self.rng.choice(('base64', 'quoted-printable', '8bit')) if cyr else '7bit'
+        if encoding == 'base64':
+            body = _base64(data)
+        elif encoding == 'quoted-printable':
+            body = quopri.encodestring(data).replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+        else:
+            body = data
+        return (f'Content-Type: {content_type}; charset=utf-8\r\n'
+                f'Content-Transfer-Encoding: {encoding}\r\n\r\n').encode() + body
+
+    def _header(self, text, cyr):
+        if not cyr:
+            return text
+        charset = Charset('utf-8')
+        # Mail clients use both encodings
+        charset.header_encoding = self.rng.choice((BASE64, QP))
+        return Header(text, charset).encode()
+
+    def _words(self, cyr, n):
+        return ' '.join(self.rng.choice(_WORDS[cyr]) for _ in range(n))
+
+    def _text(self, i, size, cyr):
+        lines = [f'{"Подтвердите" if cyr else "Confirm"}: https://example.com/confirm?id={i}',
+                 f'{"Код" if cyr else "Code"}: {self.rng.randrange(100000, 999999)}']
+        length = 0
+        while length < size:
+            line = self._words(cyr, 10)
+            lines.append(line)
+            length += len(line.encode()) + 2
+        return '\r\n'.join(lines) + '\r\n'
+
+    def _html(self, i, size, cyr):
+        label = 'Подтвердить' if cyr else 'Confirm'
+        paragraphs = self._text(i, size, cyr).replace('\r\n', '</p>\r\n<p>')
+        return (f'<html><body><p>{paragraphs}</p>\r\n'
+                f'<a href="https://example.com/confirm?id={i}">{label}</a></body></html>\r\n')
+
+
+def _base64(data):
+    return base64.encodebytes(data).replace(b'\n', b'\r\n')
+
+
+def _q(value):
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _params(pairs):
+    pairs = [(k, v) for k, v in pairs if v is not None]
+    return '(' + ' '.join(f'{_q(k.upper())} {_q(v)}' for k, v in pairs) + ')' if pairs else 'NIL'
+
+
+def _body_bytes(part):
+    payload = part.get_payload()
+    if not isinstance(payload, str):
+        return b''
+    try:
+        return payload.encode('ascii', 'surrogateescape')
+    except UnicodeEncodeError:
+        # 8bit text comes back decoded with its charset
+        return payload.encode(part.get_content_charset() or 'utf-8', 'surrogateescape')
+
+
+def bodystructure(msg):
+    """RFC 3501 BODYSTRUCTURE of an email.message.Message, with extension data."""
+    disposition = msg.get_content_disposition()
+    disp = 'NIL'
+    if disposition:
+        disp = f'({_q(disposition.upper())} {_params([("filename", msg.get_filename())])})'
+    maintype, subtype = msg.get_content_maintype(), msg.get_content_subtype()
+    if maintype == 'multipart':
+        children = ''.join(bodystructure(p) for p in msg.get_payload())
+        return f'({children} {_q(subtype.upper())} {_params([("boundary", msg.get_boundary())])} {disp} NIL NIL)'
+    params = _params([(k, v) for k, v in msg.get_params()[1:]] if msg.get_params() else [])
+    encoding = _q((msg.get('Content-Transfer-Encoding') or '7bit').upper())
+    fields = f'{_q(maintype.upper())} {_q(subtype.upper())} {params} NIL NIL {encoding}'
+    if msg.get_content_type() == 'message/rfc822':
+        inner = msg.get_payload(0)
+        size = len(inner.as_bytes())
+        return f'({fields} {size} NIL {bodystructure(inner)} 0 NIL {disp} NIL NIL)'
+    body = _body_bytes(msg)
+    if maintype == 'text':
+        lines = body.count(b'\n')
+        return f'({fields} {len(body)} {lines} NIL {disp} NIL NIL)'
+    return f'({fields} {len(body)} NIL {disp} NIL NIL)'
+
+
+def section_bytes(raw, section, msg=None):
+    """BODY[section] of a raw message: '' (all), HEADER, HEADER.FIELDS (...), TEXT or a part number."""
+    if not section:
+        return raw
+    head, _, text = raw.partition(b'\r\n\r\n')
+    upper = section.upper()
+    if upper == 'HEADER':
+        return head + b'\r\n\r\n'
+    if upper == 'TEXT':
+        return text
+    if upper.startswith('HEADER.FIELDS'):
+        names = {n.lower() for n in section[section.index('(') + 1:section.rindex(')')].split()}
+        msg = msg or email.message_from_bytes(head + b'\r\n\r\n')
+        lines = [f'{k}: {v}\r\n' for k, v in msg.items() if k.lower() in names]
+        return ''.join(lines).encode('utf-8', 'surrogateescape') + b'\r\n'
+    part = msg or email.message_from_bytes(raw)
+    for n in section.split('.'):
+        if part.get_content_type() == 'message/rfc822':
+            part = part.get_payload(0)
+        if part.is_multipart():
+            part = part.get_payload()[int(n) - 1]
+        elif n != '1':
+            return b''
+    return _body_bytes(part)
+
+
+def format_datetime_now():
+    from datetime import datetime, timezone
+    return format_datetime(datetime.now(timezone.utc))
+
+
+def uid_set_members(spec, uids):
+    """Expands an IMAP sequence set ("1:5,9,12:*") against the existing uids."""
+    top = uids[-1] if uids else 0
+    wanted = set()
+    for part in spec.split(','):
+        if ':' in part:
+            a, b = part.split(':')
+            a = top if a == '*' else int(a)
+            b = top if b == '*' else int(b)
+            lo, hi = min(a, b), max(a, b)
+            wanted.update(u for u in uids if lo <= u <= hi)
+        else:
+            n = top if part == '*' else int(part)
+            if n in uids:
+                wanted.add(n)
+    return sorted(wanted)
+
+
+def sequence_set(uids):
+    """Sorted uids -> "1:3,7,9:10"."""
+    parts = []
+    start = prev = None
+    for uid in uids + [None]:
+        if prev is not None and uid == prev + 1:
+            prev = uid
+            continue
+        if start is not None:
+            parts.append(str(start) if start == prev else f'{start}:{prev}')
+        start = prev = uid
+    return ','.join(parts)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.sock = self.request
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lines = queue.Queue()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def _read_loop(self):
+        buf = b''
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    self.lines.put((time.monotonic(), line.rstrip(b'\r')))
+        except OSError:
+            pass
+        self.lines.put((time.monotonic(), None))
+
+    def _next(self):
+        arrived, line = self.lines.get()
+        # Simulated round trip: act on the command `latency` after it arrived
+        delay = arrived + self.server.latency - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return line
+
+    def w(self, data):
+        data = data if isinstance(data, bytes) else data.encode()
+        self.sock.sendall(data)
+        if self.server.bandwidth:
+            time.sleep(len(data) / self.server.bandwidth)
+
+    def handle(self):
+        with self.server.lock:
+            self.server.sessions += 1
+            self.server.peak_sessions = max(self.server.peak_sessions, self.server.sessions)
+        try:
+            self._session()
+        finally:
+            with self.server.lock:
+                self.server.sessions -= 1
+
+    def _session(self):
+        self.box = self.server.mailbox
+        caps = 'IMAP4rev1 IDLE UIDPLUS' if self.server.idle else 'IMAP4rev1 UIDPLUS'
+        if self.server.esearch:
+            caps += ' ESEARCH'
+        self.w(f'* OK [CAPABILITY {caps}] fake IMAP ready\r\n')
+        self.seen = 0
+        while True:
+            line = self._next()
+            if line is None:
+                return
+            try:
+                tag, cmd, *rest = line.decode().split(' ', 2)
+            except ValueError:
+                self.w(b'* BAD bad command\r\n')
+                continue
+            args = rest[0] if rest else ''
+            cmd = cmd.upper()
+            if cmd == 'CAPABILITY':
+                self.w(f'* CAPABILITY {caps}\r\n{tag} OK done\r\n')
+            elif cmd in ('LOGIN', 'AUTHENTICATE'):
+                self.w(f'{tag} OK logged in\r\n')
+            elif cmd in ('SELECT', 'EXAMINE'):
+                box = self.server.folders.get(args.strip('"'))
+                if box is None:
+                    self.w(f'{tag} NO no such mailbox\r\n')
+                    continue
+                self.box = box
+                uids = box.uids()
+                self.seen = len(uids)
+                self.w(f'* {len(uids)} EXISTS\r\n* 0 RECENT\r\n'
+                       f'* OK [UIDVALIDITY {box.uidvalidity}] UIDs valid\r\n'
+                       f'* OK [UIDNEXT {box.next_uid}] next\r\n'
+                       f'{tag} OK [READ-WRITE] selected\r\n')
+            elif cmd == 'NOOP':
+                self._report_exists()
+                self.w(f'{tag} OK done\r\n')
+            elif cmd == 'IDLE':
+                self._idle(tag)
+            elif cmd == 'LOGOUT':
+                self.w(f'* BYE logging out\r\n{tag} OK done\r\n')
+                return
+            elif cmd == 'FETCH':
+                self._fetch(tag, args, by_uid=False)
+            elif cmd == 'UID':
+                sub, _, sub_args = args.partition(' ')
+                if sub.upper() == 'SEARCH':
+                    self._search(tag, sub_args)
+                elif sub.upper() == 'FETCH':
+                    self._fetch(tag, sub_args, by_uid=True)
+                else:
+                    self.w(f'{tag} BAD unsupported\r\n')
+            else:
+                self.w(f'{tag} BAD unsupported\r\n')
+
+    def _report_exists(self):
+        count = len(self.box.uids())
+        if count != self.seen:
+            self.seen = count
+            self.w(f'* {count} EXISTS\r\n')
+
+    def _idle(self, tag):
+        box = self.box
+        self.w('+ idling\r\n')
+        while True:
+            with box.changed:
+                if len(box.messages) == self.seen:
+                    box.changed.wait(0.05)
+            self._report_exists()
+            try:
+                arrived, line = self.lines.get_nowait()
+            except queue.Empty:
+                continue
+            if line is None:
+                return
+            if line.strip().upper() == b'DONE':
+                self.w(f'{tag} OK IDLE terminated\r\n')
+                return
+
+    def _search(self, tag, args):
+        box = self.box
+        uids = box.uids()
+        extended = self.server.esearch and args.upper().startswith('RETURN (ALL) ')
+        if extended:
+            args = args[len('RETURN (ALL) '):]
+        if args.upper().startswith('UID '):
+            found = uid_set_members(args.split()[1], uids)
+        elif args.upper().startswith('SINCE'):
+            day = time.mktime(time.strptime(args.split()[1], '%d-%b-%Y'))
+            found = [u for u in uids if box.messages[u][1] >= day]
+        else:
+            found = uids
+        if extended:
+            matches = f' ALL {sequence_set(found)}' if found else ''
+            self.w(f'* ESEARCH (TAG "{tag}") UID{matches}\r\n{tag} OK search done\r\n')
+        else:
+            self.w('* SEARCH' + ''.join(f' {u}' for u in found) + f'\r\n{tag} OK search done\r\n')
+
+    def _fetch(self, tag, args, by_uid):
+        box = self.box
+        spec, _, items = args.partition(' ')
+        items = items.strip('()').upper()
+        uids = box.uids()
+        if by_uid:
+            wanted = uid_set_members(spec, uids)
+        else:
+            seqs = uid_set_members(spec, list(range(1, len(uids) + 1)))
+            wanted = [uids[s - 1] for s in seqs]
+        out = []
+        for uid in wanted:
+            seq = uids.index(uid) + 1
+            raw, _ = box.messages[uid]
+            parts = [f'UID {uid}'.encode()]
+            if 'FLAGS' in items:
+                parts.append(b'FLAGS ()')
+            if 'RFC822.SIZE' in items:
+                parts.append(f'RFC822.SIZE {len(raw)}'.encode())
+            if re.search(r'RFC822(?![.A-Z])', items):
+                parts.append(b'RFC822 {%d}\r\n' % len(raw) + raw)
+            if 'BODYSTRUCTURE' in items:
+                parts.append(b'BODYSTRUCTURE ' + box.parsed(uid)[1])
+            for m in BODY_ITEM_RE.finditer(items):
+                data = section_bytes(raw, m.group(1), box.parsed(uid)[0])
+                name = f'BODY[{m.group(1)}]'
+                if m.group(2) is not None:
+                    start = int(m.group(2))
+                    data = data[start:start + int(m.group(3))]
+                    name += f'<{start}>'
+                parts.append(name.encode() + b' {%d}\r\n' % len(data) + data)
+            out.append(b'* %d FETCH (' % seq + b' '.join(parts) + b')\r\n')
+        out.append(f'{tag} OK fetch done\r\n'.encode())
+        self.w(b''.join(out))
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, mailbox=None, latency=0.0, idle=True, host='127.0.0.1', port=0, bandwidth=None,
+                 folders=None, esearch=True):
+        self.mailbox = mailbox or FakeMailbox()
+        self.folders = {'INBOX': self.mailbox, **(folders or {})}
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.peak_sessions = 0
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.idle = idle
+        self.esearch = esearch
+        super().__init__((host, port), _Handler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,21 +1,29 @@
 import os
 import telebot
 from telebot import types
-import imaplib
-import email
-from email.header import decode_header
+from telebot.apihelper import ApiTelegramException
+from imap_scheduler import find_source, load_accounts, source_name
+from imap_sync import fetch_attachment
+from ingest import MailIngest
+from outbox import PermanentError, RetryAfter
 import threading
+import signal
 import time
 import re
 import io
 import html
-from bs4 import BeautifulSoup
-from database import EmailDatabase, ADMIN_ID, ALLOWED_DOMAINS
+from mail_parser import ParserPool, extract_links, smart_format_text
+from database import EmailDatabase, ADMIN_ID, ALLOWED_DOMAINS, is_reserved_address
 
 # --- КОНФИГУРАЦИЯ ---
 EMAIL_USER = os.environ.get('EMAIL_USER', 'your_email@yandex.ru')
 EMAIL_PASS = os.environ.get('EMAIL_PASS', 'YOUR_EMAIL_APP_PASSWORD_HERE')
 IMAP_SERVER = 'imap.yandex.ru'
+# Ящики и папки, из которых принимается почта: MAIL_ACCOUNTS (JSON),
+# по умолчанию EMAIL_USER и папки из IMAP_FOLDERS
+MAIL_ACCOUNTS = load_accounts(EMAIL_USER, EMAIL_PASS, IMAP_SERVER)
+# Сколько ждать свободного IMAP-соединения для скачивания вложения (секунды)
+ATTACHMENT_CONNECT_TIMEOUT = 30
 
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN', 'YOUR_BOT_TOKEN_HERE')
 
@@ -30,6 +38,10 @@ email_db = EmailDatabase()
 def register_new_alias(user_id, email, force=False):
     email = email.lower().strip()
     
+    # Служебные адреса только у админа
+    if is_reserved_address(email) and user_id != ADMIN_ID and not force:
+        return False, "зарезервировано"
+
     # Check if taken
     existing_owner = email_db.get_owner(email)
     if existing_owner and existing_owner != user_id and not force:
@@ -55,218 +67,67 @@ def delete_user_alias(user_id, email):
         return True, "удалено"
     return False, "не найдено или ошибка"
 
-# --- КЛАСС РАБОТЫ С ПОЧТОЙ ---
-class MailManager:
-    def __init__(self):
-        self.mail = None
-
-    def connect(self):
-        try:
-            self.mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-            self.mail.login(EMAIL_USER, EMAIL_PASS)
-            return True
-        except Exception as e:
-            print(f"IMAP Error: {e}")
-            return False
-
-    def get_last_uid(self):
-        try:
-            if not self.mail: self.connect()
-            self.mail.select("INBOX")
-            status, messages = self.mail.uid('search', None, "ALL")
-            if status == "OK":
-                uids = messages[0].split()
-                if uids: return int(uids[-1])
-            return 0
-        except:
-            return 0
-
-    def get_emails_for_alias(self, alias, limit=20, offset=0):
-        try:
-            if not self.mail: self.connect()
-            self.mail.select("INBOX")
-            # Search by TO header
-            # Note: This might be slow if mailbox is huge.
-            # Using CHARSET UTF-8 for search if needed, but email addresses are ASCII usually.
-            status, messages = self.mail.uid('search', None, f'(TO "{alias}")')
-            
-            if status == "OK":
-                uids = messages[0].split()
-                # Sort descending (newest first)
-                uids.sort(key=int, reverse=True)
-                
-                # Pagination
-                start = offset
-                end = offset + limit
-                page_uids = uids[start:end]
-                
-                result = []
-                for uid in page_uids:
-                    try:
-                        res, msg_data = self.mail.uid('fetch', str(int(uid)), '(RFC822.HEADER)')
-                        header_data = msg_data[0][1]
-                        msg = email.message_from_bytes(header_data)
-                        
-                        subject = self.decode_str(msg["Subject"])
-                        from_ = self.decode_str(msg["From"])
-                        
-                        result.append({
-                            "uid": int(uid),
-                            "subject": subject if subject else "(без темы)",
-                            "from": from_ if from_ else "(неизвестно)"
-                        })
-                    except: pass
-                
-                return result, len(uids)
-            return [], 0
-        except Exception as e:
-            print(f"Search Error: {e}")
-            return [], 0
+# --- ВЛОЖЕНИЯ ---
+# Вложения остаются на IMAP-сервере, в БД только их описание; файл
+# скачивается по кнопке
+
+def format_size(size):
+    if size >= 1 << 20:
+        return f"{size / (1 << 20):.1f} МБ"
+    return f"{max(1, size >> 10)} КБ"
+
+def truncated_note(message):
+    """Строка для подписи, если текст письма сохранён не целиком"""
+    if not message.get('truncated'):
+        return ""
+    size = f" из {format_size(message['raw_size'])}" if message.get('raw_size') else ""
+    return f"✂️ <i>письмо большое, сохранено начало{size}</i>\n"
+
+def attachment_buttons(kb, uid, attachments):
+    for a in attachments:
+        # Размер из BODYSTRUCTURE — в base64, файл примерно на четверть меньше
+        size = a['size'] * 3 // 4 if a['encoding'] == 'base64' else a['size']
+        name = a['filename'] or a['content_type']
+        kb.add(types.InlineKeyboardButton(f"📎 {name} ({format_size(size)})", callback_data=f"att_{uid}_{a['section']}"))
+
+def send_attachment(call, user_id, uid, section):
+    meta = email_db.get_email_meta(uid)
+    attachment = email_db.get_attachment(uid, section)
+    if not meta or not attachment:
+        bot.answer_callback_query(call.id, "Вложение не найдено")
+        return
+    # Только владелец ящика или админ
+    if email_db.get_owner(meta['to_email']) != user_id and user_id != ADMIN_ID:
+        bot.answer_callback_query(call.id, "⛔️ Нет доступа", show_alert=True)
+        return
 
-    def get_email_content(self, uid):
-        try:
-            if not self.mail: self.connect()
-            self.mail.select("INBOX")
-            res, msg_data = self.mail.uid('fetch', str(uid), '(RFC822)')
-            if res == 'OK':
-                return self.parse_email(msg_data[0][1])
-            return None
-        except:
-            return None
-
-    def decode_str(self, s):
-        if s is None: return ""
-        decoded_list = decode_header(s)
-        header_value = ""
-        for decoded, charset in decoded_list:
-            if isinstance(decoded, bytes):
-                try:
-                    header_value += decoded.decode(charset or 'utf-8')
-                except:
-                    header_value += decoded.decode('utf-8', errors='ignore')
-            else:
-                header_value += str(decoded)
-        return header_value
-
-    def extract_email_address(self, raw_str):
-        """Извлекает чистый email из строки вида 'Name <email@domain.com>'"""
-        match = re.search(r'<([^>]+)>', raw_str)
-        if match:
-            return match.group(1).lower().strip()
-        # Если скобок нет, возможно это просто email
-        if '@' in raw_str:
-            return raw_str.lower().strip()
-        return None
-
-    def parse_email(self, raw_email):
-        msg = email.message_from_bytes(raw_email)
-        
-        subject = self.decode_str(msg["Subject"])
-        from_ = self.decode_str(msg["From"])
-        to_raw = self.decode_str(msg["To"])
-        to_email = self.extract_email_address(to_raw)
-        
-        # Также проверяем X-Original-To или Delivered-To для точности пересылки
-        if not to_email:
-             delivered_to = msg.get("Delivered-To") or msg.get("X-Original-To")
-             if delivered_to:
-                 to_email = self.extract_email_address(str(delivered_to))
-
-        body_text = ""
-        body_html = None
-        
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                disposition = str(part.get("Content-Disposition"))
-                try:
-                    payload = part.get_payload(decode=True)
-                    if payload:
-                        if content_type == "text/plain" and "attachment" not in disposition:
-                            body_text += payload.decode('utf-8', errors='ignore')
-                        elif content_type == "text/html" and "attachment" not in disposition:
-                            body_html = payload
-                except: pass
-        else:
-            payload = msg.get_payload(decode=True)
-            if msg.get_content_type() == "text/html":
-                body_html = payload
-            else:
-                body_text = payload.decode('utf-8', errors='ignore')
+    found = find_source(MAIL_ACCOUNTS, attachment['source'] or '')
+    if not found:
+        bot.answer_callback_query(call.id, "Ящик этого письма больше не подключён", show_alert=True)
+        return
+    account, folder = found
 
-        if not body_text and body_html:
-            try:
-                soup = BeautifulSoup(body_html, "html.parser")
-                body_text = soup.get_text(separator="\n").strip()
+    bot.answer_callback_query(call.id, "⏳ Загружаю вложение...")
+    conn = None
+    try:
+        # Соединение из общего лимита аккаунта
+        conn = account.connect(timeout=ATTACHMENT_CONNECT_TIMEOUT)
+        data = fetch_attachment(conn, attachment, folder)
+    except Exception as e:
+        print(f"Attachment Error {uid}/{section}: {e}")
+        bot.send_message(user_id, "❌ Не удалось загрузить вложение, попробуйте позже")
+        return
+    finally:
+        if conn:
+            try: conn.logout()
             except: pass
 
-        return {
-            "subject": subject,
-            "from": from_,
-            "to_raw": to_raw,
-            "to_email": to_email,
-            "text": body_text.strip(),
-            "html": body_html
-        }
-
-# --- UI & LOGIC ---
-
-def extract_links(html_bytes, text_body):
-    """Ищет ссылки активации/подтверждения"""
-    links = []
-    seen = set()
-    
-    # Ключевые слова для кнопок
-    keywords = ['confirm', 'verify', 'activate', 'login', 'sign in', 'подтвердить', 'активировать', 'войти']
-    
-    # 1. Парсим HTML если есть
-    if html_bytes:
-        try:
-            soup = BeautifulSoup(html_bytes, "html.parser")
-            for a in soup.find_all('a', href=True):
-                href = a['href']
-                text = a.get_text().strip().lower()
-                
-                # Если текст ссылки содержит ключевое слово
-                score = 0
-                if any(k in text for k in keywords):
-                    score = 2
-                elif any(k in href.lower() for k in keywords):
-                    score = 1
-                
-                if score > 0 and href not in seen:
-                    label = text if len(text) < 30 and text else "🔗 action"
-                    if "http" in href:
-                        links.append({"url": href, "label": label, "score": score})
-                        seen.add(href)
-        except: pass
-
-    # 2. Если HTML не дал результатов, ищем в тексте регуляркой
-    if not links:
-        urls = re.findall(r'(https?://[^\s<>"]+)', text_body)
-        for url in urls:
-            if url not in seen:
-                 # Простая эвристика
-                 score = 0
-                 if any(k in url.lower() for k in keywords):
-                     score = 1
-                 if score > 0:
-                     links.append({"url": url, "label": "🔗 link", "score": score})
-                     seen.add(url)
-
-    # Сортируем по важности и берем топ 3
-    links.sort(key=lambda x: x['score'], reverse=True)
-    return links[:3]
-
-def smart_format_text(text):
-    # Escape HTML first
-    text = html.escape(text)
-    # Коды (wrap digits in code)
-    text = re.sub(r'(?<!\d)(\d{4,8})(?!\d)', r'<code>\1</code>', text)
-    # Обрезка
-    if len(text) > 3000:
-        text = text[:3000] + "...\n(полный текст в файле)"
-    return text
+    if data is None:
+        bot.send_message(user_id, "❌ Вложения больше нет на почтовом сервере")
+        return
+    file_obj = io.BytesIO(data)
+    file_obj.name = attachment['filename'] or f"attachment-{section}"
+    bot.send_document(user_id, file_obj)
 
 # --- КЛАВИАТУРЫ ---
 
@@ -302,7 +163,7 @@ def kb_email_control(user_id, email):
     markup.row(types.InlineKeyboardButton("🔙 назад", callback_data="my_emails"))
     return markup
 
-def kb_email_list(email, page, total, emails):
+def kb_email_list(email, emails, has_newer, has_older):
     markup = types.InlineKeyboardMarkup()
     
     for em in emails:
@@ -311,14 +172,13 @@ def kb_email_list(email, page, total, emails):
         btn_text = f"{em['from'].split('<')[0].strip()}: {subject}"
         markup.row(types.InlineKeyboardButton(btn_text, callback_data=f"read_{email}_{em['uid']}"))
     
-    # Pagination
+    # Pagination by cursor: a<uid> = newer than uid, b<uid> = older than uid
     nav_row = []
-    if page > 0:
-        nav_row.append(types.InlineKeyboardButton("⬅️", callback_data=f"list_emails_{email}_{page-1}"))
+    if has_newer and emails:
+        nav_row.append(types.InlineKeyboardButton("⬅️", callback_data=f"list_emails_{email}_a{emails[0]['uid']}"))
     
-    # Simple check if there are more pages (assuming limit 10)
-    if (page + 1) * 10 < total:
-        nav_row.append(types.InlineKeyboardButton("➡️", callback_data=f"list_emails_{email}_{page+1}"))
+    if has_older and emails:
+        nav_row.append(types.InlineKeyboardButton("➡️", callback_data=f"list_emails_{email}_b{emails[-1]['uid']}"))
         
     if nav_row:
         markup.row(*nav_row)
@@ -326,6 +186,17 @@ def kb_email_list(email, page, total, emails):
     markup.row(types.InlineKeyboardButton("🔙 назад", callback_data=f"view_email_{email}"))
     return markup
 
+def load_email_list_page(email, cursor):
+    """Страница писем по курсору из callback_data: '0', 'a<uid>' или 'b<uid>'"""
+    if cursor.startswith('a'):
+        emails, has_more, _ = email_db.get_emails_for_alias(email, limit=10, after_uid=int(cursor[1:]))
+        return emails, has_more, True
+    if cursor.startswith('b'):
+        emails, has_more, _ = email_db.get_emails_for_alias(email, limit=10, before_uid=int(cursor[1:]))
+        return emails, True, has_more
+    emails, has_more, _ = email_db.get_emails_for_alias(email, limit=10)
+    return emails, False, has_more
+
 def kb_read_email(email, uid):
     markup = types.InlineKeyboardMarkup()
     markup.row(types.InlineKeyboardButton("🔙 к списку", callback_data=f"back_list_{email}")) 
@@ -427,18 +298,18 @@ def callback_query(call):
 
     elif call.data.startswith("list_emails_"):
         parts = call.data.split("_")
-        page = int(parts[-1])
+        cursor = parts[-1]
         email = "_".join(parts[2:-1])
         
         # Чтение из БД
-        emails, total = email_db.get_emails_for_alias(email, limit=10, offset=page*10)
+        emails, has_newer, has_older = load_email_list_page(email, cursor)
         
-        if not emails and page == 0:
+        if not emails and cursor == "0":
             bot.answer_callback_query(call.id, "Писем нет 🤷‍♂️")
             return
 
-        text_msg = f"📨 Письма для <code>{email}</code> (стр. {page+1}):"
-        markup = kb_email_list(email, page, total, emails)
+        text_msg = f"📨 Письма для <code>{email}</code>:"
+        markup = kb_email_list(email, emails, has_newer, has_older)
         
         if call.message.content_type == 'text':
             bot.edit_message_text(text_msg, user_id, call.message.message_id, parse_mode="HTML", reply_markup=markup)
@@ -461,6 +332,7 @@ def callback_query(call):
                 f"📨 <b>Просмотр письма</b>\n"
                 f"👤 <b>От:</b> {html.escape(content['from'])}\n"
                 f"📌 <b>Тема:</b> {html.escape(content['subject'])}\n"
+                f"{truncated_note(content)}"
                 f"──────────────────\n"
                 f"{text_preview}"
             )
@@ -469,6 +341,7 @@ def callback_query(call):
             kb = types.InlineKeyboardMarkup()
             for link in action_links:
                 kb.add(types.InlineKeyboardButton(link['label'], url=link['url']))
+            attachment_buttons(kb, content['uid'], email_db.get_attachments(content['uid']))
             kb.row(types.InlineKeyboardButton("🔙 назад", callback_data=f"list_emails_{email}_0"))
             
             try: bot.delete_message(user_id, call.message.message_id)
@@ -483,13 +356,17 @@ def callback_query(call):
         else:
             bot.answer_callback_query(call.id, "Не удалось загрузить письмо")
 
+    elif call.data.startswith("att_"):
+        _, uid, section = call.data.split("_", 2)
+        send_attachment(call, user_id, int(uid), section)
+
     elif call.data.startswith("back_list_"):
         email = call.data.split("back_list_")[1]
         
         # Чтение из БД
-        emails, total = email_db.get_emails_for_alias(email, limit=10, offset=0)
+        emails, has_newer, has_older = load_email_list_page(email, "0")
         
-        bot.edit_message_text(f"📨 Письма для <code>{email}</code>:", user_id, call.message.message_id, parse_mode="HTML", reply_markup=kb_email_list(email, 0, total, emails))
+        bot.edit_message_text(f"📨 Письма для <code>{email}</code>:", user_id, call.message.message_id, parse_mode="HTML", reply_markup=kb_email_list(email, emails, has_newer, has_older))
 
     elif call.data == "create_email":
         bot.edit_message_text("выберите домен:", user_id, call.message.message_id, reply_markup=kb_domains())
@@ -520,167 +397,135 @@ def process_create_email(message, domain):
 # --- ПОЧТОВЫЙ ЛУП ---
 is_running = True
 
-def mail_check_loop():
-    print("🚀 Mail Monitor Started")
+# Как часто применять политики хранения (секунды)
+RETENTION_INTERVAL = int(os.environ.get('RETENTION_INTERVAL', '3600'))
+# Как часто сообщать админу о ходе загрузки истории (секунды)
+BACKFILL_REPORT_INTERVAL = int(os.environ.get('BACKFILL_REPORT_INTERVAL', '300'))
+
+def send_notification(chat_id, stored):
+    """
+    Уведомление о сохранённом письме (dict из add_emails или из БД при повторе).
+    Кому — решает БД (outbox): владельцу ящика или админу, выключенным ящикам никому.
+    Возвращает message_id; при ошибке исключение, повтор делает outbox
+    """
+    to_addr = stored['to_email']
+
+    # Формирование контента
+    # Превью и кнопки уже посчитаны при разборе (в пуле процессов)
+    text_preview = stored.get('preview') or smart_format_text(stored['text'])
     
-    # --- СИНХРОНИЗАЦИЯ ПРИ ЗАПУСКЕ ---
-    # Мы хотим получить все письма, которых у нас нет, но без фанатизма (например, за последние 30 дней или все)
-    # Так как пользователь просил "хранить все", попробуем синхронизировать от последнего локального UID.
+    # Ищем кнопки
+    action_links = stored['links'] if 'links' in stored else extract_links(stored['html'], stored['text'])
+    kb = types.InlineKeyboardMarkup()
+    for link in action_links:
+        kb.add(types.InlineKeyboardButton(link['label'], url=link['url']))
+    attachment_buttons(kb, stored['uid'], stored.get('attachments') or [])
     
-    initial_mm = MailManager()
-    if initial_mm.connect():
-        initial_mm.mail.select("INBOX")
-        
-        last_local_uid = email_db.get_last_uid()
-        print(f"📥 Last Local UID: {last_local_uid}")
-        
-        # Получаем все UID с сервера
-        status, messages = initial_mm.mail.uid('search', None, "ALL")
-        if status == "OK":
-            all_server_uids = [int(u) for u in messages[0].split()]
-            if all_server_uids:
-                max_server_uid = max(all_server_uids)
-                
-                # Если локальная база пуста или отстает, нужно подтянуть
-                # Чтобы не грузить всё сразу, можно грузить только новые. 
-                # Но пользователь хочет "хранить всё". Если база пуста, это займет время.
-                # Для начала сделаем синхронизацию только НОВЫХ с момента последнего запуска.
-                # Если база пуста (last_local_uid == 0), то загрузим, скажем, последние 50 писем для старта,
-                # чтобы не ждать вечность.
-                
-                if last_local_uid == 0:
-                    uids_to_sync = sorted(all_server_uids)[-50:] # Start with last 50
-                    print(f"📥 Initial Sync: fetching last {len(uids_to_sync)} emails...")
-                else:
-                    uids_to_sync = [u for u in all_server_uids if u > last_local_uid]
-                    print(f"📥 Syncing {len(uids_to_sync)} new emails...")
-
-                for uid in uids_to_sync:
-                    try:
-                        res, msg_data = initial_mm.mail.uid('fetch', str(uid), '(RFC822)')
-                        parsed = initial_mm.parse_email(msg_data[0][1])
-                        
-                        # Определяем владельца
-                        to_addr = parsed['to_email']
-                        owner_id = email_db.get_owner(to_addr)
-                        
-                        # Сохраняем в БД даже если нет владельца (на будущее) или если владелец админ
-                        # Но если владельца нет, ставим owner_id=0 или None
-                        if not owner_id:
-                             if parsed['to_raw'] and EMAIL_USER in parsed['to_raw']:
-                                owner_id = ADMIN_ID
-                             else:
-                                owner_id = 0 # Unknown
-                        
-                        email_db.add_email(
-                            uid, owner_id, to_addr, parsed['from'], 
-                            parsed['subject'], parsed['text'], parsed['html']
-                        )
-                        print(f"✅ Synced UID {uid}")
-                        
-                        # Обновляем last_local_uid чтобы монитор подхватил только новее этого
-                        if uid > last_local_uid:
-                            last_local_uid = uid
-                            
-                    except Exception as e:
-                        print(f"Sync Error UID {uid}: {e}")
-        
-        initial_mm.mail.close()
-        initial_mm.mail.logout()
+    caption = (
+        f"📨 <b>новое письмо!</b>\n\n"
+        f"📬 <b>на:</b> <code>{to_addr}</code>\n"
+        f"👤 <b>от:</b> {html.escape(stored['from'])}\n"
+        f"📌 <b>тема:</b> {html.escape(stored['subject'])}\n"
+        f"{truncated_note(stored)}"
+        f"──────────────────\n"
+        f"{text_preview}"
+    )
     
-    last_uid = last_local_uid
-    print(f"🏁 Sync Complete. Monitoring from UID: {last_uid}")
+    # Отправка
+    try:
+        if stored['html']:
+            file_obj = io.BytesIO(stored['html'])
+            file_obj.name = "message.html"
+            sent = bot.send_document(chat_id, file_obj, caption=caption, parse_mode="HTML", reply_markup=kb)
+        else:
+            sent = bot.send_message(chat_id, caption, parse_mode="HTML", reply_markup=kb)
+    except ApiTelegramException as e:
+        if e.error_code == 429:
+            raise RetryAfter(((e.result_json or {}).get('parameters') or {}).get('retry_after', 30), e.description)
+        # 403: бот заблокирован, 400: чат не найден или письмо не отправить — повтор не поможет
+        if e.error_code in (400, 403):
+            raise PermanentError(e.description) from e
+        raise
+    return sent.message_id
+
+def report_backfill():
+    """Прогресс загрузки истории для админа, не чаще BACKFILL_REPORT_INTERVAL"""
+    last_report = 0.0
+
+    def progress(p):
+        nonlocal last_report
+        now = time.monotonic()
+        if not p['finished'] and now - last_report < BACKFILL_REPORT_INTERVAL:
+            return
+        last_report = now
+        head = "✅ <b>история загружена</b>" if p['finished'] else "📥 <b>загрузка истории</b>"
+        text = (
+            f"{head}: {html.escape(p['source'])}\n"
+            f"писем: {p['messages_done']}/{p['messages']} (сохранено {p['stored']})\n"
+            f"диапазонов: {p['ranges_done']}/{p['ranges']}, {p['rate']:.0f} писем/с"
+        )
+        print(text.replace('<b>', '').replace('</b>', ''))
+        try:
+            bot.send_message(ADMIN_ID, text, parse_mode="HTML")
+        except Exception as e:
+            print(f"Send Error to {ADMIN_ID}: {e}")
+    return progress
+
+ingest = None
+# Разбор писем (MIME, HTML -> текст, ссылки) в отдельных процессах
+parser_pool = ParserPool()
+
+def mail_check_loop():
+    global ingest
+    print("🚀 Mail Monitor Started")
 
+    # База от одного INBOX переезжает на имя источника "ящик/папка"
+    legacy = source_name(EMAIL_USER, 'INBOX')
+    if any(legacy in account.sources() for account in MAIL_ACCOUNTS) and email_db.adopt_legacy_source(legacy):
+        print(f"📦 INBOX state moved to {legacy}")
+
+    # Все папки всех ящиков (и LMTP/SMTP, если включён) -> разбор -> БД -> уведомления
+    ingest = MailIngest(email_db, MAIL_ACCOUNTS, parser_pool.parse, send_notification, progress=report_backfill())
+    ingest.run()
+
+def shutdown(mail_thread=None):
+    """Останавливает приём и дожидается записи и уведомлений по уже скачанным письмам"""
+    global is_running
+    is_running = False
+    if ingest:
+        ingest.stop(mail_thread)
+    parser_pool.close()
+
+def retention_loop():
+    # Переносит старые письма в архивы по месяцам и удаляет просроченные тела
     while is_running:
         try:
-            mm = MailManager()
-            if mm.connect():
-                mm.mail.select("INBOX")
-                status, messages = mm.mail.uid('search', None, "ALL")
-                
-                if status == "OK":
-                    current_uids = [int(u) for u in messages[0].split()]
-                    new_uids = [u for u in current_uids if u > last_uid]
-                    
-                    for uid in new_uids:
-                        try:
-                            res, msg_data = mm.mail.uid('fetch', str(uid), '(RFC822)')
-                            parsed = mm.parse_email(msg_data[0][1])
-                            
-                            # Роутинг
-                            to_addr = parsed['to_email']
-                            owner_id = email_db.get_owner(to_addr)
-                            
-                            # Сохраняем в БД СРАЗУ
-                            email_db.add_email(
-                                uid, owner_id if owner_id else 0, to_addr, parsed['from'], 
-                                parsed['subject'], parsed['text'], parsed['html']
-                            )
-                            
-                            # Проверка статуса ящика для уведомления
-                            if owner_id and not email_db.is_alias_active(owner_id, to_addr):
-                                print(f"Skipping notification for inactive address: {to_addr}")
-                                if uid > last_uid: last_uid = uid
-                                continue
-                            
-                            if not owner_id:
-                                if parsed['to_raw'] and EMAIL_USER in parsed['to_raw']:
-                                    owner_id = ADMIN_ID
-                                else:
-                                    owner_id = ADMIN_ID 
-                            
-                            # Формирование контента
-                            text_preview = smart_format_text(parsed['text'])
-                            
-                            # Ищем кнопки
-                            action_links = extract_links(parsed['html'], parsed['text'])
-                            kb = types.InlineKeyboardMarkup()
-                            for link in action_links:
-                                kb.add(types.InlineKeyboardButton(link['label'], url=link['url']))
-                            
-                            caption = (
-                                f"📨 <b>новое письмо!</b>\n\n"
-                                f"📬 <b>на:</b> <code>{to_addr}</code>\n"
-                                f"👤 <b>от:</b> {html.escape(parsed['from'])}\n"
-                                f"📌 <b>тема:</b> {html.escape(parsed['subject'])}\n"
-                                f"──────────────────\n"
-                                f"{text_preview}"
-                            )
-                            
-                            # Отправка
-                            try:
-                                if parsed['html']:
-                                    file_obj = io.BytesIO(parsed['html'])
-                                    file_obj.name = "message.html"
-                                    bot.send_document(owner_id, file_obj, caption=caption, parse_mode="HTML", reply_markup=kb)
-                                else:
-                                    bot.send_message(owner_id, caption, parse_mode="HTML", reply_markup=kb)
-                            except Exception as e:
-                                print(f"Send Error to {owner_id}: {e}")
-
-                            if uid > last_uid:
-                                last_uid = uid
-                                
-                        except Exception as e:
-                            print(f"Error processing UID {uid}: {e}")
-
-                mm.mail.close()
-                mm.mail.logout()
-            
+            result = email_db.apply_retention()
+            if result['archived'] or result['bodies_dropped']:
+                print(f"🗄 Retention: archived {result['archived']}, bodies dropped {result['bodies_dropped']}")
         except Exception as e:
-            print(f"Loop Error: {e}")
-        
-        time.sleep(5)
+            print(f"Retention Error: {e}")
+        time.sleep(RETENTION_INTERVAL)
 
 if __name__ == '__main__':
+    # Процессы разбора создаются до остальных потоков
+    parser_pool.start()
+
     # Запуск потока
     t = threading.Thread(target=mail_check_loop)
     t.daemon = True
     t.start()
 
+    r = threading.Thread(target=retention_loop)
+    r.daemon = True
+    r.start()
+
     # Запуск бота
     print("🤖 Bot Polling Started...")
+    signal.signal(signal.SIGTERM, lambda *_: bot.stop_polling())
     try:
         bot.infinity_polling()
     except Exception as e:
         print(f"Bot Polling Error: {e}")
+    finally:
+        shutdown(t)
@@ -1,5 +1,19 @@
+import datetime
+import fnmatch
+import hashlib
+import json
+import re
 import sqlite3
 import threading
+import time
+import queue
+import zlib
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 import os
 ADMIN_ID = int(os.environ.get('ADMIN_ID', '0'))
@@ -17,29 +31,259 @@ CRITICAL_LOCAL_PARTS = [
     'system', 'bot', 'mailer-daemon'
 ]
 
+# Further addresses reserved for the admin, as GLOB patterns
+# (e.g. "noreply-*@*"), comma-separated.
+RESERVED_PATTERNS = [
+    p.strip().lower() for p in os.environ.get('RESERVED_ALIAS_PATTERNS', '').split(',') if p.strip()
+]
+
+def reserved_addresses(admin_alias=ADMIN_EMAIL):
+    """The fixed reserved list: the admin mailbox plus the critical names on every domain."""
+    addresses = [admin_alias.lower().strip()]
+    for domain in ALLOWED_DOMAINS:
+        for local in CRITICAL_LOCAL_PARTS:
+            addresses.append(f"{local}@{domain}")
+    return addresses
+
+_RESERVED = frozenset(reserved_addresses())
+
+def is_reserved_address(address):
+    address = (address or '').lower().strip()
+    return address in _RESERVED or any(fnmatch.fnmatchcase(address, p) for p in RESERVED_PATTERNS)
+
+# Connection tuning. WAL lets readers run alongside a writer (and across the
+# bot and web processes); synchronous=NORMAL is durable enough in WAL mode.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+DB_BUSY_TIMEOUT_MS = 30000
+# How stale the alias routing table may get before the version is checked
+# again; changes made through this process apply at once
+ROUTES_MAX_AGE = float(os.environ.get('ROUTES_MAX_AGE', '1.0'))
+# A new database hands out live uids above this, leaving the positive uids
+# below for history backfills, which sort under live mail
+HISTORY_UID_ROOM = 1 << 27
+DB_PRAGMAS = (
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',       # ~16 MB page cache per connection
+    'PRAGMA mmap_size = 268435456',     # 256 MB
+    f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}',
+)
+
+# Full-text search over subject, sender and text body. unicode61 case-folds
+# Cyrillic as well as Latin but does not treat ё as е, so both the indexed
+# text and the query are folded explicitly.
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+FTS_WEIGHTS = (10.0, 5.0, 1.0)  # subject, from_addr, text_body
+
+def _fts_fold_sql(expr):
+    return f"replace(replace({expr}, 'ё', 'е'), 'Ё', 'Е')"
+
+def _fts_text_sql(prefix, inline=False, bodies='bodies'):
+    # Text comes from the shared bodies table. While an old database is being
+    # migrated, rows not yet moved there still carry it inline.
+    text = f"(SELECT body_text(b.codec, b.data) FROM {bodies} b WHERE b.hash = {prefix}.text_hash)"
+    if inline:
+        text = f"COALESCE({text}, body_text({prefix}.body_codec, {prefix}.text_body))"
+    return text
+
+def _fts_values_sql(prefix, inline=False, bodies='bodies'):
+    text = _fts_text_sql(prefix, inline, bodies)
+    return ', '.join(_fts_fold_sql(expr) for expr in (f"{prefix}.subject", f"{prefix}.from_addr", text))
+
+def build_fts_query(text):
+    """Turns free user input into an FTS5 query: every word must match as a prefix."""
+    text = (text or '').replace('ё', 'е').replace('Ё', 'Е')
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{w}"*' for w in words)
+
+# Optional compression of message bodies. Off by default; 'zlib' or 'zstd'
+# (needs the zstandard package). The codec is stored per body, so bodies
+# written with different settings can live side by side.
+BODY_CODEC = os.environ.get('BODY_CODEC', 'none')
+BODY_COMPRESS_MIN = 512  # bytes; smaller bodies are stored as is
+
+# Retention: mail older than a policy's hot_days moves out of the main
+# database into one archive database per month; after body_days only the
+# headers are kept. Policies are per alias, RETENTION_GLOBAL is the default.
+RETENTION_GLOBAL = '*'
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR')  # default: "archive" next to the database
+# Seconds a claimed notification is left to its sender before another may take it
+OUTBOX_LEASE = 300
+
+def _compress(codec, data):
+    if codec == 'zlib':
+        return zlib.compress(data, 6)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError(f"Unknown body codec: {codec}")
+
+def _decompress(codec, data):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown body codec: {codec}")
+
+def encode_body(codec, data):
+    """Returns (codec, stored_bytes); codec is None when the body is kept uncompressed."""
+    if codec in (None, 'none') or len(data) < BODY_COMPRESS_MIN:
+        return None, data
+    packed = _compress(codec, data)
+    if len(packed) >= len(data):
+        return None, data
+    return codec, packed
+
+def body_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def decode_text(codec, value):
+    if value is None:
+        return None
+    if codec is not None:
+        value = _decompress(codec, value)
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='ignore')
+    return value
+
+def decode_html(codec, value):
+    if codec is None or value is None:
+        return value
+    return _decompress(codec, value)
+
 class EmailDatabase:
-    def __init__(self, db_path="emails.db"):
+    def __init__(self, db_path="emails.db", pool_size=DB_POOL_SIZE, body_codec=BODY_CODEC):
+        if body_codec == 'zstd' and zstandard is None:
+            print("zstandard is not installed, falling back to zlib body compression")
+            body_codec = 'zlib'
         self.db_path = db_path
+        self.body_codec = body_codec
+        self.archive_dir = ARCHIVE_DIR or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'archive')
+        # Serializes writers inside this process; readers never take it.
         self.lock = threading.Lock()
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._write_conn = None
+        # In-memory alias routing table: {address: (user_id, active)}
+        self._routes = None
+        self._routes_version = None
+        self._routes_checked = 0.0    # monotonic time of the last version check
+        self._routes_epoch = 0        # bumped by local changes
+        self._routes_lock = threading.Lock()
         self.init_db()
 
-    def init_db(self):
+    # --- Connections ---
+
+    def _open(self):
+        # isolation_level=None: we issue BEGIN/COMMIT ourselves
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        # Used by the FTS triggers to index compressed text bodies
+        conn.create_function('body_text', 2, decode_text, deterministic=True)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def _reader(self, attach=None):
+        """
+        Borrow a pooled read connection. Readers do not block each other or
+        the writer. `attach` maps schema names to archive files to attach.
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        try:
+            self._attach(conn, attach)
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._detach(conn, attach)
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    @contextmanager
+    def _writer(self, attach=None):
+        """Run a write transaction on the shared write connection."""
+        with self.lock:
+            if self._write_conn is None:
+                self._write_conn = self._open()
+            conn = self._write_conn
+            # ATTACH is not allowed inside a transaction
+            self._attach(conn, attach)
+            try:
+                # IMMEDIATE takes the write lock up front, so another process
+                # waits on busy_timeout instead of failing mid-transaction.
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    yield conn
+                except BaseException:
+                    conn.rollback()
+                    raise
+                else:
+                    conn.commit()
+            finally:
+                self._detach(conn, attach)
+
+    def _attach(self, conn, attach):
+        for name, path in (attach or {}).items():
+            conn.execute(f'ATTACH DATABASE ? AS {name}', (path,))
+
+    def _detach(self, conn, attach):
+        for name in (attach or {}):
+            try:
+                conn.execute(f'DETACH DATABASE {name}')
+            except sqlite3.Error:
+                pass
+
+    def close(self):
         with self.lock:
-            conn = sqlite3.connect(self.db_path)
+            if self._write_conn is not None:
+                self._write_conn.close()
+                self._write_conn = None
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def init_db(self):
+        conn = self._open()
+        try:
+            # Persistent: once set, every connection (bot and web) uses WAL
+            conn.execute('PRAGMA journal_mode = WAL')
+        finally:
+            conn.close()
+
+        with self._writer() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS emails (
-                    uid INTEGER PRIMARY KEY,
-                    owner_id INTEGER,
-                    to_addr TEXT,
-                    from_addr TEXT,
-                    subject TEXT,
-                    text_body TEXT,
-                    html_body BLOB,
-                    received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
+            self._create_emails_table(cursor, 'emails')
+
+            # Databases from before the metadata/body split keep their bodies
+            # inline until migrate_inline_bodies() moves them out.
+            inline = 'text_body' in self._columns(cursor, 'emails')
+            if inline:
+                self._add_column(cursor, 'emails', 'body_codec', 'TEXT')
+                self._add_column(cursor, 'emails', 'body_size', 'INTEGER')
+                self._add_column(cursor, 'emails', 'text_hash', 'TEXT')
+                self._add_column(cursor, 'emails', 'html_hash', 'TEXT')
+            self._create_sources(cursor)
+            if 'truncated' not in self._columns(cursor, 'emails'):
+                # Archives are read with the same queries, so they get the columns first
+                if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'archive_months'").fetchone():
+                    for row in cursor.execute('SELECT month FROM archive_months').fetchall():
+                        path = self._archive_path(row['month'])
+                        if os.path.exists(path):
+                            self._init_archive(path)
+                self._create_message_size(cursor)
+
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS aliases (
                     address TEXT PRIMARY KEY,
@@ -67,325 +311,1180 @@ class EmailDatabase:
                 )
             ''')
 
-            # Index for faster lookup by address
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_to_addr ON emails (to_addr)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_owner ON emails (owner_id)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_alias_user ON aliases (user_id)')
-            conn.commit()
-            conn.close()
+            self._create_alias_version(cursor)
+            self._create_retention(cursor)
+
+            # IMAP position per source (account/folder). first_uid is where the
+            # live sync started; history below it is the backfill's. uid_offset
+            # is left from single-mailbox databases, whose local uids were
+            # server uid + uid_offset. The gap columns are imap_reconcile's:
+            # server uids from gap_floor up are checked, `gaps` is what the
+            # last pass still found missing.
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    source TEXT PRIMARY KEY,
+                    uidvalidity INTEGER,
+                    last_uid INTEGER NOT NULL DEFAULT 0,
+                    uid_offset INTEGER NOT NULL DEFAULT 0,
+                    highest_modseq INTEGER,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    first_uid INTEGER,
+                    gap_floor INTEGER,
+                    gaps INTEGER,
+                    gaps_recovered INTEGER NOT NULL DEFAULT 0,
+                    gaps_checked_at TIMESTAMP
+                )
+            ''')
+            if 'first_uid' not in self._columns(cursor, 'sync_state'):
+                cursor.execute('ALTER TABLE sync_state ADD COLUMN first_uid INTEGER')
+                # What Backfill.plan() used to derive from the oldest local uid
+                cursor.execute('''
+                    UPDATE sync_state SET first_uid = MIN(last_uid + 1, COALESCE((
+                        SELECT MIN(m) FROM (SELECT MIN(uid) AS m FROM emails
+                                            UNION ALL SELECT MIN(min_uid) FROM archive_months)
+                    ) - uid_offset, last_uid + 1))
+                ''')
+            if 'gap_floor' not in self._columns(cursor, 'sync_state'):
+                self._add_column(cursor, 'sync_state', 'gap_floor', 'INTEGER')
+                self._add_column(cursor, 'sync_state', 'gaps', 'INTEGER')
+                self._add_column(cursor, 'sync_state', 'gaps_recovered', 'INTEGER NOT NULL DEFAULT 0')
+                self._add_column(cursor, 'sync_state', 'gaps_checked_at', 'TIMESTAMP')
+                # Mail deleted or archived so far left no trace in removed_messages,
+                # so what is stored already is not reconciled (gap-status --floor to widen)
+                cursor.execute('UPDATE sync_state SET gap_floor = last_uid + 1')
+            self._create_backfill(cursor)
+            self._create_uid_sequence(cursor)
+            self._create_bodies(cursor)
+            self._create_attachments(cursor)
+            self._create_outbox(cursor)
+            self._create_removed(cursor)
+
+            counters_exist = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'user_counters'"
+            ).fetchone()
+            self._create_counters(cursor)
+            if not counters_exist:
+                self._fill_counters(cursor)
+
+            fts_exists = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'emails_fts'"
+            ).fetchone()
+            self._create_fts(cursor)
+            if not fts_exists:
+                # Existing database without an index yet
+                self._fill_fts(cursor)
+
+            self._create_email_indexes(cursor)
+
+        if inline:
+            self.migrate_inline_bodies()
+            self._drop_inline_columns()
             
         # Strictly enforce admin alias on every init
         self.ensure_admin_alias(ADMIN_ID, ADMIN_EMAIL)
 
-    def upsert_user(self, user_id, username, first_name, last_name):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
+    def _create_alias_version(self, cursor):
+        # Bumped by triggers on every alias change, whichever process makes
+        # it, so each process can tell when its routing table is stale.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS db_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO db_versions (name) VALUES ('aliases')")
+        bump = "UPDATE db_versions SET version = version + 1 WHERE name = 'aliases';"
+        for name, event in (('ai', 'INSERT'), ('ad', 'DELETE'), ('au', 'UPDATE')):
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS aliases_version_{name} AFTER {event} ON aliases BEGIN {bump} END')
+
+    def _create_uid_sequence(self, cursor):
+        # The highest local uid ever handed out. It only grows, so a uid freed
+        # by a deletion is never reused and old Telegram buttons (read_, att_,
+        # paging cursors) can never point at another message. Databases from
+        # before the counter start at their newest uid, new ones above
+        # HISTORY_UID_ROOM.
+        cursor.execute('''
+            INSERT OR IGNORE INTO db_versions (name, version)
+            SELECT 'email_uid', COALESCE(MAX(m), ?) FROM (SELECT MAX(uid) AS m FROM emails
+                                                          UNION ALL SELECT MAX(max_uid) FROM archive_months)
+        ''', (HISTORY_UID_ROOM,))
+        # The lowest local uid ever reserved for history (plan_backfill). It
+        # only goes down, so a job planned again, or after deletions, gets a
+        # block of uids no email has had.
+        cursor.execute('''
+            INSERT OR IGNORE INTO db_versions (name, version)
+            SELECT 'history_uid', COALESCE(MIN(m), (SELECT version + 1 FROM db_versions WHERE name = 'email_uid'))
+            FROM (SELECT MIN(uid) AS m FROM emails
+                  UNION ALL SELECT MIN(min_uid) FROM archive_months
+                  UNION ALL SELECT MIN(uid_offset + 1) FROM backfill_jobs WHERE uid_hi > 0)
+        ''')
+
+    def _create_emails_table(self, cursor, name):
+        # Metadata only: list views read this narrow table (or its covering
+        # index) and never touch body pages. Bodies live in `bodies`.
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {name} (
+                uid INTEGER PRIMARY KEY,
+                owner_id INTEGER,
+                to_addr TEXT,
+                from_addr TEXT,
+                subject TEXT,
+                received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                text_hash TEXT,
+                html_hash TEXT,
+                body_size INTEGER
+            )
+        ''')
+
+    def _create_sources(self, cursor):
+        # Where each message came from. Local uids are handed out by the
+        # database, so two mailboxes never collide; (source, uidvalidity,
+        # server_uid) identifies the server copy and keeps a refetch from
+        # storing it twice. Main database only, archives keep the old columns.
+        self._add_column(cursor, 'emails', 'source', 'TEXT')
+        self._add_column(cursor, 'emails', 'uidvalidity', 'INTEGER')
+        self._add_column(cursor, 'emails', 'server_uid', 'INTEGER')
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_emails_source ON emails (source, uidvalidity, server_uid)
+            WHERE source IS NOT NULL
+        ''')
+
+    def _create_message_size(self, cursor):
+        # Size of the message as received, and whether its stored text or
+        # HTML was cut short (mail_parser.MAIL_TEXT_MAX, IMAP section caps)
+        self._add_column(cursor, 'emails', 'raw_size', 'INTEGER')
+        self._add_column(cursor, 'emails', 'truncated', 'INTEGER NOT NULL DEFAULT 0')
+
+    def _create_email_indexes(self, cursor):
+        # Covers the list projection, so a page of 10-50 rows for an address
+        # is an index range scan and nothing else.
+        cursor.execute('DROP INDEX IF EXISTS idx_to_addr')
+        cursor.execute('DROP INDEX IF EXISTS idx_to_addr_uid')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_emails_list
+            ON emails (to_addr, uid, received_at, html_hash, from_addr, subject)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_owner ON emails (owner_id)')
+        # Retention walks rows oldest first
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_received ON emails (received_at, uid, to_addr)')
+
+    def _drop_inline_columns(self):
+        """Rebuilds `emails` without the old inline body columns once they are empty."""
+        with self._writer() as conn:
             cursor = conn.cursor()
-            try:
-                cursor.execute('''
+            if 'text_body' not in self._columns(cursor, 'emails'):
+                return
+            if cursor.execute(
+                'SELECT 1 FROM emails WHERE text_body IS NOT NULL OR html_body IS NOT NULL LIMIT 1'
+            ).fetchone():
+                # Something wrote inline bodies meanwhile; retry on next start
+                return
+            self._create_emails_table(cursor, 'emails_meta')
+            cursor.execute('''
+                INSERT INTO emails_meta (uid, owner_id, to_addr, from_addr, subject, received_at,
+                                         text_hash, html_hash, body_size)
+                SELECT uid, owner_id, to_addr, from_addr, subject, received_at,
+                       text_hash, html_hash, body_size
+                FROM emails
+            ''')
+            # Dropping takes the old triggers and indexes with it; no delete
+            # triggers fire, so counters, refcounts and the index stay valid.
+            cursor.execute('DROP TABLE emails')
+            cursor.execute('ALTER TABLE emails_meta RENAME TO emails')
+            self._create_sources(cursor)
+            self._create_message_size(cursor)
+            self._create_bodies(cursor)
+            self._create_attachments(cursor)
+            self._create_outbox(cursor)
+            self._create_removed(cursor)
+            self._create_counters(cursor)
+            self._create_fts(cursor)
+            self._create_email_indexes(cursor)
+        print("Split email metadata from bodies")
+
+    def _columns(self, cursor, table):
+        return [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+
+    def _add_column(self, cursor, table, column, decl):
+        if column not in self._columns(cursor, table):
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+    def _create_bodies(self, cursor):
+        # Content-addressed message bodies: identical text/HTML is stored once
+        # and shared by every email that references its hash.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bodies (
+                hash TEXT PRIMARY KEY,
+                codec TEXT,
+                data BLOB,
+                size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_bodies_orphans ON bodies (refcount) WHERE refcount <= 0')
+
+        # Reference counts follow the emails rows; orphans are removed by
+        # _gc_bodies() at the end of the deleting transaction.
+        add_refs = '''
+            UPDATE bodies SET refcount = refcount + 1 WHERE hash = new.text_hash;
+            UPDATE bodies SET refcount = refcount + 1 WHERE hash = new.html_hash;
+        '''
+        drop_refs = '''
+            UPDATE bodies SET refcount = refcount - 1 WHERE hash = old.text_hash;
+            UPDATE bodies SET refcount = refcount - 1 WHERE hash = old.html_hash;
+        '''
+        triggers = {
+            'bodies_ref_ai': f"AFTER INSERT ON emails BEGIN {add_refs} END",
+            'bodies_ref_ad': f"AFTER DELETE ON emails BEGIN {drop_refs} END",
+            'bodies_ref_au': f"AFTER UPDATE OF text_hash, html_hash ON emails BEGIN {drop_refs} {add_refs} END",
+        }
+        for name, body in triggers.items():
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+
+    def _create_attachments(self, cursor):
+        # Parts left on the IMAP server at ingestion, fetched on demand by
+        # (source, uidvalidity, server_uid, section)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS attachments (
+                uid INTEGER NOT NULL,
+                section TEXT NOT NULL,
+                filename TEXT,
+                content_type TEXT,
+                encoding TEXT,
+                size INTEGER,
+                source TEXT,
+                uidvalidity INTEGER,
+                server_uid INTEGER,
+                PRIMARY KEY (uid, section)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS attachments_ad AFTER DELETE ON emails
+            BEGIN DELETE FROM attachments WHERE uid = old.uid; END
+        ''')
+
+    def _create_outbox(self, cursor):
+        # Telegram notifications owed for stored emails, written in the same
+        # transaction as the email (see outbox.py). A pending row is due at
+        # next_attempt (unix time); sent rows keep the Telegram message_id.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                uid INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0,
+                message_id INTEGER,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        ''')
+        # Only the pending rows are ever searched, so a restart costs O(pending)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (next_attempt) WHERE state = 'pending'")
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS outbox_ad AFTER DELETE ON emails
+            BEGIN DELETE FROM outbox WHERE uid = old.uid; END
+        ''')
+
+    def _create_removed(self, cursor):
+        # Server copies of emails deleted or archived here, so the gap
+        # reconciler (imap_reconcile.py) does not bring them back
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS removed_messages (
+                source TEXT NOT NULL,
+                uidvalidity INTEGER NOT NULL,
+                server_uid INTEGER NOT NULL,
+                PRIMARY KEY (source, uidvalidity, server_uid)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS removed_messages_ad AFTER DELETE ON emails
+            WHEN old.source IS NOT NULL AND old.uidvalidity IS NOT NULL AND old.server_uid IS NOT NULL
+            BEGIN
+                INSERT OR IGNORE INTO removed_messages (source, uidvalidity, server_uid)
+                VALUES (old.source, old.uidvalidity, old.server_uid);
+            END
+        ''')
+
+    def _gc_bodies(self, conn):
+        return conn.execute('DELETE FROM bodies WHERE refcount <= 0').rowcount
+
+    def _prepare_bodies(self, messages):
+        """
+        Hashes the text/HTML of each message and compresses the bodies the
+        database does not have yet. Runs outside the write lock. Returns
+        {hash: (codec, data, size)} for _insert_bodies(); bodies already
+        stored come back uncompressed, with codec None. Sets '_text_hash',
+        '_html_hash' and '_size' on each message.
+        """
+        payloads = {}
+        for m in messages:
+            text_bytes = m['text'].encode('utf-8') if m.get('text') else None
+            html_bytes = bytes(m['html']) if m.get('html') else None
+            m['_text_hash'] = body_hash(text_bytes) if text_bytes else None
+            m['_html_hash'] = body_hash(html_bytes) if html_bytes else None
+            m['_size'] = len(text_bytes or b'') + len(html_bytes or b'')
+            for h, data in ((m['_text_hash'], text_bytes), (m['_html_hash'], html_bytes)):
+                if h:
+                    payloads[h] = data
+
+        if not payloads:
+            return {}
+        with self._reader() as conn:
+            known = self._stored_bodies(conn, payloads)
+
+        bodies = {}
+        for h, data in payloads.items():
+            codec, stored = (None, data) if h in known else encode_body(self.body_codec, data)
+            bodies[h] = (codec, stored, len(data))
+        return bodies
+
+    def _stored_bodies(self, conn, hashes):
+        """The ones of `hashes` the bodies table has."""
+        hashes = list(hashes)
+        found = set()
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            placeholders = ','.join('?' for _ in chunk)
+            found.update(row['hash'] for row in
+                         conn.execute(f'SELECT hash FROM bodies WHERE hash IN ({placeholders})', chunk))
+        return found
+
+    def _insert_bodies(self, conn, bodies):
+        """
+        Writes the bodies from _prepare_bodies() inside the write transaction.
+        The ones it found stored are looked up again: a delete and
+        _gc_bodies() since then may have removed them, and then they are
+        compressed and inserted here.
+        """
+        known = self._stored_bodies(conn, [h for h, (codec, _, _) in bodies.items() if codec is None])
+        rows = []
+        for h, (codec, data, size) in bodies.items():
+            if codec is None:
+                if h in known:
+                    continue
+                codec, data = encode_body(self.body_codec, data)
+            rows.append((h, codec, data, size))
+        # A body another writer stored since _prepare_bodies is kept as is
+        conn.executemany('''
+            INSERT INTO bodies (hash, codec, data, size) VALUES (?, ?, ?, ?)
+            ON CONFLICT (hash) DO NOTHING
+        ''', rows)
+
+    def _new_messages(self, conn, messages):
+        """
+        The messages whose (source, uidvalidity, server_uid) is not stored yet,
+        each once. Messages without a source are all new.
+        """
+        keyed = {}
+        for m in messages:
+            if m.get('source') is not None:
+                keyed.setdefault((m['source'], m.get('uidvalidity')), set()).add(m.get('server_uid'))
+        stored = set()
+        for (source, uidvalidity), server_uids in keyed.items():
+            for row in conn.execute('''
+                SELECT server_uid FROM emails
+                WHERE source = ? AND uidvalidity IS ? AND server_uid IN (SELECT value FROM json_each(?))
+            ''', (source, uidvalidity, json.dumps(list(server_uids)))):
+                stored.add((source, uidvalidity, row['server_uid']))
+        new = []
+        for m in messages:
+            if m.get('source') is not None:
+                key = (m['source'], m.get('uidvalidity'), m.get('server_uid'))
+                if key in stored:
+                    continue
+                stored.add(key)
+            new.append(m)
+        return new
+
+    def _write_emails(self, messages):
+        """
+        Inserts messages that carry 'owner_id' and either a 'uid' or their
+        (source, uidvalidity, server_uid) key; those without a uid get the
+        next ones from the email_uid sequence, which never hands out a uid
+        twice. Messages already stored under their key are skipped, bodies
+        are deduplicated. Returns the messages written.
+        """
+        bodies = self._prepare_bodies(messages)
+        with self._writer() as conn:
+            written = self._new_messages(conn, messages)
+            # Inside the write transaction, so no other writer takes the same uids
+            next_uid = conn.execute("SELECT version FROM db_versions WHERE name = 'email_uid'").fetchone()[0]
+            for m in written:
+                if m.get('uid') is None:
+                    next_uid += 1
+                    m['uid'] = next_uid
+            # A fixed uid above the sequence (add_email) moves it on too
+            conn.execute("UPDATE db_versions SET version = MAX(version, ?) WHERE name = 'email_uid'",
+                         (max([next_uid] + [m['uid'] for m in written]),))
+            self._insert_bodies(conn, bodies)
+            inserted = []
+            for m in written:
+                cursor = conn.execute('''
+                    INSERT OR IGNORE INTO emails (uid, owner_id, to_addr, from_addr, subject,
+                                                  text_hash, html_hash, body_size, source, uidvalidity, server_uid,
+                                                  raw_size, truncated)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (m['uid'], m['owner_id'], m.get('to_email'), m.get('from'), m.get('subject'),
+                      m['_text_hash'], m['_html_hash'], m['_size'],
+                      m.get('source'), m.get('uidvalidity'), m.get('server_uid'),
+                      m.get('raw_size'), bool(m.get('truncated'))))
+                if cursor.rowcount:
+                    inserted.append(m)
+                else:
+                    # A fixed uid (backfill block, add_email) another email has: its
+                    # attachments and outbox row must not go to that one
+                    print(f"DB Error: uid {m['uid']} is taken, email {m.get('source')}/{m.get('server_uid')} "
+                          f"not stored")
+            written = inserted
+            conn.executemany('''
+                INSERT OR IGNORE INTO attachments (uid, section, filename, content_type, encoding, size,
+                                                   source, uidvalidity, server_uid)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (m['uid'], a['section'], a.get('filename'), a.get('content_type'), a.get('encoding'),
+                 a.get('size'), a.get('source'), a.get('uidvalidity'), a.get('server_uid'))
+                for m in written for a in m.get('attachments') or ()
+            ])
+            # Left to the sender that stored them for a lease, then to the outbox worker
+            conn.executemany('INSERT OR IGNORE INTO outbox (uid, chat_id, next_attempt) VALUES (?, ?, ?)', [
+                (m['uid'], m['owner_id'] or ADMIN_ID, time.time() + OUTBOX_LEASE)
+                for m in written if m.get('notify') and m.get('active')
+            ])
+            # Bodies of already-stored messages (skipped above) end up unreferenced
+            self._gc_bodies(conn)
+        for m in messages:
+            for key in ('_text_hash', '_html_hash', '_size'):
+                m.pop(key, None)
+        return written
+
+    def migrate_inline_bodies(self, chunk_size=500):
+        """Moves bodies still stored inline in `emails` into `bodies`. Returns rows moved."""
+        moved = 0
+        with self._reader() as conn:
+            if 'text_body' not in self._columns(conn, 'emails'):
+                return moved
+        while True:
+            with self._reader() as conn:
+                rows = conn.execute('''
+                    SELECT uid, text_body, html_body, body_codec FROM emails
+                    WHERE text_body IS NOT NULL OR html_body IS NOT NULL
+                    LIMIT ?
+                ''', (chunk_size,)).fetchall()
+            if not rows:
+                break
+            messages = [{
+                'uid': row['uid'],
+                'text': decode_text(row['body_codec'], row['text_body']),
+                'html': decode_html(row['body_codec'], row['html_body'])
+            } for row in rows]
+            bodies = self._prepare_bodies(messages)
+            with self._writer() as conn:
+                self._insert_bodies(conn, bodies)
+                conn.executemany('''
+                    UPDATE emails SET text_hash = ?, html_hash = ?, body_size = ?,
+                                      text_body = NULL, html_body = NULL, body_codec = NULL
+                    WHERE uid = ?
+                ''', [(m['_text_hash'], m['_html_hash'], m['_size'], m['uid']) for m in messages])
+            moved += len(rows)
+        if moved:
+            print(f"Moved {moved} message bodies into the shared bodies table")
+        return moved
+
+    def _create_counters(self, cursor):
+        # Per-address email counts and per-user alias/email counts, maintained
+        # by triggers so the admin stats never scan `emails`.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS alias_counters (
+                address TEXT PRIMARY KEY,
+                email_count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_counters (
+                user_id INTEGER PRIMARY KEY,
+                alias_count INTEGER NOT NULL DEFAULT 0,
+                email_count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        email_added = '''
+            INSERT INTO alias_counters (address, email_count) VALUES (new.to_addr, 1)
+                ON CONFLICT (address) DO UPDATE SET email_count = email_count + 1;
+            UPDATE user_counters SET email_count = email_count + 1
+                WHERE user_id = (SELECT user_id FROM aliases WHERE address = new.to_addr);
+        '''
+        email_removed = '''
+            UPDATE alias_counters SET email_count = email_count - 1 WHERE address = old.to_addr;
+            UPDATE user_counters SET email_count = email_count - 1
+                WHERE user_id = (SELECT user_id FROM aliases WHERE address = old.to_addr);
+        '''
+        alias_added = '''
+            INSERT INTO user_counters (user_id, alias_count, email_count)
+                VALUES (new.user_id, 1, COALESCE((SELECT email_count FROM alias_counters WHERE address = new.address), 0))
+                ON CONFLICT (user_id) DO UPDATE SET
+                    alias_count = alias_count + 1,
+                    email_count = email_count + excluded.email_count;
+        '''
+        alias_removed = '''
+            UPDATE user_counters SET
+                alias_count = alias_count - 1,
+                email_count = email_count - COALESCE((SELECT email_count FROM alias_counters WHERE address = old.address), 0)
+            WHERE user_id = old.user_id;
+        '''
+        triggers = {
+            'counters_email_ai': f"AFTER INSERT ON emails WHEN new.to_addr IS NOT NULL BEGIN {email_added} END",
+            'counters_email_ad': f"AFTER DELETE ON emails WHEN old.to_addr IS NOT NULL BEGIN {email_removed} END",
+            'counters_email_au': (
+                "AFTER UPDATE OF to_addr ON emails WHEN new.to_addr IS NOT old.to_addr BEGIN "
+                f"{email_removed} {email_added} END"
+            ),
+            'counters_alias_ai': f"AFTER INSERT ON aliases BEGIN {alias_added} END",
+            'counters_alias_ad': f"AFTER DELETE ON aliases BEGIN {alias_removed} END",
+            'counters_alias_au': (
+                "AFTER UPDATE OF user_id, address ON aliases "
+                "WHEN new.user_id IS NOT old.user_id OR new.address IS NOT old.address "
+                f"BEGIN {alias_removed} {alias_added} END"
+            ),
+        }
+        for name, body in triggers.items():
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+
+    def _fill_counters(self, cursor):
+        cursor.execute('DELETE FROM alias_counters')
+        cursor.execute('''
+            INSERT INTO alias_counters (address, email_count)
+            SELECT to_addr, COUNT(*) FROM emails WHERE to_addr IS NOT NULL GROUP BY to_addr
+        ''')
+        cursor.execute('DELETE FROM user_counters')
+        cursor.execute('''
+            INSERT INTO user_counters (user_id, alias_count, email_count)
+            SELECT a.user_id, COUNT(*), COALESCE(SUM(c.email_count), 0)
+            FROM aliases a LEFT JOIN alias_counters c ON c.address = a.address
+            GROUP BY a.user_id
+        ''')
+
+    def check_counters(self, repair=False):
+        """
+        Compares the maintained counters with a full recount.
+        Returns a list of mismatches; with repair=True the counters are rebuilt.
+        """
+        with self._reader() as conn:
+            mismatches = [dict(row) for row in conn.execute('''
+                SELECT 'alias' AS kind, t.to_addr AS key, COALESCE(c.email_count, 0) AS stored, t.n AS actual
+                FROM (SELECT to_addr, COUNT(*) AS n FROM emails WHERE to_addr IS NOT NULL GROUP BY to_addr) t
+                LEFT JOIN alias_counters c ON c.address = t.to_addr
+                WHERE COALESCE(c.email_count, 0) != t.n
+                UNION ALL
+                SELECT 'alias', c.address, c.email_count, 0
+                FROM alias_counters c
+                WHERE c.email_count != 0 AND NOT EXISTS (SELECT 1 FROM emails e WHERE e.to_addr = c.address)
+                UNION ALL
+                SELECT 'user', t.user_id, COALESCE(u.alias_count, 0) || '/' || COALESCE(u.email_count, 0),
+                       t.aliases || '/' || t.emails
+                FROM (
+                    SELECT a.user_id, COUNT(*) AS aliases,
+                           (SELECT COUNT(*) FROM emails e JOIN aliases x ON x.address = e.to_addr
+                            WHERE x.user_id = a.user_id) AS emails
+                    FROM aliases a GROUP BY a.user_id
+                ) t
+                LEFT JOIN user_counters u ON u.user_id = t.user_id
+                WHERE COALESCE(u.alias_count, 0) != t.aliases OR COALESCE(u.email_count, 0) != t.emails
+                UNION ALL
+                SELECT 'user', u.user_id, u.alias_count || '/' || u.email_count, '0/0'
+                FROM user_counters u
+                WHERE (u.alias_count != 0 OR u.email_count != 0)
+                  AND NOT EXISTS (SELECT 1 FROM aliases a WHERE a.user_id = u.user_id)
+            ''').fetchall()]
+
+        if repair and mismatches:
+            with self._writer() as conn:
+                self._fill_counters(conn.cursor())
+        return mismatches
+
+    def _create_fts(self, cursor):
+        # Contentless index: the text itself stays in `emails`. Triggers feed it
+        # the folded, decompressed values, so writes from either process keep
+        # it in sync. Deleting emails therefore needs a connection with the
+        # body_text() function, i.e. one opened by EmailDatabase.
+        self._create_fts_table(cursor)
+        # Triggers are recreated on every start so older databases pick up
+        # changes to their definitions.
+        inline = 'text_body' in self._columns(cursor, 'emails')
+        values = lambda prefix: _fts_values_sql(prefix, inline)
+        text = lambda prefix: _fts_text_sql(prefix, inline)
+        watched = 'subject, from_addr, text_body, body_codec, text_hash' if inline else 'subject, from_addr, text_hash'
+        triggers = {
+            'emails_fts_ai': f'''
+                AFTER INSERT ON emails BEGIN
+                    INSERT INTO emails_fts (rowid, subject, from_addr, text_body)
+                    VALUES (new.uid, {values('new')});
+                END
+            ''',
+            'emails_fts_ad': f'''
+                AFTER DELETE ON emails BEGIN
+                    INSERT INTO emails_fts (emails_fts, rowid, subject, from_addr, text_body)
+                    VALUES ('delete', old.uid, {values('old')});
+                END
+            ''',
+            # Moving a body into `bodies` changes the row but not the text
+            'emails_fts_au': f'''
+                AFTER UPDATE OF {watched} ON emails
+                WHEN old.subject IS NOT new.subject OR old.from_addr IS NOT new.from_addr
+                  OR {text('old')} IS NOT {text('new')}
+                BEGIN
+                    INSERT INTO emails_fts (emails_fts, rowid, subject, from_addr, text_body)
+                    VALUES ('delete', old.uid, {values('old')});
+                    INSERT INTO emails_fts (rowid, subject, from_addr, text_body)
+                    VALUES (new.uid, {values('new')});
+                END
+            ''',
+        }
+        for name, body in triggers.items():
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+            cursor.execute(f'CREATE TRIGGER {name} {body}')
+
+    def _create_fts_table(self, cursor):
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+                subject, from_addr, text_body,
+                content = '', tokenize = '{FTS_TOKENIZER}', prefix = '2 3'
+            )
+        ''')
+
+    def _fill_fts(self, cursor):
+        inline = 'text_body' in self._columns(cursor, 'emails')
+        cursor.execute("INSERT INTO emails_fts (emails_fts) VALUES ('delete-all')")
+        cursor.execute(f'''
+            INSERT INTO emails_fts (rowid, subject, from_addr, text_body)
+            SELECT e.uid, {_fts_values_sql('e', inline)} FROM emails e
+        ''')
+
+    def rebuild_search_index(self):
+        """Re-index every stored email (for databases created before the FTS table)."""
+        with self._writer() as conn:
+            cursor = conn.cursor()
+            self._create_fts(cursor)
+            self._fill_fts(cursor)
+            cursor.execute("INSERT INTO emails_fts (emails_fts) VALUES ('optimize')")
+            return cursor.execute('SELECT COUNT(*) FROM emails').fetchone()[0]
+
+    def search_emails(self, addresses, text, limit=20, offset=0, include_archive=False):
+        """
+        Ranked full-text search limited to the given aliases. Returns (emails, total).
+        With include_archive every monthly archive is searched as well.
+        """
+        fts_query = build_fts_query(text)
+        if not fts_query or not addresses:
+            return [], 0
+
+        if not include_archive:
+            with self._reader() as conn:
+                rows = self._search_rows(conn, 'main', addresses, fts_query, limit, offset)
+            total = rows[0]['total'] if rows else 0
+            hits = [(row, False) for row in rows]
+        else:
+            # Each archive has its own index: take the top offset+limit of
+            # every source, then merge by score
+            with self._reader() as conn:
+                rows = self._search_rows(conn, 'main', addresses, fts_query, offset + limit, 0)
+            total = rows[0]['total'] if rows else 0
+            hits = [(row, False) for row in rows]
+            for archive in self._archives():
+                with self._reader(attach={'arc': archive['path']}) as conn:
+                    rows = self._search_rows(conn, 'arc', addresses, fts_query, offset + limit, 0)
+                total += rows[0]['total'] if rows else 0
+                hits.extend((row, True) for row in rows)
+            hits.sort(key=lambda h: (h[0]['score'], -h[0]['uid']))
+            hits = hits[offset:offset + limit]
+
+        emails = []
+        for row, archived in hits:
+            emails.append({
+                "uid": row['uid'],
+                "to": row['to_addr'],
+                "from": row['from_addr'],
+                "subject": row['subject'],
+                "date": row['received_at'],
+                "has_html": bool(row['has_html']),
+                "archived": archived
+            })
+        return emails, total
+
+    def _search_rows(self, conn, schema, addresses, fts_query, limit, offset):
+        placeholders = ','.join('?' for _ in addresses)
+        # COUNT(*) OVER () gives the total in the same pass as the page
+        return conn.execute(f'''
+            SELECT e.uid, e.to_addr, e.from_addr, e.subject, e.received_at,
+                   e.html_hash IS NOT NULL AS has_html, hits.score,
+                   COUNT(*) OVER () AS total
+            FROM (
+                SELECT rowid, bm25(emails_fts, ?, ?, ?) AS score
+                FROM {schema}.emails_fts WHERE emails_fts MATCH ?
+            ) AS hits
+            JOIN {schema}.emails e ON e.uid = hits.rowid
+            WHERE e.to_addr IN ({placeholders})
+            ORDER BY hits.score, e.uid DESC
+            LIMIT ? OFFSET ?
+        ''', [*FTS_WEIGHTS, fts_query, *addresses, limit, offset]).fetchall()
+
+    def upsert_user(self, user_id, username, first_name, last_name):
+        try:
+            with self._writer() as conn:
+                conn.execute('''
                     INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, updated_at)
                     VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
                 ''', (user_id, username, first_name, last_name))
-                conn.commit()
-            except Exception as e:
-                print(f"DB Error upserting user: {e}")
-            finally:
-                conn.close()
+        except Exception as e:
+            print(f"DB Error upserting user: {e}")
 
     def add_alias(self, user_id, email, active=True):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            try:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO aliases (address, user_id, active)
+        try:
+            with self._writer() as conn:
+                # Upsert rather than REPLACE: REPLACE deletes without firing
+                # the delete triggers and would skew the counters
+                conn.execute('''
+                    INSERT INTO aliases (address, user_id, active)
                     VALUES (?, ?, ?)
+                    ON CONFLICT (address) DO UPDATE SET user_id = excluded.user_id, active = excluded.active
                 ''', (email.lower().strip(), user_id, active))
-                conn.commit()
-                return True
-            except Exception as e:
-                print(f"DB Error adding alias: {e}")
-                return False
-            finally:
-                conn.close()
+            self._invalidate_routes()
+            return True
+        except Exception as e:
+            print(f"DB Error adding alias: {e}")
+            return False
 
     def delete_alias(self, user_id, email):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            try:
-                cursor.execute('DELETE FROM aliases WHERE address = ? AND user_id = ?', (email.lower().strip(), user_id))
-                rows = cursor.rowcount
-                conn.commit()
-                return rows > 0
-            except Exception as e:
-                print(f"DB Error deleting alias: {e}")
-                return False
-            finally:
-                conn.close()
+        try:
+            with self._writer() as conn:
+                cursor = conn.execute('DELETE FROM aliases WHERE address = ? AND user_id = ?', (email.lower().strip(), user_id))
+                if cursor.rowcount and is_reserved_address(email):
+                    self._reset_reserved(conn)
+            self._invalidate_routes()
+            return cursor.rowcount > 0
+        except Exception as e:
+            print(f"DB Error deleting alias: {e}")
+            return False
 
     def get_user_aliases(self, user_id):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM aliases WHERE user_id = ?', (user_id,))
-            rows = cursor.fetchall()
-            conn.close()
+        with self._reader() as conn:
+            rows = conn.execute('SELECT address, active FROM aliases WHERE user_id = ?', (user_id,)).fetchall()
             
-            result = []
-            for row in rows:
-                result.append({
-                    "addr": row['address'],
-                    "active": bool(row['active'])
-                })
-            return result
+        result = []
+        for row in rows:
+            result.append({
+                "addr": row['address'],
+                "active": bool(row['active'])
+            })
+        return result
 
-    def get_owner(self, email):
+    # --- Alias routing ---
+
+    def _invalidate_routes(self):
+        # Changes from other processes are caught by the version check
+        self._routes_epoch += 1
+        self._routes = None
+
+    def refresh_routes(self):
+        """
+        The routing table. Within ROUTES_MAX_AGE of the last check it is
+        returned as is, without I/O or locking; after that it is reloaded if
+        any process changed aliases since, which costs one single-row read
+        when nothing changed.
+        """
+        routes = self._routes
+        if routes is not None and time.monotonic() - self._routes_checked < ROUTES_MAX_AGE:
+            return routes
+        with self._routes_lock:
+            routes = self._routes
+            if routes is not None and time.monotonic() - self._routes_checked < ROUTES_MAX_AGE:
+                return routes
+            epoch = self._routes_epoch
+            with self._reader() as conn:
+                # One read transaction so the version matches the rows
+                conn.execute('BEGIN')
+                try:
+                    row = conn.execute("SELECT version FROM db_versions WHERE name = 'aliases'").fetchone()
+                    version = row[0] if row else 0
+                    if self._routes is None or version != self._routes_version:
+                        self._routes = {
+                            r['address']: (r['user_id'], bool(r['active']))
+                            for r in conn.execute('SELECT address, user_id, active FROM aliases')
+                        }
+                        self._routes_version = version
+                    routes = self._routes
+                finally:
+                    conn.execute('COMMIT')
+            # A local change during the load makes the next call check again
+            self._routes_checked = time.monotonic() if epoch == self._routes_epoch else 0.0
+            return routes
+
+    def route(self, email):
+        """Returns (user_id, active) for a known alias, otherwise None."""
         if not email: return None
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT user_id FROM aliases WHERE address = ?', (email.lower().strip(),))
-            row = cursor.fetchone()
-            conn.close()
-            return row[0] if row else None
+        return self.refresh_routes().get(email.lower().strip())
+
+    def get_owner(self, email):
+        route = self.route(email)
+        return route[0] if route else None
 
     def is_alias_active(self, user_id, email):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT active FROM aliases WHERE address = ? AND user_id = ?', (email.lower().strip(), user_id))
-            row = cursor.fetchone()
-            conn.close()
-            if row:
-                return bool(row[0])
-            # If alias not found but we are checking activity, default to True? 
-            # Or False? Usually if we check for email routing, we check owner first.
-            # If we check for UI, it should exist.
-            return True
+        route = self.route(email)
+        if route and route[0] == user_id:
+            return route[1]
+        # If alias not found but we are checking activity, default to True? 
+        # Or False? Usually if we check for email routing, we check owner first.
+        # If we check for UI, it should exist.
+        return True
 
     def toggle_alias_active(self, user_id, email):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            try:
-                # First get current state
-                cursor.execute('SELECT active FROM aliases WHERE address = ? AND user_id = ?', (email.lower().strip(), user_id))
-                row = cursor.fetchone()
-                if row:
-                    new_state = not bool(row[0])
-                    cursor.execute('UPDATE aliases SET active = ? WHERE address = ?', (new_state, email.lower().strip()))
-                    conn.commit()
-                    return new_state
-                return None
-            finally:
-                conn.close()
+        with self._writer() as conn:
+            # First get current state
+            row = conn.execute('SELECT active FROM aliases WHERE address = ? AND user_id = ?', (email.lower().strip(), user_id)).fetchone()
+            if row:
+                new_state = not bool(row[0])
+                conn.execute('UPDATE aliases SET active = ? WHERE address = ?', (new_state, email.lower().strip()))
+            else:
+                new_state = None
+        self._invalidate_routes()
+        return new_state
 
     def add_email(self, uid, owner_id, to_addr, from_addr, subject, text_body, html_body):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            try:
-                cursor.execute('''
-                    INSERT OR IGNORE INTO emails (uid, owner_id, to_addr, from_addr, subject, text_body, html_body)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (uid, owner_id, to_addr, from_addr, subject, text_body, html_body))
-                conn.commit()
-                return True
-            except Exception as e:
-                print(f"DB Error adding email: {e}")
-                return False
-            finally:
-                conn.close()
+        try:
+            self._write_emails([{
+                'uid': uid, 'owner_id': owner_id, 'to_email': to_addr, 'from': from_addr,
+                'subject': subject, 'text': text_body, 'html': html_body
+            }])
+            return True
+        except Exception as e:
+            print(f"DB Error adding email: {e}")
+            return False
 
-    def get_emails_for_alias(self, email_addr, limit=10, offset=0):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM emails 
-                WHERE to_addr = ? 
-                ORDER BY uid DESC 
-                LIMIT ? OFFSET ?
-            ''', (email_addr, limit, offset))
-            rows = cursor.fetchall()
-            
-            # Count total
-            cursor.execute('SELECT COUNT(*) FROM emails WHERE to_addr = ?', (email_addr,))
-            total = cursor.fetchone()[0]
-            
-            conn.close()
-            
-            result = []
-            for row in rows:
-                result.append({
-                    'uid': row['uid'],
-                    'from': row['from_addr'],
-                    'subject': row['subject'],
-                    'text': row['text_body'],
-                    'html': row['html_body']
-                })
-            return result, total
+    def resolve_owners(self, addresses):
+        """Looks up many aliases at once. Returns {address: (user_id, active)} for the known ones."""
+        addresses = {a.lower().strip() for a in addresses if a}
+        if not addresses:
+            return {}
+        # One version check per batch, then plain dict lookups
+        table = self.refresh_routes()
+        return {addr: table[addr] for addr in addresses if addr in table}
+
+    def assign_owners(self, messages):
+        """
+        Copies of the messages (dicts with 'to_email' and 'to_raw') with
+        'owner_id' and 'active' filled in, resolved for the whole batch at
+        once. Mail for unknown addresses goes to the admin if it was sent to
+        the main mailbox, otherwise to owner 0.
+        """
+        messages = list(messages)
+        routes = self.resolve_owners(m.get('to_email') for m in messages)
+        routed = []
+        for m in messages:
+            owner_id, active = routes.get((m.get('to_email') or '').lower().strip(), (None, True))
+            if not owner_id:
+                owner_id = ADMIN_ID if m.get('to_raw') and ADMIN_EMAIL in m['to_raw'] else 0
+            routed.append({**m, 'owner_id': owner_id, 'active': active})
+        return routed
+
+    def add_emails(self, messages, raise_errors=False):
+        """
+        Stores a batch of parsed messages in one transaction.
+
+        Each message is a parse_email() dict (with 'raw_size' and
+        'truncated') plus its server copy's 'source', 'uidvalidity' and
+        'server_uid' (or a fixed local 'uid'), and optionally the
+        'attachments' left on the server. Owners are set by
+        assign_owners(). With 'notify' set, a message to an active address
+        also gets its outbox row (to the owner, or the admin). Returns the newly stored messages with 'uid',
+        'owner_id' and 'active' filled in; ones already stored, and ones whose
+        fixed uid another email has, are left out.
+        If the write fails, returns an empty list, or raises with raise_errors.
+        """
+        messages = list(messages)
+        if not messages:
+            return []
+        routed = self.assign_owners(messages)
+
+        try:
+            return self._write_emails(routed)
+        except Exception as e:
+            if raise_errors:
+                raise
+            print(f"DB Error adding {len(routed)} emails: {e}")
+            return []
+
+    def get_emails_page(self, addresses, limit=20, before_uid=None, after_uid=None, with_total=False,
+                        include_archive=False):
+        """
+        Keyset page of emails sent to any of `addresses`, newest first.
+
+        Pass before_uid (the last uid of the current page) to go to older mail,
+        or after_uid (the first uid) to go back to newer mail. Returns
+        (emails, has_more, total): has_more refers to the direction of travel,
+        total is only counted when with_total is set. With include_archive the
+        monthly archives are merged in; only those that can reach into the
+        page are attached.
+        """
+        addresses = list(addresses)
+        if not addresses:
+            return [], False, (0 if with_total else None)
+
+        if after_uid is not None:
+            cond, order, params = 'AND uid > ?', 'ASC', [after_uid]
+        elif before_uid is not None:
+            cond, order, params = 'AND uid < ?', 'DESC', [before_uid]
+        else:
+            cond, order, params = '', 'DESC', []
+        sql, sql_params = self._page_sql('main', addresses, cond, order, params, limit + 1)
+
+        with self._reader() as conn:
+            rows = [(row, False) for row in conn.execute(sql, sql_params)]
+            total = None
+            if with_total:
+                total = self._count_for_addresses(conn, addresses)
+
+        if include_archive:
+            desc = order == 'DESC'
+            for archive in self._archives(newest_first=desc):
+                if (before_uid is not None and archive['min_uid'] >= before_uid) or \
+                        (after_uid is not None and archive['max_uid'] <= after_uid):
+                    continue
+                # Archives come in uid order: once one lies wholly past the
+                # page edge, so do the rest
+                if len(rows) > limit:
+                    edge = rows[limit][0]['uid']
+                    if (archive['max_uid'] < edge) if desc else (archive['min_uid'] > edge):
+                        break
+                sql, sql_params = self._page_sql('arc', addresses, cond, order, params, limit + 1)
+                with self._reader(attach={'arc': archive['path']}) as conn:
+                    rows.extend((row, True) for row in conn.execute(sql, sql_params))
+                rows.sort(key=lambda r: r[0]['uid'], reverse=desc)
+                del rows[limit + 1:]
+            if with_total:
+                total += self._archived_count(addresses)
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if order == 'ASC':
+            rows.reverse()
+
+        emails = []
+        for row, archived in rows:
+            emails.append({
+                'uid': row['uid'],
+                'to': row['to_addr'],
+                'from': row['from_addr'],
+                'subject': row['subject'],
+                'date': row['received_at'],
+                'has_html': bool(row['has_html']),
+                'archived': archived
+            })
+        return emails, has_more, total
+
+    def _page_sql(self, schema, addresses, cond, order, params, n):
+        # One range scan per address on the covering list index, merged and
+        # cut to the page; cost depends on the page size, not on the position,
+        # and no table or body pages are read.
+        arm = f'''
+            SELECT * FROM (
+                SELECT uid, to_addr, from_addr, subject, received_at,
+                       html_hash IS NOT NULL AS has_html
+                FROM {schema}.emails WHERE to_addr = ? {cond}
+                ORDER BY uid {order} LIMIT ?
+            )
+        '''
+        sql = ' UNION ALL '.join(arm for _ in addresses) + f' ORDER BY uid {order} LIMIT ?'
+        sql_params = []
+        for addr in addresses:
+            sql_params.extend([addr, *params, n])
+        sql_params.append(n)
+        return sql, sql_params
+
+    def _count_for_addresses(self, conn, addresses):
+        placeholders = ','.join('?' for _ in addresses)
+        return conn.execute(
+            f'SELECT COALESCE(SUM(email_count), 0) FROM alias_counters WHERE address IN ({placeholders})',
+            list(addresses)
+        ).fetchone()[0]
+
+    def get_emails_for_alias(self, email_addr, limit=10, before_uid=None, after_uid=None, with_total=False):
+        return self.get_emails_page([email_addr], limit, before_uid, after_uid, with_total)
+
+    def get_email_meta(self, uid):
+        """Header fields of one email, without reading its bodies. Falls back to the archives."""
+        sql = '''
+            SELECT uid, from_addr, subject, to_addr, received_at, raw_size, truncated,
+                   html_hash IS NOT NULL AS has_html
+            FROM {schema}.emails WHERE uid = ?
+        '''
+        row, archived = self._lookup(sql, uid)
+        if row:
+            return {
+                'uid': row['uid'],
+                'from': row['from_addr'],
+                'subject': row['subject'],
+                'to_email': row['to_addr'],
+                'date': row['received_at'],
+                'has_html': bool(row['has_html']),
+                'raw_size': row['raw_size'],
+                'truncated': bool(row['truncated']),
+                'archived': archived
+            }
+        return None
 
     def get_email_by_uid(self, uid):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM emails WHERE uid = ?', (uid,))
-            row = cursor.fetchone()
-            conn.close()
-            
-            if row:
-                return {
-                    'uid': row['uid'],
-                    'from': row['from_addr'],
-                    'subject': row['subject'],
-                    'text': row['text_body'],
-                    'html': row['html_body'],
-                    'to_email': row['to_addr']
-                }
-            return None
+        sql = '''
+            SELECT e.uid, e.from_addr, e.subject, e.to_addr, e.received_at, e.raw_size, e.truncated,
+                   e.text_hash IS NULL AND e.html_hash IS NULL AND e.body_size > 0 AS body_dropped,
+                   t.codec AS text_codec, t.data AS text_data,
+                   h.codec AS html_codec, h.data AS html_data
+            FROM {schema}.emails e
+            LEFT JOIN {schema}.bodies t ON t.hash = e.text_hash
+            LEFT JOIN {schema}.bodies h ON h.hash = e.html_hash
+            WHERE e.uid = ?
+        '''
+        row, archived = self._lookup(sql, uid)
+        if row:
+            return {
+                'uid': row['uid'],
+                'from': row['from_addr'],
+                'subject': row['subject'],
+                'text': decode_text(row['text_codec'], row['text_data']) or '',
+                'html': decode_html(row['html_codec'], row['html_data']),
+                'to_email': row['to_addr'],
+                'date': row['received_at'],
+                'archived': archived,
+                'body_dropped': bool(row['body_dropped']),
+                'raw_size': row['raw_size'],
+                'truncated': bool(row['truncated'])
+            }
+        return None
 
-    def delete_email(self, uid):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            try:
-                cursor.execute('DELETE FROM emails WHERE uid = ?', (uid,))
-                conn.commit()
-                return cursor.rowcount > 0
-            except Exception as e:
-                print(f"DB Error deleting email: {e}")
-                return False
-            finally:
-                conn.close()
+    def get_attachments(self, uid):
+        """Attachments recorded for an email, in MIME order."""
+        with self._reader() as conn:
+            rows = conn.execute('''
+                SELECT uid, section, filename, content_type, encoding, size, source, uidvalidity, server_uid
+                FROM attachments WHERE uid = ?
+            ''', (uid,)).fetchall()
+        attachments = [dict(row) for row in rows]
+        # '1.10' after '1.9'
+        attachments.sort(key=lambda a: [int(n) for n in a['section'].split('.') if n.isdigit()])
+        return attachments
+
+    def get_attachment(self, uid, section):
+        for a in self.get_attachments(uid):
+            if a['section'] == section:
+                return a
+        return None
+
+    def _lookup(self, sql, uid):
+        """Runs a single-row query by uid on the main database, then on the archives that may hold it."""
+        with self._reader() as conn:
+            row = conn.execute(sql.format(schema='main'), (uid,)).fetchone()
+        if row:
+            return row, False
+        for archive in self._archives():
+            if not archive['min_uid'] <= int(uid) <= archive['max_uid']:
+                continue
+            with self._reader(attach={'arc': archive['path']}) as conn:
+                row = conn.execute(sql.format(schema='arc'), (uid,)).fetchone()
+            if row:
+                return row, True
+        return None, False
 
     def is_user_blocked(self, user_id):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT 1 FROM blocked_users WHERE user_id = ?', (user_id,))
-            row = cursor.fetchone()
-            conn.close()
-            return bool(row)
+        with self._reader() as conn:
+            row = conn.execute('SELECT 1 FROM blocked_users WHERE user_id = ?', (user_id,)).fetchone()
+        return bool(row)
 
     def block_user(self, user_id, reason=""):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('INSERT OR REPLACE INTO blocked_users (user_id, reason) VALUES (?, ?)', (user_id, reason))
-            conn.commit()
-            conn.close()
-            return True
+        with self._writer() as conn:
+            conn.execute('INSERT OR REPLACE INTO blocked_users (user_id, reason) VALUES (?, ?)', (user_id, reason))
+        return True
 
     def unblock_user(self, user_id):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM blocked_users WHERE user_id = ?', (user_id,))
-            conn.commit()
-            conn.close()
-            return True
+        with self._writer() as conn:
+            conn.execute('DELETE FROM blocked_users WHERE user_id = ?', (user_id,))
+        return True
 
     def get_all_users_stats(self):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+        with self._reader() as conn:
+            rows = conn.execute('''
+                SELECT u.user_id, u.username, u.first_name, u.last_name,
+                       COALESCE(c.alias_count, 0) AS alias_count,
+                       COALESCE(c.email_count, 0) AS email_count,
+                       b.user_id IS NOT NULL AS is_blocked
+                FROM users u
+                LEFT JOIN user_counters c ON c.user_id = u.user_id
+                LEFT JOIN blocked_users b ON b.user_id = u.user_id
+            ''').fetchall()
             
-            # Get all users from users table
-            cursor.execute('SELECT * FROM users')
-            users = cursor.fetchall()
-            
-            stats = []
-            for user in users:
-                uid = user['user_id']
-                
-                # Get aliases count
-                cursor.execute('SELECT COUNT(*) FROM aliases WHERE user_id = ?', (uid,))
-                alias_count = cursor.fetchone()[0]
-                
-                # Get total emails
-                cursor.execute('''
-                    SELECT COUNT(*) FROM emails 
-                    WHERE to_addr IN (SELECT address FROM aliases WHERE user_id = ?)
-                ''', (uid,))
-                email_count = cursor.fetchone()[0]
-                
-                # Check blocked
-                cursor.execute('SELECT 1 FROM blocked_users WHERE user_id = ?', (uid,))
-                is_blocked = bool(cursor.fetchone())
-                
-                stats.append({
-                    'user_id': uid,
-                    'username': user['username'],
-                    'first_name': user['first_name'],
-                    'last_name': user['last_name'],
-                    'alias_count': alias_count,
-                    'email_count': email_count,
-                    'is_blocked': is_blocked
-                })
-            
-            conn.close()
-            return stats
+        stats = []
+        for row in rows:
+            stats.append({
+                'user_id': row['user_id'],
+                'username': row['username'],
+                'first_name': row['first_name'],
+                'last_name': row['last_name'],
+                'alias_count': row['alias_count'],
+                'email_count': row['email_count'],
+                'is_blocked': bool(row['is_blocked'])
+            })
+        return stats
 
-    def ensure_admin_alias(self, admin_id, admin_alias="peter.gold123@yandex.ru"):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # 1. Ensure main admin alias
-            cursor.execute('SELECT 1 FROM aliases WHERE address = ?', (admin_alias,))
-            if not cursor.fetchone():
-                cursor.execute('INSERT INTO aliases (user_id, address, active) VALUES (?, ?, 1)', (admin_id, admin_alias))
-                conn.commit()
-                print(f"Restored admin alias: {admin_alias}")
-            else:
-                cursor.execute('UPDATE aliases SET user_id = ? WHERE address = ?', (admin_id, admin_alias))
-                conn.commit()
-            
-            # 2. Ensure critical aliases for all domains
-            for domain in ALLOWED_DOMAINS:
-                for local in CRITICAL_LOCAL_PARTS:
-                    critical_email = f"{local}@{domain}"
-                    cursor.execute('SELECT user_id FROM aliases WHERE address = ?', (critical_email,))
-                    row = cursor.fetchone()
-                    
-                    if not row:
-                        # Create if not exists
-                        cursor.execute('INSERT INTO aliases (user_id, address, active) VALUES (?, ?, 1)', (admin_id, critical_email))
-                        print(f"Created critical alias: {critical_email}")
-                    elif row[0] != admin_id:
-                        # Takeover if owned by someone else
-                        cursor.execute('UPDATE aliases SET user_id = ? WHERE address = ?', (admin_id, critical_email))
-                        print(f"Reclaimed critical alias: {critical_email} from {row[0]}")
-            
-            conn.commit()
-            
-            # Cleanup old incorrect alias if exists
-            incorrect_alias = "admin@dreampartners.online"
-            # We just secured admin@... so we don't want to delete it if it's in CRITICAL_LOCAL_PARTS (which it is)
-            # But let's check if there's any specific cleanup needed. 
-            # The previous code deleted it. But now we want 'admin' to be valid and owned by admin.
-            # So I will remove the deletion logic for admin@dreampartners.online
-                
-            conn.close()
+    def ensure_admin_alias(self, admin_id=ADMIN_ID, admin_alias=ADMIN_EMAIL):
+        """
+        Gives every reserved address to the admin. Guarded by a fingerprint of
+        the reservation config: when it is unchanged this is one indexed read.
+        """
+        addresses = reserved_addresses(admin_alias)
+        config = [admin_id, addresses, RESERVED_PATTERNS]
+        fingerprint = int(hashlib.sha256(json.dumps(config).encode()).hexdigest()[:15], 16)
+        with self._reader() as conn:
+            row = conn.execute("SELECT version FROM db_versions WHERE name = 'reserved_aliases'").fetchone()
+        if row and row[0] == fingerprint:
+            return
+
+        with self._writer() as conn:
+            # Create missing ones, take over those owned by someone else;
+            # rows that already belong to the admin are left untouched
+            changed = conn.execute('''
+                INSERT INTO aliases (address, user_id, active)
+                SELECT value, ?, 1 FROM json_each(?) WHERE true
+                ON CONFLICT (address) DO UPDATE SET user_id = excluded.user_id
+                WHERE aliases.user_id IS NOT excluded.user_id
+            ''', (admin_id, json.dumps(addresses))).rowcount
+            if RESERVED_PATTERNS:
+                globs = ' OR '.join('address GLOB ?' for _ in RESERVED_PATTERNS)
+                changed += conn.execute(
+                    f'UPDATE aliases SET user_id = ? WHERE user_id IS NOT ? AND ({globs})',
+                    (admin_id, admin_id, *RESERVED_PATTERNS)
+                ).rowcount
+            conn.execute('''
+                INSERT INTO db_versions (name, version) VALUES ('reserved_aliases', ?)
+                ON CONFLICT (name) DO UPDATE SET version = excluded.version
+            ''', (fingerprint,))
+        if changed:
+            print(f"Reserved aliases: {changed} created or reclaimed")
+        self._invalidate_routes()
+
+    def _reset_reserved(self, conn):
+        # Makes the next ensure_admin_alias() re-apply the reservations
+        conn.execute("DELETE FROM db_versions WHERE name = 'reserved_aliases'")
 
     def get_user_details_admin(self, user_id):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
+        with self._reader() as conn:
             cursor = conn.cursor()
             
             # Get user info
-            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            cursor.execute('SELECT username, first_name, last_name FROM users WHERE user_id = ?', (user_id,))
             user_info = cursor.fetchone()
 
             # Aliases
-            cursor.execute('SELECT * FROM aliases WHERE user_id = ?', (user_id,))
+            cursor.execute('SELECT address, active, created_at FROM aliases WHERE user_id = ?', (user_id,))
             aliases = []
             for row in cursor.fetchall():
                 aliases.append({
@@ -398,69 +1497,44 @@ class EmailDatabase:
             cursor.execute('SELECT 1 FROM blocked_users WHERE user_id = ?', (user_id,))
             is_blocked = bool(cursor.fetchone())
             
-            conn.close()
-            return {
-                'user_id': user_id,
-                'username': user_info['username'] if user_info else None,
-                'first_name': user_info['first_name'] if user_info else None,
-                'last_name': user_info['last_name'] if user_info else None,
-                'aliases': aliases,
-                'is_blocked': is_blocked
-            }
-
-    def get_user_emails_admin(self, user_id, limit=50, offset=0):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT * FROM emails 
-                WHERE to_addr IN (SELECT address FROM aliases WHERE user_id = ?)
-                ORDER BY uid DESC 
-                LIMIT ? OFFSET ?
-            ''', (user_id, limit, offset))
-            
-            emails = []
-            for row in cursor.fetchall():
-                emails.append({
-                    'uid': row['uid'],
-                    'to': row['to_addr'],
-                    'from': row['from_addr'],
-                    'subject': row['subject'],
-                    'date': row['received_at']
-                })
-                
-            cursor.execute('''
-                SELECT COUNT(*) FROM emails 
-                WHERE to_addr IN (SELECT address FROM aliases WHERE user_id = ?)
-            ''', (user_id,))
-            total = cursor.fetchone()[0]
-            
-            conn.close()
-            return emails, total
+        return {
+            'user_id': user_id,
+            'username': user_info['username'] if user_info else None,
+            'first_name': user_info['first_name'] if user_info else None,
+            'last_name': user_info['last_name'] if user_info else None,
+            'aliases': aliases,
+            'is_blocked': is_blocked
+        }
 
+    def get_user_emails_admin(self, user_id, limit=50, before_uid=None, with_total=False):
+        with self._reader() as conn:
+            rows = conn.execute('SELECT address FROM aliases WHERE user_id = ?', (user_id,)).fetchall()
+        return self.get_emails_page([row['address'] for row in rows], limit, before_uid,
+                                    with_total=with_total, include_archive=True)
 
     def delete_email(self, uid):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            try:
-                cursor.execute('DELETE FROM emails WHERE uid = ?', (uid,))
-                rows = cursor.rowcount
-                conn.commit()
-                return rows > 0
-            except Exception as e:
-                print(f"DB Error deleting email: {e}")
-                return False
-            finally:
-                conn.close()
+        try:
+            with self._writer() as conn:
+                cursor = conn.execute('DELETE FROM emails WHERE uid = ?', (uid,))
+                self._gc_bodies(conn)
+            if cursor.rowcount:
+                return True
+            archives = [a for a in self._archives() if a['min_uid'] <= int(uid) <= a['max_uid']]
+            return self._delete_archived(archives, 'e.uid = ?', (uid,)) > 0
+        except Exception as e:
+            print(f"DB Error deleting email: {e}")
+            return False
 
     def delete_user_data(self, user_id):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            try:
+        try:
+            with self._reader() as conn:
+                addresses = [row[0] for row in conn.execute('SELECT address FROM aliases WHERE user_id = ?', (user_id,))]
+            if addresses:
+                self._delete_archived(self._archives(), 'e.to_addr IN (SELECT value FROM json_each(?))',
+                                      (json.dumps(addresses),))
+
+            with self._writer() as conn:
+                cursor = conn.cursor()
                 # Delete emails
                 cursor.execute('''
                     DELETE FROM emails 
@@ -475,29 +1549,824 @@ class EmailDatabase:
                 
                 # Delete from users
                 cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+                cursor.execute('DELETE FROM user_counters WHERE user_id = ?', (user_id,))
+                self._reset_reserved(conn)
+                self._gc_bodies(conn)
                 
-                conn.commit()
-                return True
-            except Exception as e:
-                print(f"Error deleting user: {e}")
-                return False
-            finally:
-                conn.close()
+            self._invalidate_routes()
+            return True
+        except Exception as e:
+            print(f"Error deleting user: {e}")
+            return False
 
-    def get_last_uid(self):
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute('SELECT MAX(uid) FROM emails')
-            result = cursor.fetchone()[0]
-            conn.close()
-            return result if result else 0
+    # --- Retention and archives ---
 
-    def delete_email(self, uid):
-        # Optional: if we want to allow deleting from local DB
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
+    def _create_retention(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS retention_policies (
+                scope TEXT PRIMARY KEY,
+                hot_days INTEGER,
+                body_days INTEGER
+            )
+        ''')
+        # Catalog of archive databases; the uid range lets lookups skip files
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive_months (
+                month TEXT PRIMARY KEY,
+                min_uid INTEGER,
+                max_uid INTEGER,
+                email_count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+    def set_retention_policy(self, scope, hot_days=None, body_days=None):
+        """
+        Sets the policy for an alias, or the default with scope '*'. A value
+        of None falls back to the default, 0 keeps mail forever.
+        """
+        with self._writer() as conn:
+            conn.execute('''
+                INSERT INTO retention_policies (scope, hot_days, body_days) VALUES (?, ?, ?)
+                ON CONFLICT (scope) DO UPDATE SET hot_days = excluded.hot_days, body_days = excluded.body_days
+            ''', (scope.lower().strip(), hot_days, body_days))
+
+    def delete_retention_policy(self, scope):
+        with self._writer() as conn:
+            cursor = conn.execute('DELETE FROM retention_policies WHERE scope = ?', (scope.lower().strip(),))
+            return cursor.rowcount > 0
+
+    def get_retention_policies(self):
+        with self._reader() as conn:
+            rows = conn.execute('SELECT scope, hot_days, body_days FROM retention_policies').fetchall()
+        return {row['scope']: {'hot_days': row['hot_days'], 'body_days': row['body_days']} for row in rows}
+
+    def _retention_cutoffs(self, field):
+        """
+        Resolves `field` ('hot_days' or 'body_days') of all policies into
+        received_at cutoffs. Returns (cutoff_for(address), latest cutoff);
+        the latest is None when no policy applies.
+        """
+        policies = self.get_retention_policies()
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        def cutoff(days):
+            if not days:
+                return None
+            return (now - datetime.timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+        default_days = policies.get(RETENTION_GLOBAL, {}).get(field)
+        default = cutoff(default_days)
+        overrides = {
+            scope: cutoff(policy[field] if policy[field] is not None else default_days)
+            for scope, policy in policies.items() if scope != RETENTION_GLOBAL
+        }
+        cutoffs = [c for c in (default, *overrides.values()) if c]
+
+        def cutoff_for(address):
+            return overrides[address] if address in overrides else default
+        return cutoff_for, (max(cutoffs) if cutoffs else None)
+
+    def _expired(self, conn, schema, cutoff_for, latest, chunk_size, extra=''):
+        """Yields chunks of rows past their alias's cutoff, oldest first."""
+        last = ('', -1)
+        while True:
+            rows = conn.execute(f'''
+                SELECT uid, to_addr, received_at FROM {schema}.emails
+                WHERE received_at < ? AND (received_at, uid) > (?, ?) {extra}
+                ORDER BY received_at, uid LIMIT ?
+            ''', (latest, *last, chunk_size)).fetchall()
+            if not rows:
+                return
+            last = (rows[-1]['received_at'], rows[-1]['uid'])
+            due = []
+            for row in rows:
+                limit = cutoff_for(row['to_addr'])
+                if limit and row['received_at'] < limit:
+                    due.append(row)
+            if due:
+                yield due
+
+    def _archive_path(self, month):
+        stem = os.path.splitext(os.path.basename(self.db_path))[0]
+        return os.path.join(self.archive_dir, f'{stem}-{month}.db')
+
+    def _archives(self, newest_first=True):
+        """Archive databases from the catalog: [{'month', 'path', 'min_uid', 'max_uid', 'email_count'}]."""
+        order = 'DESC' if newest_first else 'ASC'
+        with self._reader() as conn:
+            rows = conn.execute(f'''
+                SELECT month, min_uid, max_uid, email_count FROM archive_months
+                WHERE email_count > 0 ORDER BY max_uid {order}
+            ''').fetchall()
+        archives = []
+        for row in rows:
+            path = self._archive_path(row['month'])
+            # Never ATTACH a missing file: that would create an empty one
+            if os.path.exists(path):
+                archives.append({**dict(row), 'path': path})
+        return archives
+
+    def _init_archive(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path)
+        try:
             cursor = conn.cursor()
-            cursor.execute('DELETE FROM emails WHERE uid = ?', (uid,))
+            self._create_emails_table(cursor, 'emails')
+            self._create_message_size(cursor)
+            self._create_email_indexes(cursor)
+            # No refcount triggers here: unreferenced bodies are found through these
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_text_hash ON emails (text_hash)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_html_hash ON emails (html_hash)')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bodies (
+                    hash TEXT PRIMARY KEY,
+                    codec TEXT,
+                    data BLOB,
+                    size INTEGER NOT NULL
+                )
+            ''')
+            self._create_fts_table(cursor)
             conn.commit()
+        finally:
             conn.close()
+
+    def _update_archive_catalog(self, conn, month):
+        # Called inside a writer transaction with the archive attached as arc
+        count, min_uid, max_uid = conn.execute('SELECT COUNT(*), MIN(uid), MAX(uid) FROM arc.emails').fetchone()
+        conn.execute('''
+            INSERT INTO archive_months (month, min_uid, max_uid, email_count) VALUES (?, ?, ?, ?)
+            ON CONFLICT (month) DO UPDATE SET min_uid = excluded.min_uid, max_uid = excluded.max_uid,
+                                              email_count = excluded.email_count
+        ''', (month, min_uid, max_uid, count))
+
+    def archive_expired_emails(self, chunk_size=500, progress=None):
+        """
+        Moves emails past their hot_days into the monthly archive databases,
+        a chunk per transaction. Counters and list totals of the main
+        database cover hot mail only. Returns the number of emails moved.
+        """
+        cutoff_for, latest = self._retention_cutoffs('hot_days')
+        if not latest:
+            return 0
+        moved = 0
+        with self._reader() as conn:
+            for due in self._expired(conn, 'main', cutoff_for, latest, chunk_size):
+                by_month = {}
+                for row in due:
+                    by_month.setdefault(row['received_at'][:7], []).append(row['uid'])
+                for month, uids in by_month.items():
+                    moved += self._move_to_archive(month, uids)
+                if progress:
+                    progress(moved)
+        return moved
+
+    def _move_to_archive(self, month, uids):
+        path = self._archive_path(month)
+        self._init_archive(path)
+        params = (json.dumps(uids),)
+        chunk = 'SELECT value FROM json_each(?)'
+
+        # Copy and delete are separate transactions (WAL gives no atomic
+        # commit across files). After a crash in between the copy is skipped
+        # for rows the archive already has, and the delete is redone.
+        with self._writer(attach={'arc': path}) as conn:
+            conn.execute(f'''
+                INSERT OR IGNORE INTO arc.bodies (hash, codec, data, size)
+                SELECT hash, codec, data, size FROM main.bodies
+                WHERE hash IN (SELECT text_hash FROM main.emails WHERE uid IN ({chunk})
+                               UNION SELECT html_hash FROM main.emails WHERE uid IN ({chunk}))
+            ''', params * 2)
+            conn.execute(f'''
+                INSERT INTO arc.emails_fts (rowid, subject, from_addr, text_body)
+                SELECT e.uid, {_fts_values_sql('e')} FROM main.emails e
+                WHERE e.uid IN ({chunk}) AND e.uid NOT IN (SELECT uid FROM arc.emails)
+            ''', params)
+            conn.execute(f'''
+                INSERT OR IGNORE INTO arc.emails (uid, owner_id, to_addr, from_addr, subject, received_at,
+                                                  text_hash, html_hash, body_size, raw_size, truncated)
+                SELECT uid, owner_id, to_addr, from_addr, subject, received_at,
+                       text_hash, html_hash, body_size, raw_size, truncated
+                FROM main.emails WHERE uid IN ({chunk})
+            ''', params)
+            self._update_archive_catalog(conn, month)
+
+        with self._writer() as conn:
+            cursor = conn.execute(f'DELETE FROM emails WHERE uid IN ({chunk})', params)
+            self._gc_bodies(conn)
+        return cursor.rowcount
+
+    def drop_expired_bodies(self, chunk_size=500, progress=None):
+        """
+        Drops the bodies of emails past their body_days, hot and archived;
+        headers stay searchable. Returns the number of emails affected.
+        """
+        cutoff_for, latest = self._retention_cutoffs('body_days')
+        if not latest:
+            return 0
+        with_body = 'AND (text_hash IS NOT NULL OR html_hash IS NOT NULL)'
+        dropped = 0
+        with self._reader() as conn:
+            for due in self._expired(conn, 'main', cutoff_for, latest, chunk_size, with_body):
+                with self._writer() as w:
+                    # body_size is kept: no hashes but a size means dropped
+                    w.execute('''
+                        UPDATE emails SET text_hash = NULL, html_hash = NULL
+                        WHERE uid IN (SELECT value FROM json_each(?))
+                    ''', (json.dumps([row['uid'] for row in due]),))
+                    self._gc_bodies(w)
+                dropped += len(due)
+                if progress:
+                    progress(dropped)
+
+        for archive in self._archives():
+            if archive['month'] > latest[:7]:
+                continue
+            with self._reader(attach={'arc': archive['path']}) as conn:
+                for due in self._expired(conn, 'arc', cutoff_for, latest, chunk_size, with_body):
+                    dropped += self._drop_archived_bodies(archive['path'], [row['uid'] for row in due])
+                    if progress:
+                        progress(dropped)
+        return dropped
+
+    def _drop_archived_bodies(self, path, uids):
+        params = (json.dumps(uids),)
+        chunk = 'SELECT value FROM json_each(?)'
+        with self._writer(attach={'arc': path}) as conn:
+            hashes = set()
+            for text_hash, html_hash in conn.execute(
+                    f'SELECT text_hash, html_hash FROM arc.emails WHERE uid IN ({chunk})', params):
+                hashes.update(h for h in (text_hash, html_hash) if h)
+            # Contentless index: an entry is removed with the values it was
+            # indexed with, then added back without the body text
+            conn.execute(f'''
+                INSERT INTO arc.emails_fts (emails_fts, rowid, subject, from_addr, text_body)
+                SELECT 'delete', e.uid, {_fts_values_sql('e', bodies='arc.bodies')}
+                FROM arc.emails e WHERE e.uid IN ({chunk})
+            ''', params)
+            conn.execute(f'UPDATE arc.emails SET text_hash = NULL, html_hash = NULL WHERE uid IN ({chunk})', params)
+            conn.execute(f'''
+                INSERT INTO arc.emails_fts (rowid, subject, from_addr, text_body)
+                SELECT e.uid, {_fts_values_sql('e', bodies='arc.bodies')}
+                FROM arc.emails e WHERE e.uid IN ({chunk})
+            ''', params)
+            self._gc_archived_bodies(conn, hashes)
+        return len(uids)
+
+    def _gc_archived_bodies(self, conn, hashes):
+        conn.execute('''
+            DELETE FROM arc.bodies
+            WHERE hash IN (SELECT value FROM json_each(?))
+              AND NOT EXISTS (SELECT 1 FROM arc.emails WHERE text_hash = bodies.hash)
+              AND NOT EXISTS (SELECT 1 FROM arc.emails WHERE html_hash = bodies.hash)
+        ''', (json.dumps(sorted(hashes)),))
+
+    def _delete_archived(self, archives, where, params):
+        """Deletes archived emails matching `where` (on alias e) from the given archives. Returns rows deleted."""
+        deleted = 0
+        for archive in archives:
+            with self._writer(attach={'arc': archive['path']}) as conn:
+                rows = conn.execute(
+                    f'SELECT uid, text_hash, html_hash FROM arc.emails e WHERE {where}', params
+                ).fetchall()
+                if not rows:
+                    continue
+                uids = (json.dumps([row['uid'] for row in rows]),)
+                conn.execute(f'''
+                    INSERT INTO arc.emails_fts (emails_fts, rowid, subject, from_addr, text_body)
+                    SELECT 'delete', e.uid, {_fts_values_sql('e', bodies='arc.bodies')}
+                    FROM arc.emails e WHERE e.uid IN (SELECT value FROM json_each(?))
+                ''', uids)
+                conn.execute('DELETE FROM arc.emails WHERE uid IN (SELECT value FROM json_each(?))', uids)
+                self._gc_archived_bodies(conn, {h for row in rows for h in (row['text_hash'], row['html_hash']) if h})
+                self._update_archive_catalog(conn, archive['month'])
+            deleted += len(rows)
+        return deleted
+
+    def _archived_count(self, addresses):
+        total = 0
+        for archive in self._archives():
+            with self._reader(attach={'arc': archive['path']}) as conn:
+                total += conn.execute(
+                    'SELECT COUNT(*) FROM arc.emails WHERE to_addr IN (SELECT value FROM json_each(?))',
+                    (json.dumps(list(addresses)),)
+                ).fetchone()[0]
+        return total
+
+    def apply_retention(self, chunk_size=500, progress=None):
+        """Runs every retention step. Returns {'archived': n, 'bodies_dropped': n}."""
+        return {
+            'archived': self.archive_expired_emails(chunk_size, progress),
+            'bodies_dropped': self.drop_expired_bodies(chunk_size, progress)
+        }
+
+    def vacuum(self):
+        """Gives the pages freed by retention back to the filesystem."""
+        with self.lock:
+            if self._write_conn is None:
+                self._write_conn = self._open()
+            self._write_conn.execute('VACUUM')
+
+    def recompress_bodies(self, codec=None, chunk_size=500, progress=None):
+        """
+        Rewrites stored bodies with `codec` (default: this instance's codec;
+        'none' decompresses). Works in rowid order, one short transaction per
+        chunk, so the bot and web app keep running. Returns the number of
+        bodies rewritten.
+        """
+        codec = codec or self.body_codec
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError("zstd needs the zstandard package")
+        last_rowid = 0
+        changed = 0
+        while True:
+            with self._reader() as conn:
+                rows = conn.execute('''
+                    SELECT rowid, hash, codec, data FROM bodies
+                    WHERE rowid > ? ORDER BY rowid LIMIT ?
+                ''', (last_rowid, chunk_size)).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1]['rowid']
+
+            updates = []
+            for row in rows:
+                data = decode_html(row['codec'], row['data'])
+                new_codec, stored = encode_body(codec, data)
+                if new_codec != row['codec']:
+                    updates.append((new_codec, stored, row['hash']))
+            if updates:
+                with self._writer() as conn:
+                    conn.executemany('UPDATE bodies SET codec = ?, data = ? WHERE hash = ?', updates)
+                changed += len(updates)
+            if progress:
+                progress(last_rowid, changed)
+        return changed
+
+    def body_storage_report(self):
+        """
+        Space used by message bodies: original vs stored bytes per codec, and
+        how much deduplication saves (bytes referenced by emails vs unique).
+        """
+        with self._reader() as conn:
+            rows = conn.execute('''
+                SELECT COALESCE(codec, 'none') AS codec, COUNT(*) AS bodies,
+                       SUM(size) AS original, SUM(LENGTH(data)) AS stored,
+                       SUM(refcount) AS refs, SUM(size * refcount) AS referenced
+                FROM bodies GROUP BY 1
+            ''').fetchall()
+        by_codec = {row['codec']: {'bodies': row['bodies'], 'original': row['original'] or 0,
+                                   'stored': row['stored'] or 0} for row in rows}
+        original = sum(c['original'] for c in by_codec.values())
+        stored = sum(c['stored'] for c in by_codec.values())
+        unique = sum(row['bodies'] for row in rows)
+        refs = sum(row['refs'] or 0 for row in rows)
+        referenced = sum(row['referenced'] or 0 for row in rows)
+        return {
+            'by_codec': by_codec,
+            'original_bytes': original,
+            'stored_bytes': stored,
+            'saved_bytes': original - stored,
+            'ratio': (stored / original) if original else 1.0,
+            'unique_bodies': unique,
+            'body_references': refs,
+            'referenced_bytes': referenced,
+            'dedup_ratio': (referenced / original) if original else 1.0
+        }
+
+    def get_last_uid(self):
+        with self._reader() as conn:
+            result = conn.execute('SELECT MAX(uid) FROM emails').fetchone()[0]
+        return result if result else 0
+
+    def get_last_received_at(self, source=None):
+        """received_at of the newest stored email, of one source if given."""
+        with self._reader() as conn:
+            if source is None:
+                row = conn.execute('SELECT received_at FROM emails ORDER BY uid DESC LIMIT 1').fetchone()
+            else:
+                row = conn.execute(
+                    'SELECT received_at FROM emails WHERE source = ? ORDER BY uid DESC LIMIT 1', (source,)
+                ).fetchone()
+        return row[0] if row else None
+
+    def has_similar_email(self, to_addr, from_addr, subject, since):
+        """True if a message with the same headers was stored at or after `since` (resync dedup)."""
+        with self._reader() as conn:
+            row = conn.execute('''
+                SELECT 1 FROM emails
+                WHERE to_addr = ? AND from_addr IS ? AND subject IS ? AND received_at >= ?
+                LIMIT 1
+            ''', (to_addr, from_addr, subject, since)).fetchone()
+        return bool(row)
+
+    def get_sync_state(self, source):
+        with self._reader() as conn:
+            row = conn.execute('''
+                SELECT uidvalidity, last_uid, first_uid, highest_modseq, gap_floor FROM sync_state WHERE source = ?
+            ''', (source,)).fetchone()
+        return dict(row) if row else None
+
+    def save_sync_state(self, source, uidvalidity, last_uid, first_uid, highest_modseq=None, gap_floor=None):
+        """Saves the position; gap_floor is only replaced when given."""
+        with self._writer() as conn:
+            conn.execute('''
+                INSERT INTO sync_state (source, uidvalidity, last_uid, first_uid, highest_modseq, gap_floor, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (source) DO UPDATE SET
+                    uidvalidity = excluded.uidvalidity, last_uid = excluded.last_uid,
+                    first_uid = excluded.first_uid, highest_modseq = excluded.highest_modseq,
+                    gap_floor = COALESCE(excluded.gap_floor, sync_state.gap_floor),
+                    updated_at = excluded.updated_at
+            ''', (source, uidvalidity, last_uid, first_uid, highest_modseq, gap_floor))
+
+    def known_server_uids(self, source, uidvalidity, uid_lo, uid_hi):
+        """
+        Server uids uid_lo..uid_hi of the source that are stored, or were
+        and got deleted or archived, as (lo, hi) runs of consecutive uids.
+        """
+        with self._reader() as conn:
+            rows = conn.execute('''
+                WITH known (u) AS (
+                    SELECT server_uid FROM emails
+                    WHERE source = ?1 AND uidvalidity = ?2 AND server_uid BETWEEN ?3 AND ?4
+                    UNION
+                    SELECT server_uid FROM removed_messages
+                    WHERE source = ?1 AND uidvalidity = ?2 AND server_uid BETWEEN ?3 AND ?4
+                )
+                SELECT MIN(u), MAX(u) FROM (SELECT u, u - ROW_NUMBER() OVER (ORDER BY u) AS run FROM known)
+                GROUP BY run ORDER BY 1
+            ''', (source, uidvalidity, uid_lo, uid_hi)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def save_gap_report(self, source, uidvalidity, gaps, recovered):
+        """Records a reconciler pass, and forgets removed messages it will not look at again."""
+        with self._writer() as conn:
+            conn.execute('''
+                UPDATE sync_state SET gaps = ?, gaps_recovered = gaps_recovered + ?,
+                                      gaps_checked_at = CURRENT_TIMESTAMP
+                WHERE source = ? AND uidvalidity = ?
+            ''', (gaps, recovered, source, uidvalidity))
+            conn.execute('''
+                DELETE FROM removed_messages WHERE source = ?1 AND (uidvalidity != ?2 OR server_uid < (
+                    SELECT COALESCE(gap_floor, 0) FROM sync_state WHERE source = ?1))
+            ''', (source, uidvalidity))
+
+    def set_gap_floor(self, source, gap_floor):
+        """Where the reconciler starts looking; False if the source has no sync position."""
+        with self._writer() as conn:
+            return conn.execute('UPDATE sync_state SET gap_floor = ? WHERE source = ?',
+                                (gap_floor, source)).rowcount > 0
+
+    def gap_status(self):
+        """{source: {'gap_floor', 'last_uid', 'gaps', 'gaps_recovered', 'gaps_checked_at'}}"""
+        with self._reader() as conn:
+            rows = conn.execute('''
+                SELECT source, gap_floor, last_uid, gaps, gaps_recovered, gaps_checked_at FROM sync_state
+            ''').fetchall()
+        return {row['source']: dict(row) for row in rows}
+
+    def get_sources(self):
+        """Every source with a sync position: {source: sync_state dict}."""
+        with self._reader() as conn:
+            rows = conn.execute(
+                'SELECT source, uidvalidity, last_uid, first_uid, highest_modseq FROM sync_state'
+            ).fetchall()
+        return {row['source']: dict(row) for row in rows}
+
+    def adopt_legacy_source(self, source, legacy='INBOX'):
+        """
+        Moves a single-mailbox database onto the source key: the sync position,
+        backfill job and attachments kept under `legacy` are renamed, and the
+        emails of the current UIDVALIDITY get their (source, server uid) key.
+        A database from before sync_state gets a position at its newest uid,
+        which back then was the server's. Returns True if anything moved.
+        """
+        with self._writer() as conn:
+            if conn.execute('SELECT 1 FROM sync_state WHERE source = ?', (source,)).fetchone():
+                return False
+            state = conn.execute(
+                'SELECT uidvalidity, uid_offset FROM sync_state WHERE source = ?', (legacy,)
+            ).fetchone()
+            if state is None:
+                if conn.execute('SELECT 1 FROM sync_state LIMIT 1').fetchone():
+                    return False
+                lo, hi = conn.execute('SELECT MIN(uid), MAX(uid) FROM emails').fetchone()
+                if hi is None:
+                    return False
+                # No UIDVALIDITY yet; MailboxSync takes the server's on first contact.
+                # These emails have no server key, so the reconciler starts above them
+                conn.execute('''
+                    INSERT INTO sync_state (source, uidvalidity, last_uid, first_uid, gap_floor)
+                    VALUES (?, NULL, ?, ?, ?)
+                ''', (source, hi, lo, hi + 1))
+                return True
+            for table in ('sync_state', 'backfill_jobs', 'backfill_ranges', 'attachments'):
+                conn.execute(f'UPDATE {table} SET source = ? WHERE source = ?', (source, legacy))
+            if state['uidvalidity'] is not None:
+                conn.execute('''
+                    UPDATE emails SET source = ?, uidvalidity = ?, server_uid = uid - ?
+                    WHERE source IS NULL AND uid > ?
+                ''', (source, state['uidvalidity'], state['uid_offset'], state['uid_offset']))
+        return True
+
+
+    # --- History backfill ---
+
+    def _create_backfill(self, cursor):
+        # One job per mailbox: server uids up to uid_hi were planned into
+        # ranges; a range is checkpointed once all its messages are stored.
+        # History gets the local uids server uid + uid_offset, a block
+        # reserved below everything stored when the job is planned.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS backfill_jobs (
+                source TEXT PRIMARY KEY,
+                uidvalidity INTEGER,
+                uid_hi INTEGER NOT NULL,
+                planned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP,
+                uid_offset INTEGER
+            )
+        ''')
+        if 'uid_offset' not in self._columns(cursor, 'backfill_jobs'):
+            cursor.execute('ALTER TABLE backfill_jobs ADD COLUMN uid_offset INTEGER')
+            # Jobs planned by the single-mailbox sync used its offset
+            cursor.execute('''
+                UPDATE backfill_jobs SET uid_offset = COALESCE(
+                    (SELECT s.uid_offset FROM sync_state s WHERE s.source = backfill_jobs.source), 0)
+            ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS backfill_ranges (
+                source TEXT NOT NULL,
+                uid_lo INTEGER NOT NULL,
+                uid_hi INTEGER NOT NULL,
+                message_count INTEGER NOT NULL,
+                stored INTEGER NOT NULL DEFAULT 0,
+                done_at TIMESTAMP,
+                PRIMARY KEY (source, uid_lo)
+            ) WITHOUT ROWID
+        ''')
+
+    def get_backfill_job(self, source):
+        with self._reader() as conn:
+            row = conn.execute('''
+                SELECT uidvalidity, uid_hi, uid_offset, planned_at, finished_at FROM backfill_jobs
+                WHERE source = ?
+            ''', (source,)).fetchone()
+        return dict(row) if row else None
+
+    def plan_backfill(self, source, uidvalidity, uid_hi, ranges):
+        """
+        Records a backfill job with its (uid_lo, uid_hi, message_count) ranges,
+        replacing any earlier job for the mailbox. Server uids 1..uid_hi get a
+        block of local uids below every stored message and every block
+        reserved before, this mailbox's earlier ones included. Returns the
+        job's uid_offset; raises ValueError when the block would not fit
+        above uid 0.
+        """
+        with self._writer() as conn:
+            floor = conn.execute('''
+                SELECT MIN(m) FROM (SELECT version AS m FROM db_versions WHERE name = 'history_uid'
+                                    UNION ALL SELECT MIN(uid) FROM emails
+                                    UNION ALL SELECT MIN(min_uid) FROM archive_months)
+            ''').fetchone()[0]
+            uid_offset = floor - 1 - uid_hi
+            if uid_hi > 0:
+                if uid_offset < 0:
+                    raise ValueError(f'no room for {uid_hi} history uids of {source} below local uid {floor}')
+                conn.execute("UPDATE db_versions SET version = ? WHERE name = 'history_uid'", (uid_offset + 1,))
+            conn.execute('DELETE FROM backfill_ranges WHERE source = ?', (source,))
+            conn.execute('''
+                INSERT OR REPLACE INTO backfill_jobs (source, uidvalidity, uid_hi, uid_offset, finished_at)
+                VALUES (?, ?, ?, ?, CASE WHEN ? THEN NULL ELSE CURRENT_TIMESTAMP END)
+            ''', (source, uidvalidity, uid_hi, uid_offset, bool(ranges)))
+            conn.executemany('''
+                INSERT INTO backfill_ranges (source, uid_lo, uid_hi, message_count) VALUES (?, ?, ?, ?)
+            ''', [(source, lo, hi, count) for lo, hi, count in ranges])
+        return uid_offset
+
+    def get_backfill_ranges(self, source, pending_only=True):
+        """Ranges of the mailbox's job, newest first."""
+        with self._reader() as conn:
+            rows = conn.execute(f'''
+                SELECT uid_lo, uid_hi, message_count, stored, done_at FROM backfill_ranges
+                WHERE source = ? {'AND done_at IS NULL' if pending_only else ''}
+                ORDER BY uid_lo DESC
+            ''', (source,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def complete_backfill_range(self, source, uid_lo, stored):
+        """Checkpoints a range; the job is finished with its last range."""
+        with self._writer() as conn:
+            conn.execute('''
+                UPDATE backfill_ranges SET stored = ?, done_at = CURRENT_TIMESTAMP
+                WHERE source = ? AND uid_lo = ?
+            ''', (stored, source, uid_lo))
+            conn.execute('''
+                UPDATE backfill_jobs SET finished_at = CURRENT_TIMESTAMP
+                WHERE source = ? AND finished_at IS NULL
+                  AND NOT EXISTS (SELECT 1 FROM backfill_ranges WHERE source = ? AND done_at IS NULL)
+            ''', (source, source))
+
+    def backfill_progress(self, source):
+        with self._reader() as conn:
+            row = conn.execute('''
+                SELECT COUNT(*) AS ranges, COUNT(done_at) AS ranges_done,
+                       COALESCE(SUM(message_count), 0) AS messages,
+                       COALESCE(SUM(CASE WHEN done_at IS NOT NULL THEN message_count END), 0) AS messages_done,
+                       COALESCE(SUM(stored), 0) AS stored
+                FROM backfill_ranges WHERE source = ?
+            ''', (source,)).fetchone()
+        return dict(row)
+
+    # --- Notification outbox ---
+
+    def claim_notification(self, uid):
+        """
+        Takes a just-stored email's notification for its first send. Returns
+        the chat id, or None if there is none or the outbox worker has it.
+        """
+        with self._writer() as conn:
+            row = conn.execute(
+                "SELECT chat_id FROM outbox WHERE uid = ? AND state = 'pending' AND attempts = 0", (uid,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE outbox SET attempts = 1, next_attempt = ? WHERE uid = ?',
+                         (time.time() + OUTBOX_LEASE, uid))
+        return row['chat_id']
+
+    def claim_notifications(self, limit=50):
+        """Due notifications, leased to the caller: [{uid, chat_id, attempts}], attempts counting this one."""
+        now = time.time()
+        with self._writer() as conn:
+            rows = conn.execute('''
+                SELECT uid, chat_id, attempts + 1 AS attempts FROM outbox
+                WHERE state = 'pending' AND next_attempt <= ?
+                ORDER BY next_attempt LIMIT ?
+            ''', (now, limit)).fetchall()
+            conn.executemany('UPDATE outbox SET attempts = ?, next_attempt = ? WHERE uid = ?',
+                             [(row['attempts'], now + OUTBOX_LEASE, row['uid']) for row in rows])
+        return [dict(row) for row in rows]
+
+    def complete_notification(self, uid, message_id):
+        with self._writer() as conn:
+            conn.execute('''
+                UPDATE outbox SET state = 'sent', message_id = ?, last_error = NULL, sent_at = CURRENT_TIMESTAMP
+                WHERE uid = ?
+            ''', (message_id, uid))
+
+    def retry_notification(self, uid, error, delay=None, counted=True):
+        """
+        Schedules another attempt in `delay` seconds; without one the
+        notification is marked failed. An attempt that is not `counted`
+        (Telegram's rate limit) is given back.
+        """
+        with self._writer() as conn:
+            if delay is None:
+                conn.execute("UPDATE outbox SET state = 'failed', last_error = ? WHERE uid = ?", (error, uid))
+            else:
+                conn.execute('''
+                    UPDATE outbox SET next_attempt = ?, last_error = ?,
+                                      attempts = CASE WHEN ? THEN attempts ELSE MAX(attempts - 1, 0) END
+                    WHERE uid = ?
+                ''', (time.time() + delay, error, counted, uid))
+
+    def release_notifications(self):
+        """
+        On start: drops the leases of the previous run, so every pending
+        notification is due now. Returns how many are pending.
+        """
+        with self._writer() as conn:
+            conn.execute("UPDATE outbox SET next_attempt = 0 WHERE state = 'pending' AND next_attempt > 0")
+            return conn.execute("SELECT COUNT(*) FROM outbox WHERE state = 'pending'").fetchone()[0]
+
+    def next_notification_due(self):
+        """Unix time the next pending notification is due, or None."""
+        with self._reader() as conn:
+            return conn.execute("SELECT MIN(next_attempt) FROM outbox WHERE state = 'pending'").fetchone()[0]
+
+    def outbox_status(self):
+        with self._reader() as conn:
+            counts = {row['state']: row['n'] for row in conn.execute(
+                'SELECT state, COUNT(*) AS n FROM outbox GROUP BY state')}
+            failed = [dict(row) for row in conn.execute('''
+                SELECT uid, chat_id, attempts, last_error, created_at FROM outbox
+                WHERE state = 'failed' ORDER BY uid DESC LIMIT 20
+            ''')]
+        return {'counts': counts, 'failed': failed}
+
+    def retry_failed_notifications(self):
+        """Gives the failed notifications a new round of attempts. Returns how many."""
+        with self._writer() as conn:
+            return conn.execute('''
+                UPDATE outbox SET state = 'pending', attempts = 0, next_attempt = 0 WHERE state = 'failed'
+            ''').rowcount
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="emails.db maintenance")
+    parser.add_argument('--db', default="emails.db")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('rebuild-fts', help="rebuild the full-text search index")
+    check = sub.add_parser('check-counters', help="verify the per-user/per-alias counters")
+    check.add_argument('--repair', action='store_true', help="rebuild the counters if they drifted")
+    compress = sub.add_parser('compress-bodies', help="recompress stored bodies and report the space saved")
+    compress.add_argument('--codec', choices=['zlib', 'zstd', 'none'], default='zlib')
+    compress.add_argument('--chunk', type=int, default=500)
+    sub.add_parser('body-report', help="show space used by message bodies")
+    policy = sub.add_parser('retention-policy', help="show or set retention policies")
+    policy.add_argument('scope', nargs='?', help="alias address, or '*' for the default")
+    policy.add_argument('--hot-days', type=int, help="days to keep in emails.db before archiving (0: forever)")
+    policy.add_argument('--body-days', type=int, help="days to keep bodies, headers stay (0: forever)")
+    policy.add_argument('--delete', action='store_true', help="remove the policy for scope")
+    retention = sub.add_parser('apply-retention', help="archive old emails and drop expired bodies")
+    retention.add_argument('--chunk', type=int, default=500)
+    retention.add_argument('--vacuum', action='store_true', help="shrink emails.db afterwards")
+    backfill = sub.add_parser('backfill-status', help="show history backfill progress")
+    backfill.add_argument('--source', help="account/folder, e.g. me@yandex.ru/INBOX (default: all)")
+    outbox = sub.add_parser('outbox-status', help="show Telegram notifications not delivered yet")
+    outbox.add_argument('--retry-failed', action='store_true', help="try the failed ones again on the bot's next pass")
+    gaps = sub.add_parser('gap-status', help="show messages missing from the sync (UID gaps)")
+    gaps.add_argument('--source', help="account/folder, e.g. me@yandex.ru/INBOX (default: all)")
+    gaps.add_argument('--floor', type=int,
+                      help="reconcile from this server uid up; mail deleted or archived before the "
+                           "reconciler existed is fetched again if it is below the current floor")
+    args = parser.parse_args()
+
+    db = EmailDatabase(args.db)
+    if args.command == 'rebuild-fts':
+        count = db.rebuild_search_index()
+        print(f"Search index rebuilt: {count} emails")
+    elif args.command == 'check-counters':
+        mismatches = db.check_counters(repair=args.repair)
+        for m in mismatches:
+            print(f"{m['kind']} {m['key']}: stored {m['stored']}, actual {m['actual']}")
+        if not mismatches:
+            print("Counters are consistent")
+        elif args.repair:
+            print(f"Rebuilt counters ({len(mismatches)} mismatches)")
+    elif args.command == 'compress-bodies':
+        changed = db.recompress_bodies(
+            args.codec, args.chunk,
+            progress=lambda rowid, n: print(f"  up to body #{rowid}: {n} rewritten")
+        )
+        print(f"Recompressed {changed} bodies with {args.codec}")
+    elif args.command == 'retention-policy':
+        if args.scope and args.delete:
+            db.delete_retention_policy(args.scope)
+        elif args.scope:
+            db.set_retention_policy(args.scope, args.hot_days, args.body_days)
+        for scope, p in sorted(db.get_retention_policies().items()):
+            print(f"{scope}: hot_days={p['hot_days']}, body_days={p['body_days']}")
+    elif args.command == 'apply-retention':
+        result = db.apply_retention(args.chunk)
+        print(f"Archived {result['archived']} emails, dropped bodies of {result['bodies_dropped']}")
+        for a in db._archives():
+            print(f"  {a['month']}: {a['email_count']} emails ({a['path']})")
+        if args.vacuum:
+            db.vacuum()
+    elif args.command == 'backfill-status':
+        for source in [args.source] if args.source else sorted(db.get_sources()):
+            job = db.get_backfill_job(source)
+            if job is None:
+                print(f"No backfill planned for {source}")
+                continue
+            p = db.backfill_progress(source)
+            state = f"finished {job['finished_at']}" if job['finished_at'] else "in progress"
+            print(f"{source}: uids 1..{job['uid_hi']}, {state}")
+            print(f"  ranges {p['ranges_done']}/{p['ranges']}, messages {p['messages_done']}/{p['messages']}, "
+                  f"stored {p['stored']}")
+    elif args.command == 'outbox-status':
+        if args.retry_failed:
+            print(f"{db.retry_failed_notifications()} failed notifications queued again")
+        status = db.outbox_status()
+        print(', '.join(f"{state}: {n}" for state, n in sorted(status['counts'].items())) or "Outbox is empty")
+        for f in status['failed']:
+            print(f"  uid {f['uid']} -> {f['chat_id']}, {f['attempts']} attempts, {f['created_at']}: {f['last_error']}")
+    elif args.command == 'gap-status':
+        if args.floor is not None:
+            if not args.source:
+                parser.error("--floor needs --source")
+            if not db.set_gap_floor(args.source, args.floor):
+                print(f"No sync position for {args.source}")
+        status = db.gap_status()
+        for source in [args.source] if args.source else sorted(status):
+            s = status.get(source)
+            if s is None:
+                continue
+            checked = (f"{s['gaps']} missing, checked {s['gaps_checked_at']}" if s['gaps_checked_at']
+                       else "not checked yet")
+            print(f"{source}: uids {s['gap_floor'] or 1}..{s['last_uid']}, {checked}, "
+                  f"{s['gaps_recovered']} recovered so far")
+    if args.command in ('compress-bodies', 'body-report'):
+        report = db.body_storage_report()
+        for codec, c in report['by_codec'].items():
+            print(f"{codec:>5}: {c['bodies']} bodies, {c['original']} -> {c['stored']} bytes")
+        print(f"Total: {report['original_bytes']} -> {report['stored_bytes']} bytes, "
+              f"saved {report['saved_bytes']} ({1 - report['ratio']:.1%})")
+        print(f"Dedup: {report['body_references']} references to {report['unique_bodies']} bodies, "
+              f"{report['referenced_bytes']} -> {report['original_bytes']} bytes "
+              f"({report['dedup_ratio']:.2f}x)")
+    db.close()
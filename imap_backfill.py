@@ -0,0 +1,251 @@
+"""
+Full-history backfill. The live sync starts a new database with only the
+last few messages; this job downloads everything older, over several IMAP
+connections at once.
+
+Server uids below where the live sync started (sync_state.first_uid) are
+split into ranges of about BACKFILL_CHUNK messages and given a block of local
+uids below everything already stored, so history sorts under the live mail.
+Workers take ranges newest first, fetch them with pipelined batches
+(imap_sync.fetch_structured) and store them through add_emails(); each
+finished range is checkpointed in backfill_ranges, so a restart only repeats
+the ranges that were in progress. A shared Throttle caps the download rate
+and lets live delivery go first.
+"""
+import contextlib
+import os
+import queue
+import random
+import threading
+import time
+
+from imap_sync import IMAP_FETCH_BATCH, fetch_structured, with_fetched
+
+BACKFILL_CONNECTIONS = int(os.environ.get('BACKFILL_CONNECTIONS', '3'))
+BACKFILL_CHUNK = int(os.environ.get('BACKFILL_CHUNK', '500'))          # messages per checkpoint
+BACKFILL_RATE = float(os.environ.get('BACKFILL_RATE', '0'))            # messages/s over all connections, 0: no cap
+BACKFILL_RETRIES = 3
+
+
+class Throttle:
+    """
+    Token bucket shared by the backfill workers. While anyone is inside
+    hold(), wait() blocks, so live mail never queues behind history.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._cond = threading.Condition()
+        self._holders = 0
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+
+    @contextlib.contextmanager
+    def hold(self):
+        with self._cond:
+            self._holders += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._holders -= 1
+                self._cond.notify_all()
+
+    def wait(self, n=1):
+        with self._cond:
+            while self._holders:
+                self._cond.wait()
+            if not self.rate:
+                return
+            while True:
+                now = time.monotonic()
+                # At most a second's worth of burst
+                self._tokens = min(self.rate, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                self._cond.wait((n - self._tokens) / self.rate)
+
+
+class Backfill:
+    """
+    Downloads the history of one source once. `connect` returns a logged in
+    connection (imap_idle.connect), `mailbox` is the folder to select (by
+    default the source name itself), `parse(raw)` gives the add_emails()
+    dict. progress(p) is called after every range with backfill_progress()
+    plus 'source', 'finished' and 'rate' (messages per second in this run).
+    """
+
+    def __init__(self, db, connect, parse, source='INBOX', connections=BACKFILL_CONNECTIONS,
+                 chunk_size=BACKFILL_CHUNK, throttle=None, progress=None, mailbox=None):
+        self.db = db
+        self.connect = connect
+        self.parse = parse
+        self.source = source
+        self.mailbox = mailbox or source
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.throttle = throttle or Throttle(BACKFILL_RATE)
+        self.progress = progress
+        self.running = False
+        self._lock = threading.Lock()
+        self._fetched = 0
+        self._started = time.monotonic()
+
+    def stop(self):
+        self.running = False
+
+    def plan(self, conn):
+        """
+        Creates the job if the mailbox has none (or its UIDVALIDITY changed).
+        Returns the pending ranges.
+        """
+        info = conn.selected
+        state = self.db.get_sync_state(self.source)
+        job = self.db.get_backfill_job(self.source)
+        if state is None or state['uidvalidity'] != info['uidvalidity']:
+            # The live sync has not positioned itself on this mailbox yet
+            return []
+        if job is not None and job['uidvalidity'] == info['uidvalidity']:
+            return self.db.get_backfill_ranges(self.source)
+
+        # Everything below where the live sync started; after a UIDVALIDITY
+        # reset the old history is not reachable any more (first_uid is 1)
+        uid_hi = min(state['first_uid'], state['last_uid'] + 1) - 1
+        uids = self._search(conn, f'1:{uid_hi}') if uid_hi > 0 else []
+        ranges = []
+        for i in range(0, len(uids), self.chunk_size):
+            chunk = uids[i:i + self.chunk_size]
+            ranges.append((chunk[0], chunk[-1], len(chunk)))
+        self.db.plan_backfill(self.source, info['uidvalidity'], max(uid_hi, 0), ranges)
+        if ranges:
+            print(f"Backfill of {self.source}: {len(uids)} messages in {len(ranges)} ranges")
+        return self.db.get_backfill_ranges(self.source)
+
+    def run(self):
+        """Runs the job to completion (or stop()). Returns the number of messages stored."""
+        self.running = True
+        conn = self._open()
+        try:
+            ranges = self.plan(conn)
+            uidvalidity = conn.selected['uidvalidity']
+        finally:
+            self._logout(conn)
+        if not ranges:
+            return 0
+
+        work = queue.Queue()
+        for r in ranges:
+            work.put((r, 0))
+        self._started = time.monotonic()
+        self._fetched = 0
+        stored = []
+        workers = [
+            threading.Thread(target=self._worker, args=(work, uidvalidity, stored), daemon=True)
+            for _ in range(min(self.connections, len(ranges)))
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self._report()
+        return sum(stored)
+
+    def _worker(self, work, uidvalidity, stored):
+        conn = None
+        while self.running:
+            try:
+                r, attempt = work.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if conn is None:
+                    conn = self._open()
+                    if conn.selected['uidvalidity'] != uidvalidity:
+                        print(f"Backfill of {self.source} stopped: UIDVALIDITY changed")
+                        self.running = False
+                        break
+                count = self._fetch_range(conn, r)
+                self.db.complete_backfill_range(self.source, r['uid_lo'], count)
+                with self._lock:
+                    stored.append(count)
+                self._report()
+            except Exception as e:
+                if not self.running:
+                    break
+                print(f"Backfill range {r['uid_lo']}:{r['uid_hi']} failed: {e}")
+                self._logout(conn)
+                conn = None
+                if attempt + 1 < BACKFILL_RETRIES:
+                    work.put((r, attempt + 1))
+                time.sleep(random.uniform(1, 2) * 2 ** attempt)
+        self._logout(conn)
+
+    def _fetch_range(self, conn, r):
+        offset = self.db.get_backfill_job(self.source)['uid_offset']
+        uidvalidity = conn.selected['uidvalidity']
+        uids = self._search(conn, f"{r['uid_lo']}:{r['uid_hi']}")
+        batch = []
+        count = 0
+
+        def store(_):
+            nonlocal batch, count
+            # A retried range finds part of its messages already stored
+            self.db.add_emails(batch, raise_errors=True)
+            count += len(batch)
+            batch = []
+
+        stream = fetch_structured(conn, uids, self.db.assign_owners, min(IMAP_FETCH_BATCH, self.chunk_size),
+                                  on_batch=store, source=self.source)
+        for uid, raw, fetched in stream:
+            self.throttle.wait()
+            if not self.running:
+                raise RuntimeError('stopped')
+            with self._lock:
+                self._fetched += 1
+            try:
+                message = with_fetched(self.parse(raw), fetched)
+                batch.append({**message, 'uid': uid + offset, 'source': self.source,
+                              'uidvalidity': uidvalidity, 'server_uid': uid})
+            except Exception as e:
+                print(f"Error processing UID {uid} of {self.source}: {e}")
+        store(None)
+        return count
+
+    def _search(self, conn, uid_range):
+        typ, data = conn.uid('search', None, f'UID {uid_range}')
+        if typ != 'OK':
+            raise conn.error(f'UID SEARCH failed: {data}')
+        lo, hi = (int(x) for x in uid_range.split(':'))
+        return sorted(u for u in (int(x) for x in data[0].split()) if lo <= u <= hi)
+
+    def _open(self):
+        conn = self.connect()
+        # Read-only: history is copied without marking it \Seen
+        typ, data = conn.select(self.mailbox, readonly=True)
+        if typ != 'OK':
+            self._logout(conn)
+            raise conn.error(f'cannot select {self.mailbox}: {data}')
+        return conn
+
+    def _logout(self, conn):
+        if conn is None:
+            return
+        try:
+            conn.logout()
+        except Exception:
+            pass
+
+    def _report(self):
+        if not self.progress:
+            return
+        p = self.db.backfill_progress(self.source)
+        elapsed = time.monotonic() - self._started
+        p['source'] = self.source
+        p['finished'] = p['ranges_done'] == p['ranges']
+        p['rate'] = self._fetched / elapsed if elapsed > 0 else 0.0
+        try:
+            self.progress(p)
+        except Exception as e:
+            print(f"Backfill progress callback error: {e}")
@@ -0,0 +1,302 @@
+"""
+Push ingestion over IMAP IDLE (RFC 2177).
+
+One authenticated connection stays open on the mailbox and sits in IDLE; the
+server's EXISTS notification wakes it up. IDLE is re-issued before the server
+would drop it, lost connections are re-opened with exponential backoff, and
+servers without IDLE are polled with NOOP on the same connection. FolderPoller
+covers folders without a connection of their own by SELECTing them in turn.
+
+Only the standard library is used, so the watcher can be run against a local
+fake server:
+
+    watcher = IdleWatcher(lambda: connect('127.0.0.1', 'u', 'p', port=1143, use_ssl=False), on_wake)
+    watcher.run()
+"""
+import imaplib
+import os
+import random
+import select
+import time
+
+IMAP_IDLE_TIMEOUT = float(os.environ.get('IMAP_IDLE_TIMEOUT', '600'))     # RFC 2177: below 29 min
+IMAP_POLL_INTERVAL = float(os.environ.get('IMAP_POLL_INTERVAL', '5'))     # NOOP fallback
+IMAP_BACKOFF_MIN = 1.0
+IMAP_BACKOFF_MAX = float(os.environ.get('IMAP_BACKOFF_MAX', '300'))
+
+
+class IdleMixin:
+    """
+    Adds idle() to imaplib.IMAP4. Responses are read through our own buffer
+    instead of the socket file, so waiting for data can use select() with a
+    timeout without leaving the stream in an undefined state.
+    """
+
+    def _reset_buffer(self):
+        self._rbuf = bytearray()
+
+    def open(self, *args, **kwargs):
+        self._reset_buffer()
+        super().open(*args, **kwargs)
+
+    def _fill(self, timeout=None):
+        """Reads more bytes into the buffer. False on timeout; raises abort on EOF."""
+        if not self._readable(timeout):
+            return False
+        data = self.sock.recv(65536)
+        if not data:
+            raise self.abort('socket closed')
+        self._rbuf += data
+        return True
+
+    def _readable(self, timeout):
+        # Bytes already decrypted by the SSL layer do not show up in select()
+        pending = getattr(self.sock, 'pending', None)
+        if pending and pending():
+            return True
+        return bool(select.select([self.sock], [], [], timeout)[0])
+
+    def read(self, size):
+        while len(self._rbuf) < size:
+            self._fill()
+        data = bytes(self._rbuf[:size])
+        del self._rbuf[:size]
+        return data
+
+    def readline(self):
+        while True:
+            end = self._rbuf.find(b'\n')
+            if end >= 0:
+                break
+            if len(self._rbuf) > imaplib._MAXLINE:
+                raise self.error('got more than %d bytes' % imaplib._MAXLINE)
+            self._fill()
+        line = bytes(self._rbuf[:end + 1])
+        del self._rbuf[:end + 1]
+        return line
+
+    def _line_ready(self, timeout):
+        while b'\n' not in self._rbuf:
+            if not self._fill(timeout):
+                return False
+            timeout = 0
+        return True
+
+    def select(self, mailbox='INBOX', readonly=False):
+        """
+        imaplib's select(); also keeps the mailbox status from the response
+        in self.selected: exists, uidvalidity, uidnext and, on CONDSTORE
+        servers, highestmodseq (None when not reported).
+        """
+        typ, data = super().select(mailbox, readonly)
+        if typ == 'OK':
+            self.selected = {
+                'mailbox': mailbox,
+                'exists': int(data[0]) if data and data[0] else 0,
+                'uidvalidity': self._response_int('UIDVALIDITY'),
+                'uidnext': self._response_int('UIDNEXT'),
+                'highestmodseq': self._response_int('HIGHESTMODSEQ'),
+            }
+        return typ, data
+
+    def _response_int(self, code):
+        typ, data = self.response(code)
+        try:
+            return int(data[-1].split()[0])
+        except (TypeError, ValueError, IndexError, AttributeError):
+            return None
+
+    def idle(self, timeout, interrupted=None):
+        """
+        Runs one IDLE command for at most `timeout` seconds and returns the
+        untagged responses received (e.g. [b'* 12 EXISTS']); empty on timeout.
+        Returns early once the server has reported something. `interrupted`
+        is checked about once a second.
+        """
+        tag = self._new_tag()
+        # The command is completed here, not through imaplib's response loop
+        self.tagged_commands.pop(tag, None)
+        self.send(tag + b' IDLE\r\n')
+
+        responses = []
+        while True:
+            line = self.readline()
+            if line.startswith(b'+'):
+                break
+            if line.startswith(tag):
+                raise self.error(f'IDLE failed: {line.decode(errors="replace").strip()}')
+            responses.append(line.rstrip())
+
+        deadline = time.monotonic() + timeout
+        while not responses:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (interrupted and interrupted()):
+                break
+            if self._line_ready(min(remaining, 1.0)):
+                # Take everything that arrived together
+                while True:
+                    responses.append(self.readline().rstrip())
+                    if not self._line_ready(0):
+                        break
+
+        self.send(b'DONE\r\n')
+        while True:
+            line = self.readline()
+            if line.startswith(tag + b' '):
+                if not line[len(tag) + 1:].startswith(b'OK'):
+                    raise self.error(f'IDLE failed: {line.decode(errors="replace").strip()}')
+                break
+            responses.append(line.rstrip())
+
+        for response in responses:
+            if response.startswith(b'* BYE'):
+                raise self.abort(response.decode(errors='replace'))
+        return responses
+
+
+class IdleIMAP4(IdleMixin, imaplib.IMAP4):
+    pass
+
+
+class IdleIMAP4_SSL(IdleMixin, imaplib.IMAP4_SSL):
+    pass
+
+
+def connect(host, user, password, port=None, use_ssl=True):
+    """Opens and authenticates a connection that supports idle()."""
+    if use_ssl:
+        conn = IdleIMAP4_SSL(host, port or imaplib.IMAP4_SSL_PORT)
+    else:
+        conn = IdleIMAP4(host, port or imaplib.IMAP4_PORT)
+    try:
+        conn.login(user, password)
+    except Exception:
+        conn.shutdown()
+        raise
+    return conn
+
+
+def has_capability(conn, name):
+    # Servers often announce more after LOGIN, so ask again
+    typ, data = conn.capability()
+    if typ == 'OK' and data and data[0]:
+        return name.upper() in data[0].decode(errors='replace').upper().split()
+    return name.upper() in conn.capabilities
+
+
+class IdleWatcher:
+    """
+    Calls on_wake(conn) whenever new mail may have arrived: once after each
+    (re)connect to catch up, then on every EXISTS. `connect` returns a logged
+    in IdleIMAP4 connection. Any error, including one raised by on_wake,
+    drops the connection and triggers a reconnect.
+    """
+
+    def __init__(self, connect, on_wake, mailbox='INBOX', idle_timeout=IMAP_IDLE_TIMEOUT,
+                 poll_interval=IMAP_POLL_INTERVAL, backoff_min=IMAP_BACKOFF_MIN,
+                 backoff_max=IMAP_BACKOFF_MAX):
+        self.connect = connect
+        self.on_wake = on_wake
+        self.mailbox = mailbox
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.conn = None
+        self.running = False
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        delay = self.backoff_min
+        while self.running:
+            try:
+                self._open()
+                delay = self.backoff_min
+                self._watch()
+            except Exception as e:
+                print(f"IMAP connection to {self.mailbox} lost: {e}")
+            finally:
+                self._close()
+            if not self.running:
+                break
+            # Jitter keeps several processes from reconnecting in step
+            wait = random.uniform(delay / 2, delay)
+            print(f"IMAP reconnect in {wait:.1f}s")
+            self._sleep(wait)
+            delay = min(delay * 2, self.backoff_max)
+
+    def _open(self):
+        self.conn = self.connect()
+        typ, data = self.conn.select(self.mailbox)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f'cannot select {self.mailbox}: {data}')
+        self.can_idle = has_capability(self.conn, 'IDLE')
+        if not self.can_idle:
+            print(f"IMAP server has no IDLE, polling every {self.poll_interval}s")
+
+    def _watch(self):
+        self.on_wake(self.conn)
+        while self.running:
+            if self.can_idle:
+                responses = self.conn.idle(self.idle_timeout, interrupted=lambda: not self.running)
+                if any(r.endswith(b'EXISTS') for r in responses):
+                    self.on_wake(self.conn)
+            else:
+                self._sleep(self.poll_interval)
+                if not self.running:
+                    break
+                typ, data = self.conn.noop()
+                if typ != 'OK':
+                    raise imaplib.IMAP4.abort(f'NOOP failed: {data}')
+                self.on_wake(self.conn)
+
+    def _close(self):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        try:
+            conn.logout()
+        except Exception:
+            try:
+                conn.shutdown()
+            except Exception:
+                pass
+
+    def _sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while self.running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 1.0))
+
+
+class FolderPoller(IdleWatcher):
+    """
+    Watches several folders over one connection by polling: every
+    poll_interval each folder is SELECTed in turn and on_wake(conn) called
+    with it selected. For folders that do not get a connection of their own.
+    """
+
+    def __init__(self, connect, on_wake, mailboxes, poll_interval=IMAP_POLL_INTERVAL,
+                 backoff_min=IMAP_BACKOFF_MIN, backoff_max=IMAP_BACKOFF_MAX):
+        super().__init__(connect, on_wake, mailboxes[0], poll_interval=poll_interval,
+                         backoff_min=backoff_min, backoff_max=backoff_max)
+        self.mailboxes = list(mailboxes)
+
+    def _open(self):
+        self.conn = self.connect()
+
+    def _watch(self):
+        while self.running:
+            for mailbox in self.mailboxes:
+                typ, data = self.conn.select(mailbox)
+                if typ != 'OK':
+                    raise imaplib.IMAP4.error(f'cannot select {mailbox}: {data}')
+                self.on_wake(self.conn)
+                if not self.running:
+                    return
+            self._sleep(self.poll_interval)
@@ -0,0 +1,272 @@
+"""
+UID gap reconciliation. A message whose fetch or parse failed is skipped by
+the live sync and the backfill alike, and their positions move on past it;
+this job finds such messages later and fetches them again.
+
+Per source it compares the UIDs on the server with the ones the database
+accounts for: stored emails, plus the ones deleted or archived since
+(removed_messages). Both sides are UidRanges, runs of consecutive UIDs, so a
+mailbox of hundreds of thousands of messages with a handful of holes costs a
+handful of ranges: the server's come from ESEARCH (RFC 4731) where offered,
+the local ones straight from SQL. Only UIDs the sync already went past are
+checked, from the source's gap_floor (mail present at a UIDVALIDITY reset,
+or stored before this job existed, is left alone) up to its last_uid; ranges
+the backfill has yet to do are skipped as well.
+
+Missing messages are fetched at backfill priority (the shared Throttle, so
+live mail goes first), RECONCILE_BATCH per source and pass, and stored
+without a notification. What is still missing after a pass is saved as the
+source's gap count (`python database.py gap-status`).
+"""
+import os
+import re
+from array import array
+from itertools import islice
+
+from imap_backfill import Throttle
+from imap_idle import has_capability
+from imap_sync import IMAP_FETCH_BATCH, fetch_structured, with_fetched
+
+RECONCILE_INTERVAL = float(os.environ.get('RECONCILE_INTERVAL', '3600'))   # seconds between passes, 0: off
+RECONCILE_BATCH = int(os.environ.get('RECONCILE_BATCH', '500'))            # messages fetched per source and pass
+
+# UIDs per SEARCH: imaplib refuses response lines over 1 MB
+SEARCH_SPAN = 50000
+
+NUMBER_RE = re.compile(rb'\d+')
+ESEARCH_ALL_RE = re.compile(rb'\bALL ([0-9:,]+)')
+
+
+class UidRanges:
+    """
+    A set of UIDs as sorted, disjoint runs, kept as flat lo, hi, lo, hi...
+    bounds in an array: 16 bytes per run whatever its length.
+    """
+
+    __slots__ = ('_bounds', '_sorted')
+
+    def __init__(self, runs=()):
+        self._bounds = array('Q')
+        self._sorted = True
+        for lo, hi in runs:
+            self.add(lo, hi)
+        self._normalize()
+
+    @classmethod
+    def from_uids(cls, uids):
+        """From UIDs in any order; ascending input is merged as it streams in."""
+        ranges = cls()
+        lo = hi = None
+        for uid in uids:
+            if hi is not None and uid == hi + 1:
+                hi = uid
+                continue
+            if hi is not None:
+                ranges.add(lo, hi)
+            lo = hi = uid
+        if hi is not None:
+            ranges.add(lo, hi)
+        ranges._normalize()
+        return ranges
+
+    @classmethod
+    def parse(cls, text):
+        """From an IMAP sequence set: '1:3,7,9:10'."""
+        ranges = cls()
+        for part in (text.decode() if isinstance(text, bytes) else text).split(','):
+            if part:
+                lo, _, hi = part.partition(':')
+                lo, hi = int(lo), int(hi or lo)
+                ranges.add(min(lo, hi), max(lo, hi))
+        ranges._normalize()
+        return ranges
+
+    def add(self, lo, hi):
+        b = self._bounds
+        if b and lo <= b[-1] + 1:
+            if lo < b[-2]:
+                self._sorted = False
+            elif hi > b[-1]:
+                b[-1] = hi
+                return
+            else:
+                return
+        b.append(lo)
+        b.append(hi)
+
+    def _normalize(self):
+        if self._sorted:
+            return
+        runs = sorted(self.runs())
+        self._bounds = array('Q')
+        self._sorted = True
+        for lo, hi in runs:
+            self.add(lo, hi)
+
+    def runs(self):
+        b = self._bounds
+        return [(b[i], b[i + 1]) for i in range(0, len(b), 2)]
+
+    def __iter__(self):
+        b = self._bounds
+        for i in range(0, len(b), 2):
+            yield from range(b[i], b[i + 1] + 1)
+
+    def __len__(self):
+        b = self._bounds
+        return sum(b[i + 1] - b[i] + 1 for i in range(0, len(b), 2))
+
+    def __bool__(self):
+        return bool(self._bounds)
+
+    def __eq__(self, other):
+        return isinstance(other, UidRanges) and self._bounds == other._bounds
+
+    def __sub__(self, other):
+        """UIDs of self not in other; one pass over both."""
+        result = UidRanges()
+        theirs = other.runs()
+        j = 0
+        for lo, hi in self.runs():
+            while j < len(theirs) and theirs[j][1] < lo:
+                j += 1
+            k = j
+            while lo <= hi and k < len(theirs) and theirs[k][0] <= hi:
+                t_lo, t_hi = theirs[k]
+                if t_lo > lo:
+                    result.add(lo, t_lo - 1)
+                lo = max(lo, t_hi + 1)
+                k += 1
+            if lo <= hi:
+                result.add(lo, hi)
+        return result
+
+    def to_imap(self):
+        """'1:3,7,9:10'"""
+        return ','.join(str(lo) if lo == hi else f'{lo}:{hi}' for lo, hi in self.runs())
+
+    def __repr__(self):
+        return f'UidRanges({self.to_imap()!r})'
+
+
+def server_uids(conn, lo, hi):
+    """UIDs lo..hi of the selected mailbox as UidRanges, the server's own ranges where it has ESEARCH."""
+    esearch = has_capability(conn, 'ESEARCH')
+    found = UidRanges()
+    for start in range(lo, hi + 1, SEARCH_SPAN):
+        span = f'UID {start}:{min(hi, start + SEARCH_SPAN - 1)}'
+        if esearch:
+            typ, data = conn.uid('search', 'RETURN (ALL)', span)
+            if typ != 'OK':
+                raise conn.error(f'UID SEARCH failed: {data}')
+            _, responses = conn.response('ESEARCH')
+            m = ESEARCH_ALL_RE.search(responses[-1] or b'') if responses else None
+            runs = UidRanges.parse(m.group(1)).runs() if m else []
+        else:
+            typ, data = conn.uid('search', None, span)
+            if typ != 'OK':
+                raise conn.error(f'UID SEARCH failed: {data}')
+            runs = UidRanges.from_uids(int(m.group()) for m in NUMBER_RE.finditer(data[0] or b'')).runs()
+        for run in runs:
+            found.add(*run)
+    found._normalize()
+    # A range past the last UID still matches the last message
+    return found - UidRanges([(0, lo - 1), (hi + 1, 1 << 63)])
+
+
+class Reconciler:
+    """
+    One pass over one source: `connect` returns a logged in connection
+    (Account.connect), `mailbox` is the folder to select, `parse(raw)` gives
+    the add_emails() dict. run() returns {'gaps', 'recovered'}: messages
+    still missing after the pass, and ones stored by it.
+    """
+
+    def __init__(self, db, connect, parse, source, mailbox=None, throttle=None, batch=RECONCILE_BATCH):
+        self.db = db
+        self.connect = connect
+        self.parse = parse
+        self.source = source
+        self.mailbox = mailbox or source
+        self.throttle = throttle or Throttle()
+        self.batch = batch
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def missing(self, conn):
+        """(uidvalidity, UidRanges of the UIDs on the server the database does not account for)."""
+        info = conn.selected
+        state = self.db.get_sync_state(self.source)
+        if state is None or state['uidvalidity'] is None or state['uidvalidity'] != info['uidvalidity']:
+            # The live sync has not positioned itself on this mailbox yet
+            return info['uidvalidity'], UidRanges()
+        lo, hi = state['gap_floor'] or 1, state['last_uid']
+        if hi < lo:
+            return info['uidvalidity'], UidRanges()
+        local = UidRanges(self.db.known_server_uids(self.source, info['uidvalidity'], lo, hi))
+        # Whatever the backfill has not done yet is its business
+        job = self.db.get_backfill_job(self.source)
+        if job is None or job['uidvalidity'] != info['uidvalidity']:
+            first = state['first_uid'] or 1
+            pending = UidRanges([(1, first - 1)] if first > 1 else [])
+        else:
+            pending = UidRanges((r['uid_lo'], r['uid_hi']) for r in self.db.get_backfill_ranges(self.source))
+        return info['uidvalidity'], server_uids(conn, lo, hi) - local - pending
+
+    def run(self):
+        conn = self._open()
+        try:
+            uidvalidity, missing = self.missing(conn)
+            recovered = self._fetch(conn, uidvalidity, list(islice(missing, self.batch))) if missing else 0
+        finally:
+            self._logout(conn)
+        gaps = len(missing) - recovered
+        self.db.save_gap_report(self.source, uidvalidity, gaps, recovered)
+        return {'gaps': gaps, 'recovered': recovered}
+
+    def _fetch(self, conn, uidvalidity, uids):
+        job = self.db.get_backfill_job(self.source)
+        # History keeps the local uids its backfill reserved, so it sorts where it belongs
+        offset = job['uid_offset'] if job and job['uidvalidity'] == uidvalidity else None
+        batch = []
+        stored = 0
+
+        def store(_):
+            nonlocal batch, stored
+            stored += len(self.db.add_emails(batch, raise_errors=True))
+            batch = []
+
+        stream = fetch_structured(conn, uids, self.db.assign_owners, IMAP_FETCH_BATCH, on_batch=store,
+                                  source=self.source)
+        for uid, raw, fetched in stream:
+            self.throttle.wait()
+            if not self.running:
+                break
+            try:
+                message = {**with_fetched(self.parse(raw), fetched), 'source': self.source,
+                           'uidvalidity': uidvalidity, 'server_uid': uid}
+            except Exception as e:
+                print(f"Error processing UID {uid} of {self.source}: {e}")
+                continue
+            if offset is not None and uid <= job['uid_hi']:
+                message['uid'] = uid + offset
+            batch.append(message)
+        store(None)
+        return stored
+
+    def _open(self):
+        conn = self.connect()
+        # Read-only: the messages are copied without marking them \Seen
+        typ, data = conn.select(self.mailbox, readonly=True)
+        if typ != 'OK':
+            self._logout(conn)
+            raise conn.error(f'cannot select {self.mailbox}: {data}')
+        return conn
+
+    def _logout(self, conn):
+        try:
+            conn.logout()
+        except Exception:
+            pass
@@ -0,0 +1,172 @@
+"""
+Ingestion from several upstream mailboxes and folders.
+
+A source is one folder of one IMAP account, named "user/folder" wherever the
+database keeps per-mailbox state (sync_state, backfill jobs, the stored
+emails' source). MAIL_ACCOUNTS lists the accounts as JSON, e.g. one per
+domain:
+
+    [{"user": "mail@dreampartners.online", "password": "...", "folders": ["INBOX", "Spam"]},
+     {"user": "mail@nefor-casino.online", "password": "...", "host": "imap.yandex.ru"}]
+
+Without it the single EMAIL_USER account is read on IMAP_FOLDERS.
+
+Servers limit connections per account, so each account has a
+ConnectionBudget of IMAP_MAX_CONNECTIONS that everything talking to it
+draws from: IDLE workers, the folder poller, the backfill and attachment
+downloads. IngestScheduler gives folders an IDLE connection each while one
+connection of the budget stays spare, and polls the rest over one shared
+connection.
+
+    scheduler = IngestScheduler(load_accounts(user, password, host), on_wake)
+    scheduler.run()     # on_wake('mail@dreampartners.online/Spam', conn)
+"""
+import imaplib
+import json
+import os
+import threading
+
+import imap_idle
+from imap_idle import FolderPoller, IdleWatcher
+
+MAIL_ACCOUNTS = os.environ.get('MAIL_ACCOUNTS')
+IMAP_FOLDERS = [f.strip() for f in os.environ.get('IMAP_FOLDERS', 'INBOX').split(',') if f.strip()]
+IMAP_MAX_CONNECTIONS = int(os.environ.get('IMAP_MAX_CONNECTIONS', '5'))                  # per account
+IMAP_FOLDER_POLL_INTERVAL = float(os.environ.get('IMAP_FOLDER_POLL_INTERVAL', '60'))    # folders without IDLE
+
+
+def source_name(user, folder):
+    return f'{user}/{folder}'
+
+
+def find_source(accounts, source):
+    """'user/folder' -> (account, folder), or None when no account has that user."""
+    user, _, folder = source.partition('/')
+    account = next((a for a in accounts if a.user == user), None)
+    return (account, folder) if account and folder else None
+
+
+class ConnectionBudget:
+    """
+    At most `limit` connections open at once. open() waits for a free slot
+    (or raises imaplib.IMAP4.abort after `timeout` seconds); the slot comes
+    back when the connection is logged out or shut down.
+    """
+
+    def __init__(self, connect, limit):
+        self.connect = connect
+        self.limit = limit
+        self._slots = threading.BoundedSemaphore(limit)
+
+    def open(self, timeout=None):
+        if not self._slots.acquire(timeout=timeout):
+            raise imaplib.IMAP4.abort(f'all {self.limit} connections are in use')
+        try:
+            conn = self.connect()
+        except Exception:
+            self._slots.release()
+            raise
+        shutdown = conn.shutdown
+        released = threading.Lock()
+
+        def shutdown_and_release():
+            # logout() ends in shutdown(), and callers may shut down again
+            try:
+                shutdown()
+            finally:
+                if released.acquire(blocking=False):
+                    self._slots.release()
+        conn.shutdown = shutdown_and_release
+        return conn
+
+
+class Account:
+    """One upstream IMAP login, the folders read from it and its connection budget."""
+
+    def __init__(self, user, password, host, folders=('INBOX',), port=None, use_ssl=True,
+                 max_connections=IMAP_MAX_CONNECTIONS):
+        self.user = user
+        self.password = password
+        self.host = host
+        self.folders = list(folders)
+        self.port = port
+        self.use_ssl = use_ssl
+        self.budget = ConnectionBudget(self._connect, max(1, max_connections))
+
+    def _connect(self):
+        return imap_idle.connect(self.host, self.user, self.password, self.port, self.use_ssl)
+
+    def connect(self, timeout=None):
+        """A logged in connection from the budget; log it out to give the slot back."""
+        return self.budget.open(timeout)
+
+    def sources(self):
+        return [source_name(self.user, folder) for folder in self.folders]
+
+
+def load_accounts(user, password, host, config=MAIL_ACCOUNTS):
+    """Accounts from MAIL_ACCOUNTS (JSON), or the one given on IMAP_FOLDERS."""
+    if not config:
+        return [Account(user, password, host, IMAP_FOLDERS)]
+    return [
+        Account(a['user'], a['password'], a.get('host', host), a.get('folders', IMAP_FOLDERS),
+                port=a.get('port'), use_ssl=a.get('ssl', True),
+                max_connections=a.get('max_connections', IMAP_MAX_CONNECTIONS))
+        for a in json.loads(config)
+    ]
+
+
+class IngestScheduler:
+    """
+    Keeps every source of `accounts` ingested: on_wake(source, conn) is
+    called with the source's folder selected on conn whenever it may have
+    new mail, once after each (re)connect and then on EXISTS or every poll.
+    Calls for different sources run in parallel, each source's in order.
+    """
+
+    def __init__(self, accounts, on_wake, poll_interval=IMAP_FOLDER_POLL_INTERVAL):
+        self.accounts = accounts
+        self.on_wake = on_wake
+        self.poll_interval = poll_interval
+        self.watchers = []
+        self.running = False
+
+    def plan(self, account):
+        """(folders with their own IDLE connection, folders polled over a shared one)."""
+        # One connection stays free for the backfill and attachment downloads
+        spare = max(account.budget.limit - 1, 1)
+        if len(account.folders) <= spare:
+            return list(account.folders), []
+        return account.folders[:spare - 1], account.folders[spare - 1:]
+
+    def run(self):
+        """Starts a worker per IDLE folder and one poller per account as needed; returns after stop()."""
+        self.running = True
+        threads = []
+        for account in self.accounts:
+            idle, polled = self.plan(account)
+            watchers = [IdleWatcher(account.connect, self._waker(account), folder) for folder in idle]
+            if polled:
+                watchers.append(FolderPoller(account.connect, self._waker(account), polled, self.poll_interval))
+            print(f"IMAP {account.user}: IDLE on {', '.join(idle) or '-'}"
+                  + (f"; polling {', '.join(polled)} every {self.poll_interval:g}s" if polled else ''))
+            for w in watchers:
+                threads.append(threading.Thread(target=w.run, name=f'imap-{account.user}-{w.mailbox}',
+                                                daemon=True))
+            self.watchers += watchers
+        if not self.running:
+            return
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def stop(self):
+        self.running = False
+        for w in self.watchers:
+            w.stop()
+
+    def _waker(self, account):
+        def on_wake(conn):
+            self.on_wake(source_name(account.user, conn.selected['mailbox']), conn)
+        return on_wake
@@ -0,0 +1,196 @@
+"""
+BODYSTRUCTURE handling for header-first ingestion.
+
+The server describes a message's MIME tree in its BODYSTRUCTURE response;
+from that we pick the sections parse_message() would keep (the inline
+text/plain and text/html parts) and list the rest as attachments, so those
+can be left on the server and fetched when someone asks for them.
+rebuild_message() puts the fetched headers and sections back together into a
+small RFC822 message that parse_message() reads like the original.
+
+    structure = parse_value(head, head.index(b'BODYSTRUCTURE ') + 14)[0]
+    multipart, sections, attachments = split_parts(structure)
+    raw = rebuild_message(header, multipart, [(part, data), ...])
+"""
+import base64
+import binascii
+import itertools
+import os
+import quopri
+import re
+from urllib.parse import unquote
+
+from mail_parser import decode_str
+
+_TOKEN_RE = re.compile(rb' *(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|((?:[^ ()"\[\]\r\n]|\[[^\]]*\])+))', re.S)
+_ESCAPE_RE = re.compile(rb'\\(.)', re.S)
+
+
+def parse_value(data, pos=0):
+    """
+    One IMAP value from data[pos:] -> (value, end). Parenthesized lists
+    become lists, NIL None, atoms and quoted strings str; atoms like
+    BODY[HEADER.FIELDS (TO)] keep their brackets. Literals must already be
+    inlined as quoted strings (imap_sync._read_fetch does that).
+    """
+    stack = [[]]
+    while True:
+        m = _TOKEN_RE.match(data, pos)
+        if not m:
+            raise ValueError(f'unreadable response at {pos}')
+        pos = m.end()
+        opened, closed, quoted, atom = m.groups()
+        if opened:
+            stack.append([])
+            continue
+        if closed:
+            if len(stack) == 1:
+                raise ValueError(f'unbalanced ) at {pos}')
+            value = stack.pop()
+        elif quoted is not None:
+            value = _ESCAPE_RE.sub(rb'\1', quoted).decode('utf-8', 'replace')
+        else:
+            value = None if atom.upper() == b'NIL' else atom.decode('utf-8', 'replace')
+        if len(stack) == 1:
+            return value, pos
+        stack[-1].append(value)
+
+
+def quote(data):
+    """bytes -> IMAP quoted string, for literals inlined into a response line."""
+    return b'"' + data.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+
+def _params(value):
+    """("CHARSET" "utf-8" "NAME" "a.pdf") -> {'charset': 'utf-8', 'name': 'a.pdf'}"""
+    if not isinstance(value, list):
+        return {}
+    return {str(k).lower(): v or '' for k, v in zip(value[::2], value[1::2])}
+
+
+def _param(params, name):
+    """A filename-like parameter, RFC 2047 and RFC 2231 (incl. continuations) decoded."""
+    if params.get(name):
+        return decode_str(params[name])
+    if params.get(name + '*'):
+        return _rfc2231(params[name + '*'])
+    pieces = sorted(
+        (int(m.group(1)), key)
+        for key in params for m in [re.fullmatch(re.escape(name) + r'\*(\d+)\*?', key)] if m
+    )
+    if not pieces:
+        return None
+    joined = ''.join(params[key] for _, key in pieces)
+    return _rfc2231(joined) if pieces[0][1].endswith('*') else decode_str(joined)
+
+
+def _rfc2231(value):
+    charset, _, rest = value.partition("'")
+    _, _, text = rest.partition("'")
+    try:
+        return unquote(text, encoding=charset or 'utf-8', errors='replace')
+    except LookupError:
+        return unquote(text, errors='replace')
+
+
+def _leaf(body, section):
+    content_type = f'{body[0]}/{body[1]}'.lower()
+    params = _params(body[2])
+    # Extension data starts after the type-specific fields
+    if content_type.startswith('text/'):
+        ext = 8
+    elif content_type == 'message/rfc822':
+        ext = 10
+    else:
+        ext = 7
+    disposition = body[ext + 1] if len(body) > ext + 1 and isinstance(body[ext + 1], list) else None
+    disp_params = _params(disposition[1]) if disposition and len(disposition) > 1 else {}
+    return {
+        'section': section,
+        'content_type': content_type,
+        'charset': params.get('charset'),
+        'encoding': (body[5] or '7bit').lower(),
+        'size': int(body[6] or 0),
+        'disposition': (disposition[0] or '').lower() if disposition else '',
+        'filename': _param(disp_params, 'filename') or _param(params, 'name'),
+    }
+
+
+def _walk(body, section):
+    if isinstance(body[0], list):
+        # Children come first, then the subtype and extension data
+        for i, child in enumerate(itertools.takewhile(lambda c: isinstance(c, list), body)):
+            yield from _walk(child, f'{section}.{i + 1}' if section else str(i + 1))
+        return
+    section = section or '1'
+    if f'{body[0]}/{body[1]}'.lower() == 'message/rfc822' and len(body) > 8 and isinstance(body[8], list):
+        # email's walk() goes into attached messages too, and so did the
+        # old parser; their parts are numbered under this section
+        inner = body[8]
+        yield from _walk(inner, section if isinstance(inner[0], list) else f'{section}.1')
+        return
+    yield _leaf(body, section)
+
+
+def body_parts(structure):
+    """Leaf parts of a BODYSTRUCTURE in the order email's walk() visits them."""
+    return list(_walk(structure, ''))
+
+
+def split_parts(structure):
+    """
+    BODYSTRUCTURE -> (multipart, sections, attachments): the parts
+    parse_message() reads (inline text/plain and text/html; any text/* part
+    of a single-part message) and every other part with a size.
+    """
+    multipart = isinstance(structure[0], list)
+    sections, attachments = [], []
+    for part in body_parts(structure):
+        if multipart:
+            wanted = part['content_type'] in ('text/plain', 'text/html') and part['disposition'] != 'attachment'
+        else:
+            wanted = part['content_type'].startswith('text/')
+        if wanted:
+            sections.append(part)
+        elif part['size']:
+            attachments.append(part)
+    return multipart, sections, attachments
+
+
+def _part_header(part):
+    content_type = part['content_type']
+    if part.get('charset'):
+        content_type += f'; charset="{part["charset"]}"'
+    return f'Content-Type: {content_type}\r\nContent-Transfer-Encoding: {part["encoding"]}\r\n\r\n'.encode()
+
+
+def rebuild_message(header, multipart, sections):
+    """
+    Fetched header block plus [(part, data)] -> RFC822 bytes holding only
+    those sections, with the structure parse_message() expects.
+    """
+    head = header.rstrip(b'\r\n') + b'\r\n' if header.strip() else b''
+    if not multipart:
+        if not sections:
+            return head + b'\r\n'
+        part, data = sections[0]
+        return head + _part_header(part) + data
+    boundary = b'=_partial_' + os.urandom(12).hex().encode()
+    out = [head, b'MIME-Version: 1.0\r\nContent-Type: multipart/mixed; boundary="', boundary, b'"\r\n\r\n']
+    for part, data in sections:
+        out += [b'--', boundary, b'\r\n', _part_header(part), data, b'\r\n']
+    out += [b'--', boundary, b'--\r\n']
+    return b''.join(out)
+
+
+def decode_section(data, encoding):
+    """Transfer-decodes a fetched section (an attachment fetched on demand)."""
+    encoding = (encoding or '').lower()
+    try:
+        if encoding == 'base64':
+            return base64.b64decode(data)
+        if encoding == 'quoted-printable':
+            return quopri.decodestring(data)
+    except (binascii.Error, ValueError):
+        pass
+    return data
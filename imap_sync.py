@@ -0,0 +1,533 @@
+"""
+Incremental mailbox sync: asks the server only for UIDs above a stored
+high-water mark (`UID SEARCH UID n:*`) instead of listing the whole mailbox.
+
+The position (UIDVALIDITY, last UID, HIGHESTMODSEQ where the server has
+CONDSTORE) lives in the sync_state table under the source's name
+(account/folder), so a restart continues where the last run stopped.
+Messages are stored under their (source, UIDVALIDITY, server UID) and get
+their local uid from the database, so several mailboxes share one uid
+sequence. When the server resets UIDVALIDITY the old UIDs mean nothing any
+more; the mailbox is then resynced in a controlled way: only messages since
+the newest stored one are fetched, skipping those already stored.
+
+Messages are downloaded with multi-message `UID FETCH <set>` commands, a few
+of them in flight at once, and handed on one by one as they come off the
+socket, so a catch-up costs a handful of round trips instead of one per
+message and never holds more than one batch in memory.
+
+Ingestion goes header-first (fetch_structured): size, BODYSTRUCTURE and the
+routing headers come first, the owner is resolved from those, and only the
+text and HTML sections are downloaded from larger messages. Attachments stay
+on the server, recorded by section, until fetch_attachment() is asked for one.
+Sections are cut at a cap, and a message whose structure cannot be read is
+fetched whole only up to the same cap, so no message is held in memory whole
+however large it is.
+"""
+import collections
+import email
+import os
+import re
+import time
+
+from imap_structure import decode_section, parse_value, quote, rebuild_message, split_parts
+from mail_parser import recipient
+
+UID_RE = re.compile(rb'UID (\d+)')
+SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+LITERAL_RE = re.compile(rb'\{(\d+)\}\r?\n$')
+# A literal that is the value of a fetch item rather than part of e.g. BODYSTRUCTURE
+ITEM_RE = re.compile(rb'((?:RFC822(?:\.[A-Z]+)?|BODY\[[^\]]*\]|BINARY\[[^\]]*\])(?:<\d+>)?) $')
+
+IMAP_FETCH_BATCH = int(os.environ.get('IMAP_FETCH_BATCH', '100'))                     # messages per command
+IMAP_FETCH_BATCH_BYTES = int(os.environ.get('IMAP_FETCH_BATCH_BYTES', str(8 << 20)))  # bytes per command
+IMAP_FETCH_WINDOW = int(os.environ.get('IMAP_FETCH_WINDOW', '2'))                     # commands in flight
+IMAP_PARTIAL_MIN = int(os.environ.get('IMAP_PARTIAL_MIN', str(64 << 10)))             # smaller mail is fetched whole
+IMAP_SECTION_MAX = int(os.environ.get('IMAP_SECTION_MAX', str(2 << 20)))              # bytes per text/HTML section
+# Mail no alias and not the main mailbox routes to is kept, but only briefly
+IMAP_UNROUTED_SECTION_MAX = int(os.environ.get('IMAP_UNROUTED_SECTION_MAX', str(64 << 10)))
+# What routing needs: parse_message() reads these, the bodies come later
+ROUTING_HEADERS = ('From', 'To', 'Subject', 'Delivered-To', 'X-Original-To')
+STRUCTURE_BATCH = 1000      # messages per BODYSTRUCTURE command
+
+
+def imap_date(received_at):
+    """'2024-05-01 12:00:00' -> '01-May-2024' for SEARCH SINCE."""
+    return time.strftime('%d-%b-%Y', time.strptime(received_at[:10], '%Y-%m-%d'))
+
+
+def uid_set(uids):
+    """[1, 2, 3, 7, 9, 10] -> '1:3,7,9:10'"""
+    parts = []
+    uids = sorted(uids)
+    start = prev = uids[0]
+    for uid in uids[1:] + [None]:
+        if uid is not None and uid == prev + 1:
+            prev = uid
+            continue
+        parts.append(str(start) if start == prev else f'{start}:{prev}')
+        start = prev = uid
+    return ','.join(parts)
+
+
+def fetch_sizes(conn, uids):
+    """RFC822.SIZE of each uid, in one command. Messages gone in between are missing."""
+    if not uids:
+        return {}
+    typ, data = conn.uid('fetch', uid_set(uids), '(RFC822.SIZE)')
+    if typ != 'OK':
+        raise conn.error(f'UID FETCH RFC822.SIZE failed: {data}')
+    sizes = {}
+    for item in data:
+        line = item[0] if isinstance(item, tuple) else item
+        uid, size = UID_RE.search(line or b''), SIZE_RE.search(line or b'')
+        if uid and size:
+            sizes[int(uid.group(1))] = int(size.group(1))
+    return sizes
+
+
+def plan_batches(uids, sizes, max_messages=IMAP_FETCH_BATCH, max_bytes=IMAP_FETCH_BATCH_BYTES):
+    """
+    Splits uids into FETCH batches of at most max_messages and, where sizes
+    are known, max_bytes. A message larger than max_bytes goes alone.
+    """
+    batches, batch, total = [], [], 0
+    for uid in sorted(uids):
+        size = sizes.get(uid, 0)
+        if batch and (len(batch) >= max_messages or total + size > max_bytes):
+            batches.append(batch)
+            batch, total = [], 0
+        batch.append(uid)
+        total += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def fetch_stream(conn, batches, items='(UID RFC822)', window=IMAP_FETCH_WINDOW, on_batch=None):
+    """
+    Pipelined `UID FETCH`: keeps up to `window` batch commands in flight and
+    yields (uid, head, {item: bytes}) for every message as soon as its
+    literals have been read, e.g. (17, b'* 3 FETCH (UID 17 RFC822 )',
+    {b'RFC822': b'From: ...'}). A batch is a list of uids fetched with
+    `items`, or a (uids, items) pair. on_batch(uids) is called once all
+    messages of a batch have been yielded.
+
+    Reads the responses itself, so the generator must be run to the end or
+    the connection dropped; closing it early drains what is still in flight.
+    When reading fails (the connection aborted, a command failed) that error
+    is raised as is and nothing more is read.
+    """
+    batches = iter(batches)
+    pending = collections.OrderedDict()
+
+    def send_next():
+        batch = next(batches, None)
+        if batch is None:
+            return False
+        batch, batch_items = batch if isinstance(batch, tuple) else (batch, items)
+        tag = _untracked_tag(conn)
+        conn.send(b'%s UID FETCH %s %s\r\n' % (tag, uid_set(batch).encode(), batch_items.encode()))
+        pending[tag] = batch
+        return True
+
+    def read_response():
+        line = conn.readline()
+        tag = line.split(b' ', 1)[0]
+        if tag in pending:
+            batch = pending.pop(tag)
+            if not line[len(tag) + 1:].startswith(b'OK'):
+                raise conn.error(f'UID FETCH failed: {line.decode(errors="replace").strip()}')
+            return None, batch
+        if line.startswith(b'* BYE'):
+            raise conn.abort(line.decode(errors='replace').strip())
+        if line.startswith(b'* ') and b' FETCH ' in line[:32]:
+            return _read_fetch(conn, line), None
+        return None, None  # EXISTS, EXPUNGE and other untagged noise
+
+    while len(pending) < window and send_next():
+        pass
+    try:
+        while pending:
+            message, done = read_response()
+            if message:
+                head, literals = message
+                uid = UID_RE.search(head)
+                if uid:
+                    yield int(uid.group(1)), head, literals
+            elif done is not None:
+                if on_batch:
+                    on_batch(done)
+                send_next()
+    except GeneratorExit:
+        # The consumer stopped early: leave the connection usable. Not after
+        # an error, when the connection may be gone and the error is the news
+        while pending:
+            read_response()
+        raise
+
+
+def _untracked_tag(conn):
+    """
+    A new command tag that imaplib's own response loop will not wait for:
+    fetch_stream() reads the completion itself. This reaches into imaplib
+    internals (IMAP4._new_tag, IMAP4.tagged_commands), so it stays here.
+    """
+    try:
+        tag = conn._new_tag()
+        conn.tagged_commands.pop(tag, None)
+    except AttributeError as e:
+        raise RuntimeError(f'pipelined UID FETCH needs an imaplib.IMAP4 connection: {e}') from e
+    return tag
+
+
+def _read_fetch(conn, line):
+    """
+    Reads one '* n FETCH (...)' response: (text without item literals,
+    {item: bytes}). Literals inside a value, like a filename in
+    BODYSTRUCTURE, are put back into the text as quoted strings.
+    """
+    head = bytearray()
+    literals = {}
+    while True:
+        m = LITERAL_RE.search(line)
+        if not m:
+            head += line
+            return bytes(head), literals
+        data = conn.read(int(m.group(1)))
+        item = ITEM_RE.search(line, 0, m.start())
+        if item:
+            head += line[:m.start()]
+            literals[item.group(1)] = data
+        else:
+            head += line[:m.start()] + quote(data)
+        line = conn.readline()
+
+
+def fetch_messages(conn, uids, max_messages=IMAP_FETCH_BATCH, max_bytes=IMAP_FETCH_BATCH_BYTES,
+                   window=IMAP_FETCH_WINDOW, on_batch=None):
+    """Yields (uid, raw RFC822 bytes) for uids, in batches bounded by count and size."""
+    if not uids:
+        return
+    sizes = fetch_sizes(conn, uids) if max_bytes else {}
+    # Without sizes the byte cap cannot be planned, only the count cap
+    batches = plan_batches(uids, sizes, max_messages, max_bytes or float('inf'))
+    for uid, _, literals in fetch_stream(conn, batches, '(UID RFC822)', window, on_batch):
+        raw = literals.get(b'RFC822')
+        if raw is not None:
+            yield uid, raw
+
+
+def fetch_structured(conn, uids, owners=None, max_messages=IMAP_FETCH_BATCH, max_bytes=IMAP_FETCH_BATCH_BYTES,
+                     window=IMAP_FETCH_WINDOW, on_batch=None, source=None):
+    """
+    Header-first download: yields (uid, raw, fetched) for uids.
+
+    For every STRUCTURE_BATCH uids one command brings RFC822.SIZE,
+    BODYSTRUCTURE and the routing headers. owners(headers) gets
+    [{'to_raw', 'to_email'}] and returns them with 'owner_id'
+    (Database.assign_owners); mail nobody owns gets its sections cut at
+    IMAP_UNROUTED_SECTION_MAX instead of IMAP_SECTION_MAX. Messages up to
+    IMAP_PARTIAL_MIN are then fetched whole, larger ones as their text and
+    HTML sections only. `raw` is what parse_message() should read;
+    `fetched` is {'attachments', 'raw_size', 'truncated'}: the other parts,
+    with where to fetch them later (`source`, by default the selected
+    mailbox's name), the size on the server and whether a cap cut anything.
+    """
+    uids = sorted(uids)
+    mailbox = getattr(conn, 'selected', None) or {}
+    for i in range(0, len(uids), STRUCTURE_BATCH):
+        plans = _plan_fetch(conn, uids[i:i + STRUCTURE_BATCH], owners)
+        for uid, plan in plans.items():
+            for a in plan['attachments']:
+                a.update(source=source or mailbox.get('mailbox'), uidvalidity=mailbox.get('uidvalidity'), server_uid=uid)
+        batches = _group(plans, max_messages, max_bytes)
+        for uid, _, literals in fetch_stream(conn, batches, window=window, on_batch=_in_order(list(plans), on_batch)):
+            plan = plans.pop(uid, None)
+            if plan is None:
+                continue    # unsolicited FETCH, e.g. a flag change
+            if plan['sections'] is None:
+                raw = next((v for k, v in literals.items() if k == b'RFC822' or k.startswith(b'BODY[]')), None)
+                if raw is None:
+                    continue
+            else:
+                data = {_section_key(item): value for item, value in literals.items()}
+                raw = rebuild_message(plan['header'], plan['multipart'], [
+                    (part, _cut(data[part['section']], part, plan['cap']))
+                    for part in plan['sections'] if part['section'] in data
+                ])
+            yield uid, raw, {'attachments': plan['attachments'], 'raw_size': plan['size'],
+                             'truncated': plan['truncated']}
+
+
+def _plan_fetch(conn, uids, owners):
+    """Structure and routing headers of uids -> {uid: plan} in uid order, saying what to fetch next."""
+    items = '(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (%s)])' % ' '.join(ROUTING_HEADERS)
+    found = []
+    for uid, head, literals in fetch_stream(conn, [uids], items, window=1):
+        header = next((v for k, v in literals.items() if k.startswith(b'BODY[HEADER')), None)
+        size = SIZE_RE.search(head)
+        if header is None or not size:
+            continue
+        try:
+            structure = parse_value(head, head.index(b'BODYSTRUCTURE ') + len(b'BODYSTRUCTURE '))[0]
+            multipart, sections, attachments = split_parts(structure)
+        except (ValueError, IndexError, TypeError, AttributeError):
+            # Unreadable structure: fetch the whole message as before
+            multipart, sections, attachments = None, None, []
+        found.append((uid, {'size': int(size.group(1)), 'header': header, 'multipart': multipart,
+                            'sections': sections, 'attachments': attachments}))
+
+    found.sort(key=lambda f: f[0])
+    headers = [dict(zip(('to_raw', 'to_email'), recipient(email.message_from_bytes(p['header']))))
+               for _, p in found]
+    routed = owners(headers) if owners else headers
+    plans = collections.OrderedDict()
+    for (uid, plan), route in zip(found, routed):
+        plan['cap'] = IMAP_SECTION_MAX if route.get('owner_id', True) else IMAP_UNROUTED_SECTION_MAX
+        plan['truncated'] = False
+        if plan['size'] <= IMAP_PARTIAL_MIN:
+            plan['sections'] = None
+            plan['items'], plan['bytes'] = '(UID RFC822)', plan['size']
+        elif plan['sections'] is None:
+            # No structure to pick sections from: the start of the message, at most a section's worth
+            plan['items'] = f"(UID BODY.PEEK[]<0.{plan['cap']}>)"
+            plan['bytes'] = min(plan['size'], plan['cap'])
+            plan['truncated'] = plan['size'] > plan['cap']
+        else:
+            plan['items'] = '(%s)' % ' '.join(['UID'] + [
+                f"BODY.PEEK[{part['section']}]" + (f"<0.{plan['cap']}>" if part['size'] > plan['cap'] else '')
+                for part in plan['sections']
+            ])
+            plan['bytes'] = sum(min(part['size'], plan['cap']) for part in plan['sections'])
+            plan['truncated'] = any(part['size'] > plan['cap'] for part in plan['sections'])
+        plans[uid] = plan
+    return plans
+
+
+def _group(plans, max_messages, max_bytes):
+    """
+    Messages fetched with the same items share commands, within the batch
+    limits: all the whole ones, and each layout of text/HTML sections.
+    Batches are sent in order of their lowest uid.
+    """
+    by_items = collections.defaultdict(list)
+    for uid, plan in plans.items():
+        by_items[plan['items']].append(uid)
+    batches = []
+    for items, uids in by_items.items():
+        batch, total = [], 0
+        for uid in uids:
+            size = plans[uid]['bytes']
+            if batch and (len(batch) >= max_messages or total + size > max_bytes):
+                batches.append((batch, items))
+                batch, total = [], 0
+            batch.append(uid)
+            total += size
+        batches.append((batch, items))
+    batches.sort(key=lambda b: b[0][0])
+    return batches
+
+
+def _in_order(uids, on_batch):
+    """
+    Wraps on_batch for batches that finish out of uid order: it is called
+    with the uids below which everything is done, so a checkpoint at
+    max(uids) never skips a message still in flight.
+    """
+    done = set()
+    pos = 0
+
+    def batch_done(batch):
+        nonlocal pos
+        done.update(batch)
+        start = pos
+        while pos < len(uids) and uids[pos] in done:
+            pos += 1
+        if pos > start and on_batch:
+            on_batch(uids[start:pos])
+    return batch_done
+
+
+def _section_key(item):
+    """b'BODY[1.2]<0>' -> '1.2'"""
+    return item[item.index(b'[') + 1:item.index(b']')].decode()
+
+
+def _cut(data, part, cap):
+    # A section cut at the cap ends on a line break, so base64 and
+    # quoted-printable decode cleanly
+    if part['size'] > cap and len(data) >= cap and b'\n' in data:
+        return data[:data.rindex(b'\n') + 1]
+    return data
+
+
+def with_fetched(parsed, fetched):
+    """
+    A parse_message() dict completed from fetch_structured()'s `fetched`:
+    the attachments, the size of the message on the server (raw may be a
+    rebuilt part of it) and whether fetch or parse cut anything.
+    """
+    return {**parsed, 'attachments': fetched['attachments'], 'raw_size': fetched['raw_size'],
+            'truncated': bool(parsed.get('truncated') or fetched['truncated'])}
+
+
+def fetch_attachment(conn, attachment, mailbox=None):
+    """
+    Downloads one attachment recorded by fetch_structured() from `mailbox`
+    (default: its source): decoded bytes, or None when the server copy is
+    gone (expunged, or UIDVALIDITY changed).
+    """
+    typ, _ = conn.select(mailbox or attachment['source'], readonly=True)
+    if typ != 'OK' or conn.selected['uidvalidity'] != attachment['uidvalidity']:
+        return None
+    typ, data = conn.uid('fetch', str(attachment['server_uid']), f"(BODY.PEEK[{attachment['section']}])")
+    if typ != 'OK':
+        raise conn.error(f'UID FETCH failed: {data}')
+    literal = next((item[1] for item in data if isinstance(item, tuple)), None)
+    if literal is None:
+        return None
+    return decode_section(literal, attachment['encoding'])
+
+
+class MailboxSync:
+    """
+    Brings one source up to date: `source` names it (account/folder) in
+    sync_state and on the stored messages, and the connection given to
+    sync() has its folder selected. `parse(raw)` turns an RFC822 message
+    into the dict add_emails() expects; parsed messages go to a sink with
+    add() and flush(), e.g. ingest.PipelineSink. With defer_parse the sink
+    gets the raw records instead ({'source', 'uidvalidity', 'server_uid',
+    'raw', 'fetched', 'resync_from'}) and parsing is left to whoever
+    calls prepare() on them.
+    """
+
+    def __init__(self, db, parse, source='INBOX', initial_count=50,
+                 batch_messages=IMAP_FETCH_BATCH, batch_bytes=IMAP_FETCH_BATCH_BYTES, defer_parse=False):
+        self.db = db
+        self.parse = parse
+        self.defer_parse = defer_parse
+        self.source = source
+        # How much history a brand new source starts with
+        self.initial_count = initial_count
+        self.batch_messages = batch_messages
+        self.batch_bytes = batch_bytes
+        self._selected = None
+
+    def sync(self, conn, sink):
+        """Fetches everything above the high-water mark. Returns the number of messages handed to sink."""
+        info = conn.selected
+        # Every SELECT brings a fresh status; a connection that stayed in
+        # the folder (IDLE) has to search
+        fresh_session = info is not self._selected
+        self._selected = info
+
+        state = self.db.get_sync_state(self.source)
+        since = None
+        if state is None:
+            state = self._initial_state(conn, info)
+        elif state['uidvalidity'] is None:
+            # Position adopted from a database that never saw UIDVALIDITY
+            state['uidvalidity'] = info['uidvalidity']
+        elif info['uidvalidity'] is not None and state['uidvalidity'] != info['uidvalidity']:
+            state, since = self._reset_state(conn, state, info)
+
+        last = state['last_uid']
+        modseq = info['highestmodseq']
+        if fresh_session and not since:
+            # Right after SELECT the status says whether anything is new
+            nothing_new = (info['uidnext'] is not None and info['uidnext'] <= last + 1) or \
+                          (modseq is not None and modseq == state['highest_modseq'])
+            if nothing_new:
+                self._save(info, last, state, modseq)
+                return 0
+
+        criteria = f'SINCE {since}' if since else f'UID {last + 1}:*'
+        typ, data = conn.uid('search', None, criteria)
+        if typ != 'OK':
+            raise conn.error(f'UID SEARCH failed: {data}')
+        # "n:*" always matches the last message, even below n
+        uids = sorted(u for u in (int(x) for x in data[0].split()) if u > last)
+
+        count = 0
+
+        def checkpoint(batch):
+            # Commit a finished batch before moving the mark past it, so an
+            # interrupted catch-up resumes after the last complete batch
+            sink.flush()
+            self._save(info, max(batch), state, None)
+
+        stream = fetch_structured(conn, uids, self.db.assign_owners, self.batch_messages, self.batch_bytes,
+                                  on_batch=checkpoint, source=self.source)
+        for uid, raw, fetched in stream:
+            record = {'source': self.source, 'uidvalidity': info['uidvalidity'], 'server_uid': uid,
+                      'raw': raw, 'fetched': fetched,
+                      'resync_from': state['resync_from'] if since else None}
+            if self.defer_parse:
+                sink.add(record)
+                count += 1
+                continue
+            try:
+                message = self.prepare(record)
+                if message is not None:
+                    sink.add(message)
+                    count += 1
+            except Exception as e:
+                print(f"Error processing UID {uid} of {self.source}: {e}")
+        if uids:
+            last = uids[-1]
+
+        sink.flush()
+        self._save(info, last, state, modseq)
+        return count
+
+    def prepare(self, record):
+        """
+        Parses a fetched record into the add_emails() dict. None when a resync
+        finds the message already stored.
+        """
+        parsed = self.parse(record['raw'])
+        if record.get('resync_from') and self.db.has_similar_email(
+                parsed.get('to_email'), parsed.get('from'), parsed.get('subject'), record['resync_from']):
+            return None
+        return {**with_fetched(parsed, record['fetched']), 'source': record['source'],
+                'uidvalidity': record['uidvalidity'], 'server_uid': record['server_uid']}
+
+    def _save(self, info, last_uid, state, modseq):
+        self.db.save_sync_state(self.source, info['uidvalidity'], last_uid, state['first_uid'], modseq,
+                                state.get('gap_floor'))
+
+    def _initial_state(self, conn, info):
+        last = 0
+        if info['exists']:
+            # Sequence numbers are dense, so the last N messages are easy to find
+            first = max(1, info['exists'] - self.initial_count + 1)
+            typ, data = conn.fetch(f'{first}:*', '(UID)')
+            uids = [int(m.group(1)) for m in (UID_RE.search(d) for d in data if isinstance(d, bytes)) if m]
+            last = min(uids) - 1 if typ == 'OK' and uids else 0
+        # Everything below is left to the backfill
+        return {'uidvalidity': info['uidvalidity'], 'last_uid': last, 'first_uid': last + 1,
+                'highest_modseq': None}
+
+    def _uid_next(self, conn, info):
+        if info['uidnext'] is not None:
+            return info['uidnext']
+        # "*" is the highest UID in the mailbox
+        typ, data = conn.uid('search', None, 'UID *')
+        found = [int(x) for x in data[0].split()] if typ == 'OK' and data and data[0] else []
+        return max(found, default=0) + 1
+
+    def _reset_state(self, conn, state, info):
+        resync_from = self.db.get_last_received_at(self.source)
+        print(f"UIDVALIDITY of {self.source} changed {state['uidvalidity']} -> {info['uidvalidity']}; "
+              f"resyncing since {resync_from or 'the beginning'}")
+        # The history before the reset is not reachable any more. What the
+        # mailbox holds now is resynced or stored under the old UIDVALIDITY,
+        # so gap reconciliation starts above it
+        new_state = {
+            'uidvalidity': info['uidvalidity'], 'last_uid': 0, 'first_uid': 1,
+            'highest_modseq': None, 'resync_from': resync_from, 'gap_floor': self._uid_next(conn, info),
+        }
+        if not resync_from:
+            return new_state, None
+        return new_state, imap_date(resync_from)
@@ -0,0 +1,252 @@
+"""
+Mail intake as the bot runs it, without the Telegram side: every source of
+the IMAP accounts (IngestScheduler: IDLE, or polling past the connection
+budget) and optionally LMTP/SMTP from our MTA, through the parse -> store ->
+notify pipeline, plus the history backfill of each new source and, every
+RECONCILE_INTERVAL, a pass that fetches again what the sync skipped
+(imap_reconcile.py).
+
+New emails are announced through the outbox (outbox.py): send(chat_id,
+email) is called once per stored email, retried until it succeeds. Only
+the first pass over a source the database has never seen is stored
+without notifications; after a restart, what arrived meanwhile is
+announced like live mail. bot1 passes its Telegram send;
+benchmarks/bench_ingest.py runs the same loop against benchmarks/fake_imap.py.
+
+    ingest = MailIngest(db, accounts, parser_pool.parse, send)
+    threading.Thread(target=ingest.run).start()
+    ...
+    ingest.stop()       # waits for what was already downloaded to be stored
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from imap_backfill import BACKFILL_RATE, Backfill, Throttle
+from imap_reconcile import RECONCILE_INTERVAL, Reconciler
+from imap_scheduler import IngestScheduler, source_name
+from imap_sync import MailboxSync
+from mail_parser import PARSE_PROCESSES
+from outbox import Outbox
+from pipeline import Pipeline, Stage
+from smtp_ingest import IngestServer, SMTP_DELIVERY_TIMEOUT, SMTP_INGEST_PORT, SMTP_SOURCE
+
+# Emails per store transaction, and how long a partial batch waits
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', '200'))
+INGEST_FLUSH_INTERVAL = float(os.environ.get('INGEST_FLUSH_INTERVAL', '2.0'))
+# Threads of the parse and notify stages and the queue between stages. The
+# parsing itself runs in PARSE_PROCESSES processes; twice as many threads keep them busy
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', str(max(2, 2 * PARSE_PROCESSES))))
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', '4'))
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', '200'))
+PIPELINE_REPORT_INTERVAL = int(os.environ.get('PIPELINE_REPORT_INTERVAL', '60'))
+
+
+def settle(messages, error=None):
+    """Answers whoever waits for a message to be stored (LMTP/SMTP): its uid or the error."""
+    for m in messages:
+        delivered = m.get('delivered')
+        if delivered is None or delivered.done():
+            continue
+        if error is not None:
+            delivered.set_exception(error)
+        else:
+            delivered.set_result(m.get('uid'))
+
+
+def report_synced(stored_batch):
+    uids = [m['uid'] for m in stored_batch]
+    print(f"✅ Synced {len(uids)} emails (UID {min(uids)}..{max(uids)})")
+
+
+class PipelineSink:
+    """MailboxSync's sink: flush() waits until the records are stored; notifications go on by themselves."""
+
+    def __init__(self, pipeline, quiet=False):
+        self.pipeline = pipeline
+        self.quiet = quiet
+
+    def add(self, record):
+        self.pipeline.put({**record, 'quiet': self.quiet})
+
+    def flush(self):
+        self.pipeline.flush('store')
+
+
+class MailIngest:
+    """
+    Runs the intake of `accounts` (imap_scheduler.Account) into `db`.
+    parse(raw) gives the add_emails() dict (mail_parser.parse_message or
+    ParserPool.parse); send(chat_id, email) sends a notification and returns
+    its message id (see Outbox); progress(p) gets backfill progress (see
+    Backfill). With smtp_port set, an IngestServer takes pushed mail as well.
+    Sources are reconciled every reconcile_interval seconds (0: never).
+    """
+
+    def __init__(self, db, accounts, parse, send, smtp_port=SMTP_INGEST_PORT, progress=None,
+                 throttle=None, report_interval=PIPELINE_REPORT_INTERVAL, reconcile_interval=RECONCILE_INTERVAL):
+        self.db = db
+        self.accounts = accounts
+        self.parse = parse
+        self.outbox = Outbox(db, send)
+        self.progress = progress
+        self.report_interval = report_interval
+        self.reconcile_interval = reconcile_interval
+        self.throttle = throttle or Throttle(BACKFILL_RATE)
+        self.running = False
+        self.folders = {}
+        for account in accounts:
+            for folder in account.folders:
+                self.folders[source_name(account.user, folder)] = (account, folder)
+        # Messages go into the pipeline raw; the parse stage parses them
+        self.syncs = {name: MailboxSync(db, parse, source=name, defer_parse=True) for name in self.folders}
+        self.smtp_server = IngestServer(db, parse, self.deliver, port=smtp_port) if smtp_port else None
+        self.pipeline = None
+        self.scheduler = None
+        self._sinks = {}
+        self._caught_up = set()
+        self._backfills = queue.Queue()
+        self._reconciler = None
+
+    def build_pipeline(self):
+        """
+        fetch (IDLE and folder poll threads, LMTP/SMTP) -> parse -> store in
+        batches -> notify. Bounded queues join the stages: a slow Telegram
+        upload holds up only notifications, and when those are full, the download.
+        """
+        prepare = {**self.syncs, SMTP_SOURCE: self.smtp_server} if self.smtp_server else self.syncs
+
+        def parse(record):
+            try:
+                message = prepare[record['source']].prepare(record)
+            except Exception as e:
+                settle([record], e)
+                raise
+            return message and {**message, 'notify': not record['quiet'], 'delivered': record.get('delivered')}
+
+        def store(batch):
+            try:
+                stored = self.db.add_emails(batch, raise_errors=True)
+            except Exception as e:
+                settle(batch, e)
+                raise
+            settle(stored)
+            # Ones stored before count as delivered too
+            settle(batch)
+            # A new source's first pass does not notify, only logs
+            quiet = [m for m in stored if not m['notify']]
+            if quiet:
+                report_synced(quiet)
+            return [m for m in stored if m['notify']]
+
+        return Pipeline([
+            Stage('parse', parse, workers=PARSE_WORKERS, queue_size=INGEST_QUEUE_SIZE),
+            # Mail from the MTA is written at once: the MTA waits for the reply
+            Stage('store', store, queue_size=INGEST_QUEUE_SIZE,
+                  batch_size=INGEST_BATCH_SIZE, batch_timeout=INGEST_FLUSH_INTERVAL,
+                  urgent=lambda m: m.get('delivered') is not None),
+            # Sends from memory; what fails here the outbox worker retries
+            Stage('notify', self.outbox.deliver, workers=NOTIFY_WORKERS, queue_size=INGEST_QUEUE_SIZE),
+        ])
+
+    def deliver(self, record):
+        """Mail from our MTA: into the same pipeline; returns once it is stored."""
+        delivered = Future()
+        self.pipeline.put({**record, 'quiet': False, 'delivered': delivered}, timeout=SMTP_DELIVERY_TIMEOUT)
+        return delivered.result(SMTP_DELIVERY_TIMEOUT)
+
+    def run(self):
+        """Blocks until stop()."""
+        self.running = True
+        # Before anything is stored: the leases of the previous run's notifications are dropped
+        self.outbox.start()
+        self.pipeline = self.build_pipeline()
+        # Only a source with no sync position yet starts quietly (its newest messages)
+        self._sinks = {name: PipelineSink(self.pipeline, quiet=self.db.get_sync_state(name) is None)
+                       for name in self.folders}
+        threading.Thread(target=self._report_loop, daemon=True).start()
+        if self.smtp_server:
+            self.smtp_server.start()
+        threading.Thread(target=self._run_backfills, daemon=True).start()
+        if self.reconcile_interval:
+            threading.Thread(target=self._reconcile_loop, daemon=True).start()
+        # An IDLE connection per folder while the account's budget allows; the other folders are polled
+        self.scheduler = IngestScheduler(self.accounts, self._ingest_new)
+        self.scheduler.run()
+
+    def stop(self, thread=None, timeout=30):
+        """Stops taking mail and drains what was already downloaded. Returns False if that timed out."""
+        self.running = False
+        if self.scheduler:
+            self.scheduler.stop()
+        if self.smtp_server:
+            self.smtp_server.stop()
+        if self._reconciler:
+            self._reconciler.stop()
+        if thread:
+            # The sync pass in progress hands its messages to the pipeline
+            thread.join(timeout=timeout)
+        drained = True
+        if self.pipeline is not None:
+            print("⏳ Draining ingest pipeline...")
+            drained = self.pipeline.close(timeout=timeout)
+            if not drained:
+                print(f"Pipeline not drained: {self.pipeline.format_stats()}")
+        self.outbox.stop()
+        return drained
+
+    def _ingest_new(self, source, conn):
+        # Called after every (re)connect, on each EXISTS and on every folder poll
+        sink = self._sinks[source]
+        with self.throttle.hold():
+            self.syncs[source].sync(conn, sink)
+        sink.quiet = False
+        if source not in self._caught_up:
+            self._caught_up.add(source)
+            print(f"🏁 Sync Complete: {source}. Monitoring from UID: {self.db.get_sync_state(source)['last_uid']}")
+            self._backfills.put(source)
+
+    def _run_backfills(self):
+        # History downloads one source at a time, over that account's connections;
+        # live mail goes first (throttle.hold)
+        while self.running:
+            name = self._backfills.get()
+            account, folder = self.folders[name]
+            backfill = Backfill(self.db, account.connect, self.parse, source=name, mailbox=folder,
+                                throttle=self.throttle, progress=self.progress)
+            try:
+                stored = backfill.run()
+                if stored:
+                    print(f"📥 Backfill of {name} stored {stored} emails")
+            except Exception as e:
+                print(f"Backfill Error ({name}): {e}")
+
+    def _reconcile_loop(self):
+        # One source at a time, at backfill priority; only sources this run has caught up
+        while self.running:
+            time.sleep(self.reconcile_interval)
+            for name in sorted(self._caught_up):
+                if not self.running:
+                    break
+                account, folder = self.folders[name]
+                self._reconciler = Reconciler(self.db, account.connect, self.parse, source=name, mailbox=folder,
+                                              throttle=self.throttle)
+                try:
+                    result = self._reconciler.run()
+                except Exception as e:
+                    print(f"Reconcile Error ({name}): {e}")
+                    continue
+                if result['gaps'] or result['recovered']:
+                    print(f"🩹 {name}: {result['recovered']} missing emails fetched again, "
+                          f"{result['gaps']} still missing")
+
+    def _report_loop(self):
+        last = None
+        while self.running:
+            time.sleep(self.report_interval)
+            line = self.pipeline.format_stats()
+            if line != last:
+                print(f"📊 {line}")
+                last = line
@@ -0,0 +1,648 @@
+"""
+Message parsing for ingestion: MIME walk, header decoding, text extraction
+from HTML-only mail, action links and the Telegram preview.
+
+HTML is read by HtmlExtractor in a single pass over html.parser events,
+without building a tree: it gives the same text as BeautifulSoup's
+get_text(separator="\n") and the same links the old find_all('a') scan
+found. parse_message() returns a compact dict of plain values, so it can
+run in a worker process; ParserPool runs it in a process pool, which keeps
+the CPU-heavy work off the interpreter that serves the bot.
+
+Large messages are received into a MessageSpool, which moves to a temporary
+file past MAIL_SPOOL_THRESHOLD; parse_message() then reads them in chunks
+through a BytesFeedParser that only ever sees the headers and the text and
+HTML parts, up to their caps. Memory per message stays at about the caps
+whatever the size of the attachments.
+"""
+import email
+import html
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email.header import decode_header
+from email.parser import BytesFeedParser, BytesHeaderParser
+from html.entities import html5
+from html.parser import HTMLParser
+
+PARSE_PROCESSES = int(os.environ.get('PARSE_PROCESSES', str(max(1, (os.cpu_count() or 2) // 2))))
+# Bigger raw mail goes to a temporary file and is parsed from there in chunks
+MAIL_SPOOL_THRESHOLD = int(os.environ.get('MAIL_SPOOL_THRESHOLD', str(1 << 20)))
+MAIL_SPOOL_DIR = os.environ.get('MAIL_SPOOL_DIR') or None                       # default: system temp dir
+# Stored text (characters) and HTML (bytes); longer bodies are cut and the email marked truncated
+MAIL_TEXT_MAX = int(os.environ.get('MAIL_TEXT_MAX', str(2 << 20)))
+MAIL_HTML_MAX = int(os.environ.get('MAIL_HTML_MAX', str(2 << 20)))
+SPOOL_CHUNK = 64 << 10
+HEADER_MAX = 256 << 10      # header block of one part
+LINE_MAX = 64 << 10         # longer lines are passed on in pieces
+# Encoded bytes per decoded byte, worst case, when budgeting a part's body
+_ENCODING_FACTOR = {'base64': 4 / 3, 'quoted-printable': 3}
+
+# Link texts/urls that make a button under the notification
+LINK_KEYWORDS = ['confirm', 'verify', 'activate', 'login', 'sign in', 'подтвердить', 'активировать', 'войти']
+URL_RE = re.compile(r'(https?://[^\s<>"]+)')
+CODE_RE = re.compile(r'(?<!\d)(\d{4,8})(?!\d)')
+PREVIEW_LIMIT = 3000
+
+
+def decode_str(s):
+    if s is None: return ""
+    decoded_list = decode_header(s)
+    header_value = ""
+    for decoded, charset in decoded_list:
+        if isinstance(decoded, bytes):
+            try:
+                header_value += decoded.decode(charset or 'utf-8')
+            except:
+                header_value += decoded.decode('utf-8', errors='ignore')
+        else:
+            header_value += str(decoded)
+    return header_value
+
+
+def extract_email_address(raw_str):
+    """'Name <email@domain.com>' -> 'email@domain.com'"""
+    match = re.search(r'<([^>]+)>', raw_str)
+    if match:
+        return match.group(1).lower().strip()
+    # No brackets: maybe a bare address
+    if '@' in raw_str:
+        return raw_str.lower().strip()
+    return None
+
+
+def recipient(msg):
+    """(decoded To, routing address) of a message or of its headers alone."""
+    to_raw = decode_str(msg["To"])
+    to_email = extract_email_address(to_raw)
+
+    # Delivered-To / X-Original-To for forwarded mail
+    if not to_email:
+        delivered_to = msg.get("Delivered-To") or msg.get("X-Original-To")
+        if delivered_to:
+            to_email = extract_email_address(str(delivered_to))
+    return to_raw, to_email
+
+
+# Tree-builder rules of BeautifulSoup's html.parser backend that decide
+# which strings exist and how they read
+_EMPTY_ELEMENTS = frozenset([
+    'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image',
+    'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source',
+    'spacer', 'track', 'wbr',
+])
+_PRESERVE_WHITESPACE = frozenset(['pre', 'textarea'])
+# Strings inside these are not text (scripts, styles, templates, ruby annotations)
+_NOT_TEXT = frozenset(['script', 'style', 'template', 'rt', 'rp'])
+_ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+_ENTITIES = {}
+for _name, _char in sorted(html5.items()):
+    _ENTITIES.setdefault(_name[:-1] if _name.endswith(';') else _name, _char)
+_DECIMAL_REF_RE = re.compile(r'^([0-9]+)(.*)')
+_HEX_REF_RE = re.compile(r'^([0-9a-f]+)(.*)')
+_XML_ENCODING_RE = re.compile(rb'^\s*<\?.*encoding=[\'"](.*?)[\'"].*\?>', re.I)
+_META_CHARSET_RE = re.compile(rb'<\s*meta[^>]+charset\s*=\s*["\']?([^>]*?)[ /;\'">]', re.I)
+# Anchor text kept for scoring; keeps one giant link from holding the whole body
+ANCHOR_TEXT_LIMIT = 4096
+
+
+def decode_html(data):
+    """Bytes -> str the way BeautifulSoup guesses: BOM, declared charset, utf-8, windows-1252."""
+    candidates = []
+    for bom, codec in ((b'\xef\xbb\xbf', 'utf-8'), (b'\xff\xfe', 'utf-16le'), (b'\xfe\xff', 'utf-16be')):
+        if data.startswith(bom) and (codec == 'utf-8' or data[2:4] != b'\x00\x00'):
+            data = data[len(bom):]
+            candidates.append(codec)
+            break
+    declared = _XML_ENCODING_RE.search(data, 0, 1024) or \
+        _META_CHARSET_RE.search(data, 0, max(2048, int(len(data) * 0.05)))
+    if declared:
+        candidates.append(declared.group(1).decode('ascii', 'replace').lower())
+    candidates += ['utf-8', 'windows-1252']
+    for errors in ('strict', 'replace'):
+        for codec in candidates:
+            try:
+                return data.decode(codec, errors)
+            except (LookupError, UnicodeDecodeError):
+                continue
+    return data.decode('utf-8', 'replace')
+
+
+def _numeric_reference(n):
+    if n == 0 or n > 0x10FFFF or 0xD800 <= n <= 0xDFFF:
+        return '\ufffd'
+    if 0x80 <= n <= 0x9F:
+        # References written as windows-1252 byte values
+        try:
+            return bytes([n]).decode('windows-1252')
+        except UnicodeDecodeError:
+            pass
+    return chr(n)
+
+
+class _LinkPicker:
+    """The three best keyword links in document order, without keeping them all."""
+
+    def __init__(self):
+        self.by_score = {2: [], 1: []}
+        self.seen = set()
+
+    @property
+    def full(self):
+        return len(self.by_score[2]) >= 3
+
+    def add(self, href, text):
+        text = text.strip().lower()
+        # Keyword in the link text beats keyword in the url
+        score = 0
+        if any(k in text for k in LINK_KEYWORDS):
+            score = 2
+        elif any(k in href.lower() for k in LINK_KEYWORDS):
+            score = 1
+        if score > 0 and href not in self.seen and "http" in href:
+            self.seen.add(href)
+            if len(self.by_score[score]) < 3:
+                label = text if len(text) < 30 and text else "🔗 action"
+                self.by_score[score].append({"url": href, "label": label, "score": score})
+
+    def links(self):
+        return (self.by_score[2] + self.by_score[1])[:3]
+
+
+class HtmlExtractor(HTMLParser):
+    """
+    Single pass over an HTML document. feed() it str chunks, then close();
+    `text` is what BeautifulSoup's get_text(separator="\\n") returns and
+    links() the action links. Nothing but the text, the open tag names and
+    the anchors still in progress is kept.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self._parts = []
+        self._run = []              # current string, split by entity refs
+        self._stack = []            # open tag names
+        self._closed_empty = []     # <br> seen, a later </br> is ignored
+        self._anchors = []          # [href, text parts, text length, closed, depth] in document order
+        self._picker = _LinkPicker()
+
+    @property
+    def text(self):
+        return '\n'.join(self._parts)
+
+    def links(self):
+        return self._picker.links()
+
+    def close(self):
+        super().close()
+        self._end_string()
+        for anchor in self._anchors:
+            anchor[3] = True
+        self._flush_anchors()
+
+    def _end_string(self):
+        if not self._run:
+            return
+        data = ''.join(self._run)
+        self._run = []
+        if not _PRESERVE_WHITESPACE.intersection(self._stack) and not data.strip(_ASCII_SPACES):
+            data = '\n' if '\n' in data else ' '
+        if _NOT_TEXT.intersection(self._stack):
+            return
+        self._parts.append(data)
+        for anchor in self._anchors:
+            if not anchor[3] and anchor[2] < ANCHOR_TEXT_LIMIT:
+                anchor[1].append(data)
+                anchor[2] += len(data)
+
+    def _flush_anchors(self):
+        # Scored in the order the anchors start, like find_all()
+        while self._anchors and self._anchors[0][3]:
+            href, parts = self._anchors.pop(0)[:2]
+            if not self._picker.full:
+                self._picker.add(href, ''.join(parts))
+
+    def _push(self, tag, attrs):
+        self._stack.append(tag)
+        if tag == 'a':
+            href = None
+            for key, value in attrs:
+                if key == 'href':
+                    href = value or ''
+            if href is not None:
+                self._anchors.append([href, [], 0, False, len(self._stack)])
+
+    def _pop_to(self, tag):
+        if tag not in self._stack:
+            return
+        while self._stack:
+            name = self._stack.pop()
+            depth = len(self._stack) + 1
+            if name == 'a':
+                for anchor in self._anchors:
+                    if not anchor[3] and anchor[4] == depth:
+                        anchor[3] = True
+            if name == tag:
+                break
+        self._flush_anchors()
+
+    def handle_starttag(self, tag, attrs, empty_element=True):
+        self._end_string()
+        self._push(tag, attrs)
+        if tag in _EMPTY_ELEMENTS and empty_element:
+            self._pop_to(tag)
+            self._closed_empty.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, empty_element=False)
+        self._end_string()
+        self._pop_to(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._closed_empty:
+            self._closed_empty.remove(tag)
+            return
+        self._end_string()
+        self._pop_to(tag)
+
+    def handle_data(self, data):
+        self._run.append(data)
+
+    def handle_charref(self, name):
+        base = 16 if name[:1] in ('x', 'X') else 10
+        digits = name[1:] if base == 16 else name
+        extra = ''
+        try:
+            n = int(digits, base)
+        except ValueError:
+            m = (_HEX_REF_RE if base == 16 else _DECIMAL_REF_RE).match(digits)
+            n, extra = (int(m.group(1), base), m.group(2)) if m else (None, name)
+        if n is not None:
+            self._run.append(_numeric_reference(n))
+        if extra:
+            self._run.append(extra)
+
+    def handle_entityref(self, name):
+        self._run.append(_ENTITIES.get(name, '&' + name))
+
+    def handle_comment(self, data):
+        self._end_string()
+
+    def handle_decl(self, decl):
+        self._end_string()
+
+    def handle_pi(self, data):
+        self._end_string()
+
+    def unknown_decl(self, data):
+        self._end_string()
+        if data.upper().startswith('CDATA['):
+            # CDATA sections count as text
+            self._run.append(data[len('CDATA['):])
+            self._end_string()
+
+
+def extract_html(html_bytes):
+    """HTML bytes -> (text, links) in one pass; ('', []) if the markup cannot be read."""
+    extractor = HtmlExtractor()
+    try:
+        markup = decode_html(html_bytes) if isinstance(html_bytes, bytes) else html_bytes
+        # One feed() like BeautifulSoup: html.parser recovers from a broken
+        # '&#' differently when it falls on a chunk boundary
+        extractor.feed(markup)
+        extractor.close()
+    except Exception:
+        return '', []
+    return extractor.text.strip(), extractor.links()
+
+
+def text_links(text_body):
+    """Keyword urls in plain text, for mail whose HTML has no action links."""
+    links = []
+    seen = set()
+    for url in URL_RE.findall(text_body):
+        if url not in seen and any(k in url.lower() for k in LINK_KEYWORDS):
+            links.append({"url": url, "label": "🔗 link", "score": 1})
+            seen.add(url)
+    return links[:3]
+
+
+def extract_links(html_bytes, text_body):
+    """Finds activation/confirmation links, best 3."""
+    links = extract_html(html_bytes)[1] if html_bytes else []
+    return links or text_links(text_body)
+
+
+def smart_format_text(text):
+    # Escape HTML first
+    text = html.escape(text)
+    # Codes (4-8 digits) in <code>
+    text = CODE_RE.sub(r'<code>\1</code>', text)
+    if len(text) > PREVIEW_LIMIT:
+        text = text[:PREVIEW_LIMIT] + "...\n(полный текст в файле)"
+    return text
+
+
+class MessageSpool:
+    """
+    A raw message as it is received: in memory up to `threshold` bytes, then
+    in a temporary file. message() is what parse_message() takes (the bytes,
+    or the file's path); close() removes the file.
+
+        with MessageSpool() as spool:
+            for chunk in chunks:
+                spool.write(chunk)
+            parsed = parse_message(spool.message())
+    """
+
+    def __init__(self, threshold=MAIL_SPOOL_THRESHOLD, dir=MAIL_SPOOL_DIR):
+        self.threshold = threshold
+        self.dir = dir
+        self.size = 0
+        self._chunks = []
+        self._file = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self._file is None and self.size > self.threshold:
+            self._file = tempfile.NamedTemporaryFile(prefix='mail-', suffix='.eml', dir=self.dir, delete=False)
+            self._file.writelines(self._chunks)
+            self._chunks = []
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._chunks.append(data)
+
+    def message(self):
+        if self._file is None:
+            return b''.join(self._chunks)
+        self._file.flush()
+        return self._file.name
+
+    def close(self):
+        self._chunks = []
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.unlink(self._file.name)
+            except FileNotFoundError:
+                pass
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _PartFilter:
+    """
+    Sits in front of a BytesFeedParser and passes on only what
+    parse_message() reads: the headers, and the bodies of the text and HTML
+    parts while their budgets last. Attachments, preambles and epilogues are
+    dropped as they stream past; `truncated` is set when a kept body is cut.
+    """
+
+    def __init__(self, parser, text_max=MAIL_TEXT_MAX, html_max=MAIL_HTML_MAX):
+        self.parser = parser
+        self.left = {'text': text_max, 'html': html_max}
+        self.truncated = False
+        self._boundaries = []       # open multiparts, innermost last
+        self._top = True            # the current part is the message itself
+        self._in_header = True
+        self._header = []
+        self._header_size = 0
+        self._kind = None           # budget the current body counts against, None: dropped
+        self._factor = 1
+        self._partial = b''
+        self._midline = False       # the next piece continues an over-long line
+
+    def feed(self, data):
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._line(line + b'\n')
+        if len(self._partial) > LINE_MAX:
+            self._line(self._partial)
+            self._partial = b''
+
+    def close(self):
+        if self._partial:
+            self._line(self._partial)
+            self._partial = b''
+        return self.parser.close()
+
+    def _line(self, line):
+        continued = self._midline
+        self._midline = not line.endswith(b'\n')
+        if self._in_header:
+            # Pieces of an over-long header line are dropped
+            if not continued and not self._midline:
+                self._header_line(line)
+        elif continued or not (self._boundaries and line.startswith(b'--') and self._boundary(line)):
+            self._body(line)
+
+    def _boundary(self, line):
+        """Handles a boundary line of any open multipart; False if it is not one."""
+        marker = line.rstrip()
+        for i in range(len(self._boundaries) - 1, -1, -1):
+            boundary = b'--' + self._boundaries[i]
+            if marker == boundary:
+                # A boundary of an outer multipart also closes the inner ones
+                del self._boundaries[i + 1:]
+                self.parser.feed(line)
+                self._top = False
+                self._in_header = True
+                self._header, self._header_size = [], 0
+                return True
+            if marker == boundary + b'--':
+                del self._boundaries[i:]
+                self.parser.feed(line)
+                self._kind = None
+                return True
+        return False
+
+    def _header_line(self, line):
+        if line in (b'\n', b'\r\n'):
+            self.parser.feed(line)
+            self._end_header()
+        elif self._header_size < HEADER_MAX:
+            self._header.append(line)
+            self._header_size += len(line)
+            self.parser.feed(line)
+
+    def _end_header(self):
+        part = BytesHeaderParser().parsebytes(b''.join(self._header))
+        self._in_header = False
+        self._kind = None
+        content_type = part.get_content_type()
+        if part.get_content_maintype() == 'multipart':
+            boundary = part.get_boundary()
+            if boundary:
+                self._boundaries.append(boundary.encode('ascii', 'surrogateescape'))
+            return
+        if content_type == 'message/rfc822':
+            # The attached message's own headers follow; its parts count like ours
+            self._top = False
+            self._in_header = True
+            self._header, self._header_size = [], 0
+            return
+        if self._top:
+            # A single-part message is read as text whatever its type
+            self._kind = 'html' if content_type == 'text/html' else 'text'
+        elif content_type in ('text/plain', 'text/html') and 'attachment' not in str(part.get('Content-Disposition')):
+            self._kind = 'html' if content_type == 'text/html' else 'text'
+        self._factor = _ENCODING_FACTOR.get(str(part.get('Content-Transfer-Encoding', '')).strip().lower(), 1)
+
+    def _body(self, line):
+        if self._kind is None:
+            return
+        cost = len(line) / self._factor
+        if cost > self.left[self._kind]:
+            # Whole lines only, so base64 and quoted-printable still decode
+            self.left[self._kind] = 0
+            self.truncated = True
+            return
+        self.left[self._kind] -= cost
+        self.parser.feed(line)
+
+
+def _read_spooled(path):
+    """(Message, size, truncated) of a spooled message, read through _PartFilter."""
+    feed = _PartFilter(BytesFeedParser(), MAIL_TEXT_MAX, MAIL_HTML_MAX)
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(SPOOL_CHUNK)
+            if not chunk:
+                break
+            size += len(chunk)
+            feed.feed(chunk)
+    return feed.close(), size, feed.truncated
+
+
+def parse_message(raw_email):
+    """
+    RFC822 bytes, or the path of a spooled message (MessageSpool) ->
+    {subject, from, to_raw, to_email, text, html, links, preview, raw_size,
+    truncated}, the dict add_emails() stores plus what the notification
+    needs. Text and HTML are cut at MAIL_TEXT_MAX and MAIL_HTML_MAX.
+    """
+    if isinstance(raw_email, (bytes, bytearray)):
+        msg = email.message_from_bytes(raw_email)
+        raw_size, truncated = len(raw_email), False
+    else:
+        msg, raw_size, truncated = _read_spooled(raw_email)
+
+    subject = decode_str(msg["Subject"])
+    from_ = decode_str(msg["From"])
+    to_raw, to_email = recipient(msg)
+
+    body_text = ""
+    body_html = None
+
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            disposition = str(part.get("Content-Disposition"))
+            try:
+                payload = part.get_payload(decode=True)
+                if payload:
+                    if content_type == "text/plain" and "attachment" not in disposition:
+                        body_text += payload.decode('utf-8', errors='ignore')
+                    elif content_type == "text/html" and "attachment" not in disposition:
+                        body_html = payload
+            except: pass
+    else:
+        payload = msg.get_payload(decode=True) or b''
+        if msg.get_content_type() == "text/html":
+            body_html = payload
+        else:
+            body_text = payload.decode('utf-8', errors='ignore')
+
+    if body_html and len(body_html) > MAIL_HTML_MAX:
+        body_html = body_html[:MAIL_HTML_MAX]
+        truncated = True
+
+    # One pass over the HTML for both the text of HTML-only mail and the links
+    html_links = []
+    if body_html:
+        html_text, html_links = extract_html(body_html)
+        if not body_text:
+            body_text = html_text
+
+    body_text = body_text.strip()
+    if len(body_text) > MAIL_TEXT_MAX:
+        body_text = body_text[:MAIL_TEXT_MAX]
+        truncated = True
+    return {
+        "subject": subject,
+        "from": from_,
+        "to_raw": to_raw,
+        "to_email": to_email,
+        "text": body_text,
+        "html": body_html,
+        "links": html_links or text_links(body_text),
+        "preview": smart_format_text(body_text),
+        "raw_size": raw_size,
+        "truncated": truncated,
+    }
+
+
+def _ready(_):
+    return os.getpid()
+
+
+class ParserPool:
+    """
+    parse_message() in worker processes. processes=0 parses in the calling
+    thread. parse() blocks the caller until its message is done, so run it
+    from several threads (the pipeline's parse stage) to keep all workers
+    busy. A crashed pool is replaced; the message is then parsed in-process.
+    """
+
+    def __init__(self, processes=PARSE_PROCESSES):
+        self.processes = processes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the workers. Call it early, before other threads exist:
+        workers are forked where possible, so they do not re-import the bot.
+        """
+        if self.processes > 0:
+            with self._lock:
+                self._executor = self._new_executor()
+            # Forks every worker now instead of on the first message
+            list(self._executor.map(_ready, range(self.processes)))
+        return self
+
+    def _new_executor(self):
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        return ProcessPoolExecutor(self.processes, mp_context=context)
+
+    def parse(self, raw):
+        executor = self._executor
+        if executor is None:
+            return parse_message(raw)
+        try:
+            return executor.submit(parse_message, raw).result()
+        except BrokenProcessPool:
+            print("Parser pool crashed, restarting")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = self._new_executor()
+            return parse_message(raw)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
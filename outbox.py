@@ -0,0 +1,131 @@
+"""
+Telegram notifications through the database outbox.
+
+add_emails() writes an outbox row for every email to be announced in the
+same transaction as the email, so nothing stored is left without its
+notification. The pipeline's notify stage sends it right away from memory
+(Outbox.deliver). Whatever failed, and whatever was left when the bot
+stopped, goes to the retry worker, which rebuilds the email from the
+database and backs off between attempts. A restart touches only the
+pending rows.
+
+A sent notification keeps its Telegram message_id. The one gap is a crash
+after Telegram accepted a message but before its row was marked sent: that
+notification goes out again on the next start.
+
+    outbox = Outbox(db, send)       # send(chat_id, email) -> message_id
+    outbox.start()                  # releases the previous run's leases
+    pipeline stage: outbox.deliver(stored)
+"""
+import os
+import random
+import threading
+import time
+
+NOTIFY_RETRIES = int(os.environ.get('NOTIFY_RETRIES', '8'))
+NOTIFY_RETRY_DELAY = float(os.environ.get('NOTIFY_RETRY_DELAY', '10'))     # first retry, doubled after each
+NOTIFY_RETRY_MAX = float(os.environ.get('NOTIFY_RETRY_MAX', '3600'))
+OUTBOX_BATCH = 50
+OUTBOX_POLL = 30            # seconds between looks at the outbox when nothing is due sooner
+
+
+class PermanentError(Exception):
+    """Raised by send() when trying again cannot help (bot blocked, chat not found)."""
+
+
+class RetryAfter(Exception):
+    """Raised by send() when Telegram asks to wait `seconds` (429); does not use up a retry."""
+
+    def __init__(self, seconds, message=None):
+        super().__init__(message or f'retry after {seconds}s')
+        self.seconds = seconds
+
+
+class Outbox:
+    """
+    send(chat_id, email) delivers one notification and returns the Telegram
+    message_id. `email` is the dict add_emails() returned, or for a retry the
+    get_email_by_uid() dict with its 'attachments'.
+    """
+
+    def __init__(self, db, send, retries=NOTIFY_RETRIES, retry_delay=NOTIFY_RETRY_DELAY,
+                 retry_max=NOTIFY_RETRY_MAX):
+        self.db = db
+        self.send = send
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retry_max = retry_max
+        self.running = False
+        self._wake = threading.Event()
+        self._thread = None
+
+    def deliver(self, stored):
+        """First attempt, from the notify stage, with the email still in memory."""
+        chat_id = self.db.claim_notification(stored['uid'])
+        if chat_id is not None:
+            self._attempt(stored['uid'], chat_id, 1, stored)
+
+    def start(self):
+        pending = self.db.release_notifications()
+        if pending:
+            print(f"📬 {pending} notifications pending from the previous run")
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        # Leased rows are released on the next start()
+        self.running = False
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def load(self, uid):
+        email = self.db.get_email_by_uid(uid)
+        if email is not None:
+            email['attachments'] = self.db.get_attachments(uid)
+        return email
+
+    def _run(self):
+        while self.running:
+            try:
+                rows = self.db.claim_notifications(OUTBOX_BATCH)
+                for row in rows:
+                    if not self.running:
+                        break
+                    self._attempt(row['uid'], row['chat_id'], row['attempts'])
+                if rows:
+                    continue
+                due = self.db.next_notification_due()
+            except Exception as e:
+                print(f"Outbox Error: {e}")
+                due = None
+            timeout = OUTBOX_POLL if due is None else min(OUTBOX_POLL, max(0.0, due - time.time()))
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def _attempt(self, uid, chat_id, attempts, email=None):
+        try:
+            email = email or self.load(uid)
+            if email is None:
+                self.db.retry_notification(uid, 'email not found')
+                return
+            message_id = self.send(chat_id, email)
+        except PermanentError as e:
+            print(f"Notification {uid} to {chat_id} dropped: {e}")
+            self.db.retry_notification(uid, str(e))
+        except Exception as e:
+            if isinstance(e, RetryAfter):
+                delay = e.seconds
+            elif attempts >= self.retries:
+                print(f"Notification {uid} to {chat_id} failed {attempts} times, giving up: {e}")
+                self.db.retry_notification(uid, str(e))
+                return
+            else:
+                delay = min(self.retry_max, self.retry_delay * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+            print(f"Notification {uid} to {chat_id} failed (attempt {attempts}), retry in {delay:.0f}s: {e}")
+            self.db.retry_notification(uid, str(e), delay, counted=not isinstance(e, RetryAfter))
+            self._wake.set()
+        else:
+            self.db.complete_notification(uid, message_id)
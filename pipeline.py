@@ -0,0 +1,215 @@
+"""
+Staged ingestion: independent stages joined by bounded queues.
+
+Each stage has its own worker threads. A full queue blocks the stage before
+it, so a slow Telegram upload backs up into parsing and finally into the
+IMAP fetch instead of growing memory. Items that fail in a stage are logged
+and dropped; the rest of the pipeline keeps going.
+
+    p = Pipeline([
+        Stage('parse', parse, workers=2),
+        Stage('store', store_batch, batch_size=200, batch_timeout=2.0),
+        Stage('notify', notify, workers=4),
+    ])
+    p.put(raw)          # blocks while 'parse' is full
+    p.flush('store')    # everything put so far is stored
+    p.close()           # drains and stops the workers
+"""
+import collections
+import queue
+import threading
+import time
+
+_STOP = object()
+_CUT = object()     # wakes a batching worker to send what it has (flush)
+
+
+class Stage:
+    """
+    fn(item) returns the item for the next stage, or None to drop it. With
+    batch_size > 1, fn gets a list of up to batch_size items (collected for
+    at most batch_timeout seconds) and returns a list, fanned out again.
+    A batch holding an item for which urgent(item) is true does not wait:
+    it goes as soon as the queue runs empty. The same holds for every batch
+    while Pipeline.flush() waits on this stage and the stages before it
+    have nothing left.
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=100, batch_size=1, batch_timeout=1.0, urgent=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.urgent = urgent
+        self.next = None
+        self.pending = 0          # queued or being processed
+        self.flushing = 0         # flush() calls waiting on this stage
+        self.processed = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=1000)   # enqueue -> done, seconds
+        self._threads = []
+
+    def stats(self):
+        lat = sorted(self.latencies)
+        return {
+            'depth': self.queue.qsize(),
+            'pending': self.pending,
+            'workers': self.workers,
+            'processed': self.processed,
+            'errors': self.errors,
+            'latency_avg': sum(lat) / len(lat) if lat else 0.0,
+            'latency_p95': lat[int(len(lat) * 0.95)] if lat else 0.0,
+        }
+
+
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = list(stages)
+        for stage, following in zip(self.stages, self.stages[1:]):
+            stage.next = following
+        self._cond = threading.Condition()
+        self._closed = False
+        for stage in self.stages:
+            for i in range(stage.workers):
+                t = threading.Thread(target=self._work, args=(stage,), name=f'{stage.name}-{i}', daemon=True)
+                t.start()
+                stage._threads.append(t)
+
+    def put(self, item, timeout=None):
+        """Hands an item to the first stage; blocks while it is full."""
+        if self._closed:
+            raise RuntimeError('pipeline is closed')
+        self._enqueue(self.stages[0], item, timeout)
+
+    def _enqueue(self, stage, item, timeout=None):
+        with self._cond:
+            stage.pending += 1
+        try:
+            stage.queue.put((time.monotonic(), item), timeout=timeout)
+        except queue.Full:
+            self._done(stage, 1)
+            raise
+
+    def _done(self, stage, n):
+        with self._cond:
+            stage.pending -= n
+            self._cond.notify_all()
+
+    def _take(self, stage):
+        """Next item, or a batch for batching stages; _STOP when shutting down."""
+        first = stage.queue.get()
+        while first is _CUT:
+            first = stage.queue.get()
+        if first is _STOP or stage.batch_size <= 1:
+            return first
+        batch = [first]
+        urgent = stage.urgent is not None and stage.urgent(first[1])
+        deadline = time.monotonic() + stage.batch_timeout
+        while len(batch) < stage.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                # Someone waits for an urgent item or a flush: take what is queued, no more
+                if urgent or stage.flushing:
+                    entry = stage.queue.get_nowait()
+                else:
+                    entry = stage.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if entry is _CUT:
+                break
+            if entry is _STOP:
+                # Let the other workers see it too, after this batch
+                stage.queue.put(_STOP)
+                break
+            batch.append(entry)
+            urgent = urgent or (stage.urgent is not None and stage.urgent(entry[1]))
+        return batch
+
+    def _work(self, stage):
+        while True:
+            entry = self._take(stage)
+            if entry is _STOP:
+                return
+            entries = entry if stage.batch_size > 1 else [entry]
+            items = [item for _, item in entries]
+            try:
+                result = stage.fn(items if stage.batch_size > 1 else items[0])
+                outputs = (result or []) if stage.batch_size > 1 else ([] if result is None else [result])
+                if stage.next is not None:
+                    for out in outputs:
+                        self._enqueue(stage.next, out)
+            except Exception as e:
+                print(f"Pipeline stage {stage.name} error: {e}")
+                with self._cond:
+                    stage.errors += len(items)
+            now = time.monotonic()
+            with self._cond:
+                stage.processed += len(items)
+                stage.latencies.extend(now - queued for queued, _ in entries)
+            self._done(stage, len(items))
+
+    def flush(self, through=None, timeout=None):
+        """
+        Waits until every item put so far has left stage `through` (default:
+        the last stage). A batching stage on the way sends its batch without
+        waiting out batch_timeout, but only once the stages before it have
+        handed it everything put so far: what was put before the flush goes
+        out in full batches, not one item at a time as the stages before
+        finish them. Returns False on timeout.
+        """
+        names = [s.name for s in self.stages]
+        upto = self.stages[:names.index(through) + 1] if through else self.stages
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        cut = []
+        try:
+            for i, stage in enumerate(upto):
+                if stage.batch_size <= 1:
+                    continue
+                with self._cond:
+                    if not self._cond.wait_for(lambda: not any(s.pending for s in upto[:i]), remaining()):
+                        return False
+                    stage.flushing += 1
+                cut.append(stage)
+                # A worker collecting a batch is woken to send it now
+                for _ in stage._threads:
+                    try:
+                        stage.queue.put_nowait(_CUT)
+                    except queue.Full:
+                        pass    # it does not wait when there is that much queued
+            with self._cond:
+                return self._cond.wait_for(lambda: not any(s.pending for s in upto), remaining())
+        finally:
+            with self._cond:
+                for stage in cut:
+                    stage.flushing -= 1
+
+    def close(self, timeout=None):
+        """Stops taking new items, drains what is queued and stops the workers."""
+        self._closed = True
+        drained = self.flush(timeout=timeout)
+        for stage in self.stages:
+            for _ in stage._threads:
+                stage.queue.put(_STOP)
+        for stage in self.stages:
+            for t in stage._threads:
+                t.join(timeout)
+        return drained
+
+    def stats(self):
+        with self._cond:
+            return {s.name: s.stats() for s in self.stages}
+
+    def format_stats(self):
+        return ' | '.join(
+            f"{name}: q={s['depth']} done={s['processed']} err={s['errors']} "
+            f"lat={s['latency_avg'] * 1000:.0f}/{s['latency_p95'] * 1000:.0f}ms"
+            for name, s in self.stats().items()
+        )
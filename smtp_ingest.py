@@ -0,0 +1,333 @@
+"""
+Push ingestion over LMTP (RFC 2033) or SMTP (RFC 5321).
+
+For the domains in ALLOWED_DOMAINS our own MTA can hand mail straight to the
+bot instead of relaying it to the upstream mailbox and waiting for IMAP to
+bring it back. Recipients are checked against the alias table during RCPT
+TO, so unknown, inactive and foreign addresses are refused before DATA. An
+accepted message goes through the same parse, store and notify stages as the
+IMAP mail (one record per recipient, parsed by prepare()), and the MTA gets
+its reply only after the message is stored: a 250 means it is in the
+database.
+
+LMTP is the default: its reply after DATA is per recipient, so one failed
+recipient does not make the MTA send the message again to the others.
+
+Only the standard library (asyncio) is used, so the server can be tried on
+localhost with smtplib:
+
+    server = IngestServer(db, parse_message, deliver, port=0).start()
+    with smtplib.LMTP('127.0.0.1', server.port) as client:
+        client.sendmail('a@example.com', ['user@dreampartners.online'], raw)
+"""
+import asyncio
+import os
+import re
+import socket
+import threading
+
+from database import ALLOWED_DOMAINS
+from mail_parser import MessageSpool
+
+SMTP_INGEST_HOST = os.environ.get('SMTP_INGEST_HOST', '127.0.0.1')
+SMTP_INGEST_PORT = int(os.environ.get('SMTP_INGEST_PORT', '0'))                     # 0: off
+SMTP_INGEST_PROTOCOL = os.environ.get('SMTP_INGEST_PROTOCOL', 'lmtp').lower()       # lmtp | smtp
+SMTP_MAX_MESSAGE_SIZE = int(os.environ.get('SMTP_MAX_MESSAGE_SIZE', str(25 << 20)))
+SMTP_MAX_RECIPIENTS = int(os.environ.get('SMTP_MAX_RECIPIENTS', '100'))
+SMTP_DELIVERY_TIMEOUT = float(os.environ.get('SMTP_DELIVERY_TIMEOUT', '60'))        # DATA -> stored
+SMTP_TIMEOUT = 300          # idle client, RFC 5321 4.5.3.2
+SMTP_LINE_LIMIT = 1 << 20   # longer lines are not mail any MTA would send
+# Records from the server carry this source, so the pipeline knows whose prepare() to call
+SMTP_SOURCE = 'smtp'
+
+_PATH_RE = re.compile(r'(?i)^(FROM|TO):\s*<([^>]*)>\s*(.*)$')
+
+
+def _address(path):
+    """<@relay:user@domain> -> user@domain, lower-cased."""
+    return path.rpartition(':')[2].strip().lower()
+
+
+def _size(params):
+    """The SIZE= of MAIL FROM parameters ('SIZE=100 BODY=8BITMIME'), 0 if not given."""
+    for item in params.split():
+        key, _, value = item.partition('=')
+        if key.upper() == 'SIZE' and value.isdigit():
+            return int(value)
+    return 0
+
+
+class _Session:
+    def __init__(self):
+        self.greeted = False
+        self.reset()
+
+    def reset(self):
+        self.mail_from = None
+        self.recipients = []
+
+
+class IngestServer:
+    """
+    Accepts mail for our aliases. `parse(raw)` gives the add_emails() dict
+    (parse_message or ParserPool.parse); `deliver(record)` hands a record
+    ({'source', 'raw', 'mail_from', 'envelope_to', 'peer'}; raw is bytes,
+    or the path of a spooled message that is removed once deliver returns)
+    to the ingestion stages and blocks until it is stored, raising if it
+    was not.
+    The stages call prepare(record) to parse it.
+    """
+
+    def __init__(self, db, parse, deliver, host=SMTP_INGEST_HOST, port=SMTP_INGEST_PORT,
+                 lmtp=SMTP_INGEST_PROTOCOL == 'lmtp', hostname=None, domains=ALLOWED_DOMAINS,
+                 max_size=SMTP_MAX_MESSAGE_SIZE, max_recipients=SMTP_MAX_RECIPIENTS, timeout=SMTP_TIMEOUT):
+        self.db = db
+        self.parse = parse
+        self.deliver = deliver
+        self.host = host
+        self.port = port
+        self.lmtp = lmtp
+        self.hostname = hostname or socket.getfqdn()
+        self.domains = {d.lower() for d in domains}
+        self.max_size = max_size
+        self.max_recipients = max_recipients
+        self.timeout = timeout
+        self.running = False
+        self._loop = None
+        self._stopped = None
+        self._listening = threading.Event()
+        self._sessions = set()
+        self._waiting = set()       # sessions between commands, safe to cut off
+
+    # --- Lifecycle ---
+
+    def run(self):
+        """Serves until stop()."""
+        self.running = True
+        asyncio.run(self._serve())
+
+    def start(self):
+        """run() in a background thread; returns once the port is bound (self.port is set)."""
+        threading.Thread(target=self.run, name='smtp-ingest', daemon=True).start()
+        self._listening.wait()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def _serve(self):
+        self._stopped = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._handle, self.host, self.port, limit=SMTP_LINE_LIMIT)
+        self.port = server.sockets[0].getsockname()[1]
+        print(f"{'LMTP' if self.lmtp else 'SMTP'} ingestion listening on {self.host}:{self.port}")
+        self._listening.set()
+        if not self.running:
+            self._stopped.set()
+        await self._stopped.wait()
+        server.close()
+        # Idle sessions are closed now, the others once their command is answered
+        for task in list(self._waiting):
+            task.cancel()
+        if self._sessions:
+            await asyncio.wait(self._sessions, timeout=SMTP_DELIVERY_TIMEOUT)
+
+    # --- What gets in ---
+
+    def check_recipient(self, address):
+        """None if mail for `address` is accepted, otherwise the (code, text) to refuse it with."""
+        if address.rpartition('@')[2] not in self.domains:
+            return 550, '5.7.1 Relay access denied'
+        route = self.db.route(address)
+        if route is None:
+            return 550, '5.1.1 No such user here'
+        if not route[1]:
+            return 550, '5.2.1 Mailbox disabled'
+        return None
+
+    def prepare(self, record):
+        """Parses a delivered record into the add_emails() dict, addressed to its envelope recipient."""
+        parsed = self.parse(record['raw'])
+        # The envelope says who it is for; To: may be a list or a Bcc'd stranger
+        return {**parsed, 'to_email': record['envelope_to']}
+
+    # --- Protocol ---
+
+    async def _handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        task = asyncio.current_task()
+        self._sessions.add(task)
+        session = _Session()
+        try:
+            await self._reply(writer, 220, f"{self.hostname} {'LMTP' if self.lmtp else 'ESMTP'} ready")
+            while self.running:
+                self._waiting.add(task)
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.timeout)
+                except asyncio.TimeoutError:
+                    await self._reply(writer, 421, '4.4.2 Idle timeout, closing')
+                    break
+                except ValueError:
+                    await self._reply(writer, 500, '5.5.2 Line too long')
+                    continue
+                finally:
+                    self._waiting.discard(task)
+                if not line:
+                    break
+                if not await self._command(reader, writer, session, peer, line.decode('utf-8', 'replace').strip()):
+                    break
+            else:
+                await self._reply(writer, 421, '4.3.2 Shutting down')
+        except asyncio.CancelledError:
+            # stop() while waiting for a command
+            await self._reply(writer, 421, '4.3.2 Shutting down')
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except Exception as e:
+            print(f"SMTP session error ({peer}): {e}")
+        finally:
+            self._sessions.discard(task)
+            self._waiting.discard(task)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _command(self, reader, writer, session, peer, line):
+        """Handles one command line; False ends the session."""
+        verb, _, arg = line.partition(' ')
+        verb = verb.upper()
+        greeting = 'LHLO' if self.lmtp else 'EHLO'
+
+        if verb in ('LHLO', 'EHLO', 'HELO'):
+            if (verb == 'LHLO') != self.lmtp:
+                await self._reply(writer, 500, f'5.5.1 Use {greeting}')
+                return True
+            session.greeted = True
+            session.reset()
+            if verb == 'HELO':
+                await self._reply(writer, 250, self.hostname)
+            else:
+                await self._reply(writer, 250, [self.hostname, 'PIPELINING', '8BITMIME', 'ENHANCEDSTATUSCODES',
+                                                f'SIZE {self.max_size}'])
+        elif verb == 'MAIL':
+            m = _PATH_RE.match(arg)
+            if not session.greeted:
+                await self._reply(writer, 503, f'5.5.1 Send {greeting} first')
+            elif session.mail_from is not None:
+                await self._reply(writer, 503, '5.5.1 Nested MAIL command')
+            elif not m or m.group(1).upper() != 'FROM':
+                await self._reply(writer, 501, '5.5.4 Syntax: MAIL FROM:<address>')
+            elif _size(m.group(3)) > self.max_size:
+                await self._reply(writer, 552, '5.3.4 Message too big')
+            else:
+                session.mail_from = _address(m.group(2))
+                await self._reply(writer, 250, '2.1.0 Ok')
+        elif verb == 'RCPT':
+            m = _PATH_RE.match(arg)
+            if session.mail_from is None:
+                await self._reply(writer, 503, '5.5.1 Need MAIL first')
+            elif not m or m.group(1).upper() != 'TO':
+                await self._reply(writer, 501, '5.5.4 Syntax: RCPT TO:<address>')
+            elif len(session.recipients) >= self.max_recipients:
+                await self._reply(writer, 452, '4.5.3 Too many recipients')
+            else:
+                address = _address(m.group(2))
+                # route() may have to reload the alias table
+                refused = await self._loop.run_in_executor(None, self.check_recipient, address)
+                if refused:
+                    await self._reply(writer, *refused)
+                else:
+                    session.recipients.append(address)
+                    await self._reply(writer, 250, '2.1.5 Ok')
+        elif verb == 'DATA':
+            if session.mail_from is None:
+                await self._reply(writer, 503, '5.5.1 Need MAIL first')
+            elif not session.recipients:
+                await self._reply(writer, 554, '5.5.1 No valid recipients')
+            else:
+                await self._reply(writer, 354, 'End data with <CR><LF>.<CR><LF>')
+                # Big messages go to a temporary file, and the parser gets its path
+                with MessageSpool() as spool:
+                    fits = await self._read_data(reader, spool)
+                    await self._finish(writer, session, peer, spool.message() if fits else None)
+                session.reset()
+        elif verb == 'RSET':
+            session.reset()
+            await self._reply(writer, 250, '2.0.0 Ok')
+        elif verb == 'NOOP':
+            await self._reply(writer, 250, '2.0.0 Ok')
+        elif verb == 'VRFY':
+            await self._reply(writer, 252, '2.5.2 Cannot VRFY, send some mail')
+        elif verb == 'QUIT':
+            await self._reply(writer, 221, '2.0.0 Bye')
+            return False
+        else:
+            await self._reply(writer, 500, '5.5.2 Command not recognized')
+        return True
+
+    async def _read_data(self, reader, spool):
+        """Writes the message up to the lone dot, unstuffed, to spool. False if it is bigger than max_size."""
+        too_big = False
+        while True:
+            try:
+                line = await asyncio.wait_for(reader.readline(), self.timeout)
+            except ValueError:
+                # Over SMTP_LINE_LIMIT; the rest of the line is read as the next one
+                too_big = True
+                continue
+            if not line:
+                raise asyncio.IncompleteReadError(b'', None)
+            if line in (b'.\r\n', b'.\n'):
+                return not too_big
+            if too_big:
+                # Read on to the end so the session stays in sync
+                continue
+            if line.startswith(b'.'):
+                line = line[1:]
+            if spool.size + len(line) > self.max_size:
+                too_big = True
+                spool.close()
+                continue
+            spool.write(line)
+
+    async def _finish(self, writer, session, peer, raw):
+        recipients = session.recipients
+        if raw is None:
+            replies = [(552, '5.3.4 Message too big')] * len(recipients)
+        else:
+            results = await asyncio.gather(*[
+                self._loop.run_in_executor(None, self.deliver, {
+                    'source': SMTP_SOURCE, 'raw': raw, 'mail_from': session.mail_from,
+                    'envelope_to': rcpt, 'peer': peer,
+                })
+                for rcpt in recipients
+            ], return_exceptions=True)
+            replies = []
+            for rcpt, result in zip(recipients, results):
+                if isinstance(result, BaseException):
+                    print(f"Delivery to {rcpt} failed: {result!r}")
+                    # Temporary: the MTA keeps the message and tries again
+                    replies.append((451, '4.3.0 Not stored, try again later'))
+                else:
+                    replies.append((250, f'2.0.0 Ok: stored as {result}'))
+        if self.lmtp:
+            for reply in replies:
+                await self._reply(writer, *reply)
+        elif all(code == 250 for code, _ in replies):
+            await self._reply(writer, 250, f"2.0.0 Ok: stored as {' '.join(str(r) for r in results)}")
+        else:
+            # SMTP has one reply for all recipients; resending to the ones
+            # already stored beats losing the others
+            await self._reply(writer, *next(r for r in replies if r[0] != 250))
+
+    async def _reply(self, writer, code, text):
+        lines = text if isinstance(text, list) else [text]
+        writer.write(b''.join(
+            f"{code}{'-' if i < len(lines) - 1 else ' '}{line}\r\n".encode()
+            for i, line in enumerate(lines)
+        ))
+        await writer.drain()
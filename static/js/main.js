@@ -75,11 +75,13 @@ const els = {
 let currentUser = null;
 let currentAlias = 'Все';
 let currentPage = 1; // UI Page (1-based)
+let currentSearch = '';
 const ITEMS_PER_PAGE = 20; // Must match backend limit if fixed, or be handled
 let isLoadingEmails = false;
 let hasMoreEmails = true;
-let totalEmails = 0;
-let adminEmailsPage = 0;
+let totalEmails = null; // Only known for search results or when requested
+let pageCursors = [null]; // pageCursors[n] = cursor that loads UI page n+1
+let adminEmailsCursor = null;
 
 const ADMIN_ID = 669994046;
 let adminTargetUserId = null; // For creating alias for another user
@@ -168,12 +170,14 @@ function setupUI() {
         clearTimeout(timeout);
         timeout = setTimeout(() => {
             currentPage = 1;
+            pageCursors = [null];
             els.emailsList.innerHTML = '';
             currentEmailsData = [];
             selectedEmailUids.clear();
             updateMassActionsUI();
             hasMoreEmails = true;
-            loadEmails(currentAlias, 0, e.target.value);
+            currentSearch = e.target.value.trim();
+            loadEmails(currentAlias, 0, currentSearch);
         }, 500);
     });
 }
@@ -274,6 +278,7 @@ async function loadDashboard() {
             
             // Initial load
     currentPage = 1;
+    pageCursors = [null];
     els.emailsList.innerHTML = '';
     currentEmailsData = [];
     selectedEmailUids.clear();
@@ -315,6 +320,7 @@ function switchAlias(alias) {
     });
     
     currentPage = 1;
+    pageCursors = [null];
     els.emailsList.innerHTML = '';
     currentEmailsData = [];
     selectedEmailUids.clear();
@@ -325,7 +331,7 @@ function switchAlias(alias) {
 
 // --- Emails ---
 
-async function loadEmails(alias = currentAlias, page = currentPage - 1, search = '') {
+async function loadEmails(alias = currentAlias, page = currentPage - 1, search = currentSearch) {
     isLoadingEmails = true;
     updatePaginationUI(); // Disable buttons while loading
     
@@ -336,20 +342,18 @@ async function loadEmails(alias = currentAlias, page = currentPage - 1, search =
             body: JSON.stringify({ 
                 initData: tg.initData,
                 alias: alias === 'Все' ? null : alias,
-                page: page,
+                page: page, // Search results page by offset
+                cursor: pageCursors[page] ?? null, // Plain listing pages by uid cursor
                 search: search
             })
         });
         const data = await res.json();
         
         if (data.status === 'ok') {
-            // Update total logic
-            totalEmails = data.total;
-            const totalPages = Math.ceil(totalEmails / ITEMS_PER_PAGE) || 1;
-            
-            // Check if we have more pages
-            if (currentPage < totalPages) hasMoreEmails = true;
-            else hasMoreEmails = false;
+            totalEmails = data.total ?? null;
+            hasMoreEmails = data.has_more;
+            // Remember where the next page starts
+            pageCursors[page + 1] = data.next_cursor;
 
             // Clear list for pagination
             els.emailsList.innerHTML = '';
@@ -379,8 +383,11 @@ function changePage(delta) {
 }
 
 function updatePaginationUI() {
-    const totalPages = Math.ceil(totalEmails / ITEMS_PER_PAGE) || 1;
-    if (els.pageIndicator) els.pageIndicator.textContent = `Стр. ${currentPage} из ${totalPages}`;
+    if (els.pageIndicator) {
+        els.pageIndicator.textContent = totalEmails !== null
+            ? `Стр. ${currentPage} из ${Math.ceil(totalEmails / ITEMS_PER_PAGE) || 1}`
+            : `Стр. ${currentPage}`;
+    }
     
     if (els.prevPageBtn) {
         els.prevPageBtn.disabled = currentPage <= 1 || isLoadingEmails;
@@ -390,8 +397,8 @@ function updatePaginationUI() {
     }
     
     if (els.nextPageBtn) {
-        els.nextPageBtn.disabled = currentPage >= totalPages || isLoadingEmails;
-        if (currentPage >= totalPages) els.nextPageBtn.style.visibility = 'hidden';
+        els.nextPageBtn.disabled = !hasMoreEmails || isLoadingEmails;
+        if (!hasMoreEmails) els.nextPageBtn.style.visibility = 'hidden';
         else els.nextPageBtn.style.visibility = 'visible';
     }
 }
@@ -585,7 +592,7 @@ async function deleteSelectedEmails() {
         updateMassActionsUI();
         els.selectAllCheckbox.checked = false;
         
-        currentPage = 0;
+        // Cursors stay valid after deletes, so the current page just reloads
         els.emailsList.innerHTML = '';
         currentEmailsData = [];
         loadEmails(currentAlias);
@@ -612,8 +619,7 @@ async function deleteUserEmail(uid, fromView = false) {
             if (fromView) {
                 showScreen(els.dashboard);
             }
-            // Reload emails
-            currentPage = 0;
+            // Reload emails (cursors stay valid after deletes)
             els.emailsList.innerHTML = '';
             currentEmailsData = [];
             selectedEmailUids.clear();
@@ -660,7 +666,14 @@ async function openEmail(uid, fromAdmin = false) {
             } else {
                 els.emailBody.textContent = data.text_body;
             }
-            
+            // Big messages are stored cut short
+            if (data.truncated) {
+                const note = document.createElement('p');
+                note.textContent = '✂️ Письмо большое, сохранено только начало'
+                    + (data.raw_size ? ` (из ${(data.raw_size / 1048576).toFixed(1)} МБ)` : '');
+                els.emailBody.prepend(note);
+            }
+
             // Adjust Back Button behavior
             if (fromAdmin) {
                 els.backButton.onclick = () => showScreen(els.adminUserDetailView);
@@ -1068,7 +1081,7 @@ async function adminAddAlias(userId) {
 
 async function loadAdminUserEmails(userId, reset = false) {
     if (reset) {
-        adminEmailsPage = 0;
+        adminEmailsCursor = null;
         adminUserEmailsData = [];
         els.adminUserEmails.innerHTML = '';
     }
@@ -1077,7 +1090,7 @@ async function loadAdminUserEmails(userId, reset = false) {
         const res = await fetch('/api/admin/user_emails', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ initData: tg.initData, user_id: userId, page: adminEmailsPage })
+            body: JSON.stringify({ initData: tg.initData, user_id: userId, cursor: adminEmailsCursor })
         });
         const data = await res.json();
         if (data.status === 'ok') {
@@ -1089,10 +1102,10 @@ async function loadAdminUserEmails(userId, reset = false) {
             
             renderAdminUserEmailsUI(userId);
             
-            if (data.emails.length === 50) {
+            if (data.has_more) {
                 els.adminLoadMoreEmailsBtn.style.display = 'block';
                 els.adminLoadMoreEmailsBtn.onclick = () => {
-                    adminEmailsPage++;
+                    adminEmailsCursor = data.next_cursor;
                     loadAdminUserEmails(userId);
                 };
             } else {
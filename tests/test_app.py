@@ -0,0 +1,49 @@
+import hashlib
+import hmac
+import importlib
+import json
+import sys
+from urllib.parse import urlencode
+
+import pytest
+
+pytest.importorskip('flask')
+
+from database import ADMIN_ID
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # app.py opens emails.db in the working directory on import
+    monkeypatch.chdir(tmp_path)
+    sys.modules.pop('app', None)
+    app = importlib.import_module('app')
+    yield app
+    sys.modules.pop('app', None)
+
+
+def init_data(token, user_id):
+    fields = {'auth_date': '1700000000', 'user': json.dumps({'id': user_id})}
+    check = '\n'.join(f'{k}={v}' for k, v in sorted(fields.items()))
+    secret = hmac.new(b'WebAppData', token.encode(), hashlib.sha256).digest()
+    fields['hash'] = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+@pytest.mark.parametrize('path', ['/api/emails', '/api/admin/user_emails'])
+@pytest.mark.parametrize('cursor', ['abc', '1.5', 1.5, True, [1], {'uid': 1}])
+def test_bad_cursor_is_a_client_error(app, path, cursor):
+    client = app.app.test_client()
+    response = client.post(path, json={'initData': init_data(app.BOT_TOKEN, ADMIN_ID), 'user_id': ADMIN_ID,
+                                       'cursor': cursor})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('path', ['/api/emails', '/api/admin/user_emails'])
+@pytest.mark.parametrize('cursor', [None, 5, '5'])
+def test_cursor(app, path, cursor):
+    client = app.app.test_client()
+    response = client.post(path, json={'initData': init_data(app.BOT_TOKEN, ADMIN_ID), 'user_id': ADMIN_ID,
+                                       'cursor': cursor})
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'ok'
@@ -0,0 +1,65 @@
+import pytest
+
+from database import ALLOWED_DOMAINS, EmailDatabase
+
+ALIAS = f'user@{ALLOWED_DOMAINS[0]}'
+
+
+def message(server_uid, text='Hello', source='acct/INBOX'):
+    return {'source': source, 'uidvalidity': 1, 'server_uid': server_uid, 'to_email': ALIAS,
+            'from': 'sender@example.org', 'subject': f'Message {server_uid}', 'text': text, 'html': None}
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    db.add_alias(1000, ALIAS)
+    yield db
+    db.close()
+
+
+def test_body_collected_after_prepare_is_stored_again(db):
+    [first] = db.add_emails([message(1, 'shared body')])
+    prepare = db._prepare_bodies
+
+    def racing_prepare(messages):
+        # The body is there when looked up, then its only email goes
+        bodies = prepare(messages)
+        assert db.delete_email(first['uid'])
+        return bodies
+
+    db._prepare_bodies = racing_prepare
+    [second] = db.add_emails([message(2, 'shared body')])
+    assert db.get_email_by_uid(second['uid'])['text'] == 'shared body'
+
+
+def test_email_with_a_taken_uid_is_not_stored(db):
+    [live] = db.add_emails([message(1)])
+    clash = {**message(2, source='acct/Archive'), 'uid': live['uid'], 'notify': True,
+             'attachments': [{'section': '2', 'filename': 'a.pdf', 'content_type': 'application/pdf',
+                              'encoding': 'base64', 'size': 10}]}
+    assert db.add_emails([clash]) == []
+    assert db.get_attachments(live['uid']) == []
+    assert db.outbox_status()['counts'] == {}
+
+
+def test_backfill_blocks_are_never_reused(db):
+    [live] = db.add_emails([message(1000)])
+    offset = db.plan_backfill('acct/INBOX', 1, 999, [(1, 999, 999)])
+    assert 0 < offset + 1 and offset + 999 < live['uid']
+    history = db.add_emails([{**message(5), 'uid': 5 + offset}])
+    assert db.delete_email(history[0]['uid'])
+    # Planned again (UIDVALIDITY reset) after the history went: a new block below the old one
+    again = db.plan_backfill('acct/INBOX', 2, 999, [(1, 999, 999)])
+    assert again + 999 < offset + 1
+    other = db.plan_backfill('acct/Spam', 1, 10, [(1, 10, 10)])
+    assert other + 10 < again + 1
+
+
+def test_backfill_plan_without_room_is_rejected(db):
+    db.add_email(5, 1000, ALIAS, 'sender@example.org', 'Old', 'text', None)
+    with pytest.raises(ValueError):
+        db.plan_backfill('acct/INBOX', 1, 10, [(1, 10, 10)])
+    assert db.get_backfill_job('acct/INBOX') is None
+    # Four uids are left below
+    assert db.plan_backfill('acct/INBOX', 1, 4, [(1, 4, 4)]) == 0
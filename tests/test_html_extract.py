@@ -0,0 +1,28 @@
+import json
+import os
+
+import pytest
+
+from bench_html_extract import GOLDEN, golden_cases, html_parts, legacy_extract
+from bench_parse import synthetic_corpus
+from mail_parser import extract_html
+
+with open(os.path.join(GOLDEN, 'expected.json'), encoding='utf-8') as f:
+    EXPECTED = json.load(f)
+
+
+def test_every_golden_case_has_expected_output():
+    assert sorted(golden_cases()) == sorted(EXPECTED)
+
+
+@pytest.mark.parametrize('name', sorted(golden_cases()))
+def test_golden_case(name):
+    text, links = extract_html(golden_cases()[name])
+    assert {'text': text, 'links': links} == EXPECTED[name]
+
+
+def test_same_as_two_beautifulsoup_trees():
+    pytest.importorskip('bs4')
+    parts = html_parts(synthetic_corpus(200)) + list(golden_cases().values())
+    for data in parts:
+        assert extract_html(data) == legacy_extract(data)
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from database import ALLOWED_DOMAINS, EmailDatabase
+from fake_imap import FakeIMAPServer, FakeMailbox, generate_message
+from imap_idle import IdleWatcher, connect
+from imap_scheduler import Account
+from ingest import MailIngest
+from mail_parser import parse_message
+
+ALIAS = f'user@{ALLOWED_DOMAINS[0]}'
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+@pytest.fixture(params=[True, False], ids=['idle', 'noop'])
+def server(request):
+    box = FakeMailbox()
+    box.append(generate_message(0, ALIAS))
+    server = FakeIMAPServer(box, idle=request.param).start()
+    yield server
+    server.stop()
+
+
+def test_watcher_wakes_on_connect_and_on_new_mail(server):
+    seen = []
+    watcher = IdleWatcher(lambda: connect('127.0.0.1', 'u', 'p', port=server.port, use_ssl=False),
+                          lambda conn: seen.append(len(server.mailbox.uids())), poll_interval=0.1)
+    thread = threading.Thread(target=watcher.run, daemon=True)
+    thread.start()
+    try:
+        assert wait_for(lambda: seen == [1])
+        server.mailbox.append(generate_message(1, ALIAS))
+        assert wait_for(lambda: seen and seen[-1] == 2)
+    finally:
+        watcher.stop()
+        thread.join(5)
+    assert not thread.is_alive()
+    assert server.sessions == 0
+
+
+def test_watcher_reconnects_after_the_connection_drops(server):
+    wakes = []
+    conns = []
+
+    def on_wake(conn):
+        wakes.append(conn)
+        if len(wakes) == 1:
+            conns.append(conn)
+            conn.shutdown()
+
+    watcher = IdleWatcher(lambda: connect('127.0.0.1', 'u', 'p', port=server.port, use_ssl=False),
+                          on_wake, poll_interval=0.1, backoff_min=0.05)
+    thread = threading.Thread(target=watcher.run, daemon=True)
+    thread.start()
+    try:
+        assert wait_for(lambda: len(wakes) >= 2)
+    finally:
+        watcher.stop()
+        thread.join(5)
+    assert wakes[1] is not conns[0]
+
+
+def test_new_mail_is_stored_and_notified(server, tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    db.add_alias(1000, ALIAS)
+    sent = []
+    account = Account('u', 'p', '127.0.0.1', ['INBOX'], port=server.port, use_ssl=False)
+    ingest = MailIngest(db, [account], parse_message, lambda chat_id, email: sent.append(email['subject']) or 1,
+                        smtp_port=0, reconcile_interval=0)
+    thread = threading.Thread(target=ingest.run, daemon=True)
+    thread.start()
+    try:
+        # The first pass over a new source is stored without notifications
+        assert wait_for(lambda: db.get_sync_state('u/INBOX') is not None and ingest._caught_up)
+        assert sent == []
+        for i in range(1, 4):
+            server.mailbox.append(generate_message(i, ALIAS))
+        assert wait_for(lambda: len(sent) == 3)
+        assert db.get_sync_state('u/INBOX')['last_uid'] == 4
+    finally:
+        assert ingest.stop(thread, timeout=10)
+        db.close()
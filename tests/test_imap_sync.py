@@ -0,0 +1,63 @@
+import imaplib
+
+import pytest
+
+from fake_imap import FakeIMAPServer, FakeMailbox, generate_message
+from imap_sync import _untracked_tag, fetch_stream
+
+
+@pytest.fixture
+def conn():
+    box = FakeMailbox()
+    for i in range(30):
+        box.append(generate_message(i))
+    server = FakeIMAPServer(box).start()
+    conn = imaplib.IMAP4('127.0.0.1', server.port)
+    conn.login('bench@example.com', 'x')
+    conn.select('INBOX')
+    yield conn
+    try:
+        conn.logout()
+    except (OSError, imaplib.IMAP4.abort):
+        pass
+    server.stop()
+
+
+def batches():
+    return [list(range(i, i + 10)) for i in range(1, 31, 10)]
+
+
+def test_stream_yields_every_message(conn):
+    done = []
+    uids = [uid for uid, _, _ in fetch_stream(conn, iter(batches()), on_batch=done.append)]
+    assert uids == list(range(1, 31))
+    assert done == batches()
+
+
+def test_closing_early_leaves_the_connection_usable(conn):
+    stream = fetch_stream(conn, iter(batches()), window=3)
+    assert next(stream)[0] == 1
+    stream.close()
+    assert conn.noop()[0] == 'OK'
+    assert [uid for uid, _, _ in fetch_stream(conn, iter(batches()))] == list(range(1, 31))
+
+
+def test_a_dropped_connection_raises_without_reading_on(conn):
+    stream = fetch_stream(conn, iter(batches()), window=3)
+    next(stream)
+    reads = []
+
+    def dropped():
+        reads.append(1)
+        raise conn.abort('socket error: EOF')
+
+    conn.readline = dropped
+    with pytest.raises(conn.abort, match='EOF'):
+        list(stream)
+    stream.close()
+    assert len(reads) == 1
+
+
+def test_untracked_tag_needs_imaplib():
+    with pytest.raises(RuntimeError, match='imaplib'):
+        _untracked_tag(object())
@@ -0,0 +1,63 @@
+import math
+
+import pytest
+
+from database import ALLOWED_DOMAINS, EmailDatabase
+from fake_imap import FakeIMAPServer, FakeMailbox, generate_message
+from imap_scheduler import Account, source_name
+from imap_sync import IMAP_FETCH_BATCH
+from ingest import MailIngest, PipelineSink
+from mail_parser import parse_message
+
+ALIAS = f'user@{ALLOWED_DOMAINS[0]}'
+
+
+class CountingDatabase(EmailDatabase):
+    """Counts add_emails() calls: one store transaction each."""
+
+    transactions = 0
+
+    def add_emails(self, messages, raise_errors=False):
+        self.transactions += 1
+        return super().add_emails(messages, raise_errors)
+
+
+@pytest.fixture
+def mailbox():
+    box = FakeMailbox()
+    server = FakeIMAPServer(box).start()
+    yield box, Account('bench@example.com', 'x', '127.0.0.1', ['INBOX'], port=server.port, use_ssl=False)
+    server.stop()
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = CountingDatabase(str(tmp_path / 'emails.db'))
+    db.add_alias(1000, ALIAS)
+    yield db
+    db.close()
+
+
+def test_catch_up_stores_each_fetch_batch_in_one_transaction(mailbox, db):
+    box, account = mailbox
+    source = source_name(account.user, 'INBOX')
+    for i in range(5):
+        box.append(generate_message(i, ALIAS))
+    ingest = MailIngest(db, [account], parse_message, lambda chat_id, email: 1, smtp_port=0)
+    ingest.pipeline = ingest.build_pipeline()
+    sink = PipelineSink(ingest.pipeline)
+    conn = account.connect()
+    try:
+        conn.select('INBOX')
+        ingest.syncs[source].sync(conn, sink)
+        # A restart after 600 messages arrived
+        for i in range(5, 605):
+            box.append(generate_message(i, ALIAS))
+        db.transactions = 0
+        conn.select('INBOX')
+        assert ingest.syncs[source].sync(conn, sink) == 600
+    finally:
+        conn.logout()
+        ingest.pipeline.close(timeout=30)
+    assert db.get_sync_state(source)['last_uid'] == 605
+    assert db.transactions <= math.ceil(600 / IMAP_FETCH_BATCH)
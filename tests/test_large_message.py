@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+import mail_parser
+from bench_large_message import huge_text, measure, same, spooled, with_attachment
+from mail_parser import MessageSpool, parse_message
+
+CAP = 256 << 10
+# What bench_large_message.py allows by default: ten times the caps and a few MB
+MAX_PEAK = 10 * CAP + (4 << 20)
+
+
+@pytest.fixture(autouse=True)
+def caps(monkeypatch):
+    monkeypatch.setattr(mail_parser, 'MAIL_TEXT_MAX', CAP)
+    monkeypatch.setattr(mail_parser, 'MAIL_HTML_MAX', CAP)
+
+
+@pytest.mark.parametrize('make', [with_attachment, huge_text], ids=['attachment', 'text'])
+def test_spooled_peak_does_not_grow_with_the_message(make):
+    peaks = []
+    for size in (4 << 20, 16 << 20):
+        raw = make(size)
+        parsed, peak, _ = measure(lambda: spooled(raw))
+        assert parsed['raw_size'] == len(raw)
+        peaks.append(peak)
+    assert peaks[1] <= MAX_PEAK
+    assert peaks[1] < peaks[0] + (1 << 20)
+
+
+@pytest.mark.parametrize('make', [with_attachment, huge_text], ids=['attachment', 'text'])
+def test_spooled_is_the_in_memory_result_up_to_the_caps(make):
+    raw = make(4 << 20)
+    cut = spooled(raw)
+    assert same(parse_message(raw), cut)
+    assert cut['truncated'] == (make is huge_text)
+
+
+def test_spool_moves_to_a_file_and_removes_it(tmp_path):
+    with MessageSpool(threshold=100, dir=str(tmp_path)) as spool:
+        spool.write(b'x' * 60)
+        assert spool.message() == b'x' * 60
+        spool.write(b'y' * 60)
+        path = spool.message()
+        with open(path, 'rb') as f:
+            assert f.read() == b'x' * 60 + b'y' * 60
+    assert not os.path.exists(path)
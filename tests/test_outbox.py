@@ -0,0 +1,55 @@
+import pytest
+
+from database import ALLOWED_DOMAINS, EmailDatabase
+from outbox import Outbox, RetryAfter
+
+ALIAS = f'user@{ALLOWED_DOMAINS[0]}'
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    db.add_alias(1000, ALIAS)
+    yield db
+    db.close()
+
+
+def stored_email(db):
+    [stored] = db.add_emails([{'source': 'acct/INBOX', 'uidvalidity': 1, 'server_uid': 1, 'to_email': ALIAS,
+                               'from': 'sender@example.org', 'subject': 'Hi', 'text': 'Hello', 'html': None,
+                               'notify': True}])
+    return stored
+
+
+def run_due(db, outbox, passes):
+    for _ in range(passes):
+        for row in db.claim_notifications():
+            outbox._attempt(row['uid'], row['chat_id'], row['attempts'])
+
+
+def failing_outbox(db, *errors):
+    """Raises `errors` in turn, the last one from then on."""
+    calls = []
+
+    def send(chat_id, email):
+        calls.append(chat_id)
+        raise errors[min(len(calls), len(errors)) - 1]
+
+    return Outbox(db, send, retries=2, retry_delay=0), calls
+
+
+def test_rate_limit_does_not_use_up_a_retry(db):
+    outbox, calls = failing_outbox(db, RetryAfter(0), RetryAfter(0), RetryAfter(0), ConnectionError('down'))
+    outbox.deliver(stored_email(db))
+    run_due(db, outbox, 10)
+    # Three rate limited sends, then both retries
+    assert calls == [1000] * 5
+    assert db.outbox_status()['counts'] == {'failed': 1}
+
+
+def test_other_errors_give_up_after_the_retries(db):
+    outbox, calls = failing_outbox(db, ConnectionError('down'))
+    outbox.deliver(stored_email(db))
+    run_due(db, outbox, 10)
+    assert calls == [1000] * 2
+    assert db.outbox_status()['counts'] == {'failed': 1}
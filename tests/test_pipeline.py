@@ -0,0 +1,52 @@
+import threading
+import time
+
+from pipeline import Pipeline, Stage
+
+
+def batching_pipeline(parse_delay=0.0, batch_timeout=5.0):
+    batches = []
+    lock = threading.Lock()
+
+    def parse(item):
+        time.sleep(parse_delay)
+        return item
+
+    def store(batch):
+        with lock:
+            batches.append(len(batch))
+        return batch
+
+    p = Pipeline([
+        Stage('parse', parse, workers=2, queue_size=500),
+        Stage('store', store, queue_size=500, batch_size=200, batch_timeout=batch_timeout),
+    ])
+    return p, batches
+
+
+def test_flush_does_not_wait_out_batch_timeout():
+    p, batches = batching_pipeline()
+    start = time.monotonic()
+    p.put(1)
+    assert p.flush('store', timeout=10)
+    assert time.monotonic() - start < 1.0
+    assert batches == [1]
+    p.close(timeout=10)
+
+
+def test_flush_cuts_once_the_stages_before_are_drained():
+    # Parsing finishes the items one by one; the store still gets them as one batch
+    p, batches = batching_pipeline(parse_delay=0.005)
+    for i in range(100):
+        p.put(i)
+    assert p.flush('store', timeout=10)
+    assert batches == [100]
+    p.close(timeout=10)
+
+
+def test_flush_timeout():
+    p, batches = batching_pipeline(parse_delay=0.5)
+    p.put(1)
+    assert not p.flush('store', timeout=0.05)
+    assert p.flush('store', timeout=10)
+    p.close(timeout=10)
@@ -0,0 +1,145 @@
+import smtplib
+import time
+
+import pytest
+
+from bench_smtp_ingest import send
+from database import ALLOWED_DOMAINS, EmailDatabase
+from fake_imap import generate_message
+from ingest import MailIngest
+from mail_parser import parse_message
+from smtp_ingest import IngestServer
+
+DOMAIN = ALLOWED_DOMAINS[0]
+FAILING = f'broken@{DOMAIN}'
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    db.add_alias(1000, f'user@{DOMAIN}')
+    db.add_alias(1001, f'other@{DOMAIN}')
+    db.add_alias(1002, FAILING)
+    db.add_alias(999, f'off@{DOMAIN}')
+    db.toggle_alias_active(999, f'off@{DOMAIN}')
+    yield db
+    db.close()
+
+
+@pytest.fixture(params=[True, False], ids=['lmtp', 'smtp'])
+def lmtp(request):
+    return request.param
+
+
+@pytest.fixture
+def intake(db, lmtp):
+    """The bot's parse -> store -> notify stages behind an IngestServer; yields (server, notified)."""
+    notified = []
+    ingest = MailIngest(db, [], parse_message, lambda chat_id, email: notified.append((chat_id, email)) or 1,
+                        smtp_port=0, reconcile_interval=0)
+
+    def deliver(record):
+        if record['envelope_to'] == FAILING:
+            raise OSError('disk full')
+        return ingest.deliver(record)
+
+    ingest.smtp_server = IngestServer(db, parse_message, deliver, host='127.0.0.1', port=0, lmtp=lmtp,
+                                      hostname='test.local', max_size=64 << 10)
+    ingest.pipeline = ingest.build_pipeline()
+    ingest.smtp_server.start()
+    yield ingest.smtp_server, notified
+    ingest.smtp_server.stop()
+    assert ingest.pipeline.close(timeout=10)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def client(server):
+    c = (smtplib.LMTP if server.lmtp else smtplib.SMTP)('127.0.0.1', server.port)
+    c.ehlo_or_helo_if_needed()
+    return c
+
+
+@pytest.mark.parametrize('rcpt, code', [
+    (f'nobody@{DOMAIN}', 550),
+    (f'off@{DOMAIN}', 550),
+    ('someone@example.com', 550),
+    (f'User@{DOMAIN.upper()}', 250),
+])
+def test_recipients_are_checked_before_data(intake, rcpt, code):
+    server, _ = intake
+    with client(server) as c:
+        assert send(c, server.lmtp, 'sender@example.com', [rcpt], generate_message(0))[rcpt][0] == code
+
+
+def test_stored_before_the_reply_and_notified(intake, db):
+    server, notified = intake
+    raw = generate_message(1, to_addr='list@example.com')
+    with client(server) as c:
+        code, msg = send(c, server.lmtp, 'sender@example.com', [f'user@{DOMAIN}'], raw)[f'user@{DOMAIN}']
+    assert code == 250
+    uid = int(msg.decode().rsplit(' ', 1)[1])
+    # The envelope recipient, not To:, decides whose mail it is
+    assert db.get_email_by_uid(uid)['to_email'] == f'user@{DOMAIN}'
+    assert wait_for(lambda: notified)
+    assert [chat_id for chat_id, _ in notified] == [1000]
+
+
+def test_one_failed_recipient(intake, db):
+    server, _ = intake
+    recipients = [f'user@{DOMAIN}', FAILING, f'other@{DOMAIN}']
+    with client(server) as c:
+        replies = send(c, server.lmtp, 'sender@example.com', recipients, generate_message(2))
+        # The session goes on after the failure
+        assert c.noop()[0] == 250
+    if server.lmtp:
+        # One reply per recipient: only the failed one is tried again
+        assert {r: code for r, (code, _) in replies.items()} == {recipients[0]: 250, FAILING: 451,
+                                                                  recipients[2]: 250}
+    else:
+        assert {code for code, _ in replies.values()} == {451}
+    with db._reader() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM emails').fetchone()[0] == 2
+
+
+def test_oversized_messages_are_refused(intake, db):
+    server, _ = intake
+    rcpt = f'user@{DOMAIN}'
+    with client(server) as c:
+        assert c.mail('sender@example.com', [f'SIZE={server.max_size + 1}'])[0] == 552
+        c.rset()
+        # Without SIZE= the message is read to its end and then refused
+        assert send(c, server.lmtp, 'sender@example.com', [rcpt], generate_message(3, body_size=100 << 10))[rcpt][0] \
+            == 552
+        assert send(c, server.lmtp, 'sender@example.com', [rcpt], generate_message(4))[rcpt][0] == 250
+    with db._reader() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM emails').fetchone()[0] == 1
+
+
+def test_commands_out_of_order(intake):
+    server, _ = intake
+    with client(server) as c:
+        assert c.rcpt(f'user@{DOMAIN}')[0] == 503
+        assert c.docmd('DATA')[0] == 503
+        assert c.mail('sender@example.com')[0] == 250
+        assert c.mail('sender@example.com')[0] == 503
+        assert c.docmd('DATA')[0] == 554
+        assert c.docmd('LHLO' if not server.lmtp else 'EHLO', 'x')[0] == 500
+
+
+def test_dot_stuffed_lines_are_unstuffed(intake, db):
+    server, _ = intake
+    raw = (b'From: a@example.com\r\nTo: user@%s\r\nSubject: dots\r\n\r\n'
+           b'.leading dot\r\n..two\r\n.\r\nlast\r\n' % DOMAIN.encode())
+    with client(server) as c:
+        code, msg = send(c, server.lmtp, 'sender@example.com', [f'user@{DOMAIN}'], raw)[f'user@{DOMAIN}']
+    assert code == 250
+    text = db.get_email_by_uid(int(msg.decode().rsplit(' ', 1)[1]))['text']
+    assert text.splitlines()[:4] == ['.leading dot', '..two', '.', 'last']